@@ -3,7 +3,7 @@ from django.contrib.contenttypes.admin import GenericTabularInline
 from django.urls import reverse, path
 from django.utils.html import format_html
 from django.shortcuts import render
-from .models import RawTextDocument, HandwrittenNotesDocument, PDFDocument, VTTDocument, TeXDocument, TextChunk, Collection, CollectionPermission, WSConversation, GeminiAPIUsage
+from .models import RawTextDocument, HandwrittenNotesDocument, PDFDocument, VTTDocument, TeXDocument, TextChunk, Collection, CollectionPermission, WSConversation, WSConversationMessage, GeminiAPIUsage, EmbeddingCacheEntry, DocumentRegistry, IngestionJob
 from .ocr_utils import get_gemini_cost_stats
 
 
@@ -52,9 +52,40 @@ class CollectionPermissionAdmin(admin.ModelAdmin):
     list_display = ('collection', 'user', 'permission')
 
 
+class WSConversationMessageInline(admin.TabularInline):
+    model = WSConversationMessage
+    extra = 0
+    fields = ('seq', 'role', 'message_uuid', 'created_at')
+    readonly_fields = ('seq', 'role', 'message_uuid', 'created_at')
+    can_delete = False
+
+
 @admin.register(WSConversation)
 class WSConversationAdmin(admin.ModelAdmin):
     list_display = ('owner', 'id')
+    inlines = [WSConversationMessageInline]
+
+
+@admin.register(DocumentRegistry)
+class DocumentRegistryAdmin(admin.ModelAdmin):
+    list_display = ('title', 'doc_type', 'collection', 'ingestion_state', 'id')
+    list_filter = ('doc_type', 'ingestion_state')
+    search_fields = ('title',)
+
+
+@admin.register(IngestionJob)
+class IngestionJobAdmin(admin.ModelAdmin):
+    list_display = ('document', 'state', 'attempts', 'chunks_done', 'chunks_total', 'updated_at')
+    list_filter = ('state',)
+    readonly_fields = ('document', 'attempts', 'batches_done', 'chunks_done', 'chunks_total', 'task_id', 'created_at', 'updated_at', 'finished_at')
+
+
+@admin.register(EmbeddingCacheEntry)
+class EmbeddingCacheEntryAdmin(admin.ModelAdmin):
+    list_display = ('content_hash', 'model', 'input_type', 'hit_count', 'last_used')
+    list_filter = ('model', 'input_type')
+    readonly_fields = ('model', 'input_type', 'content_hash', 'hit_count', 'created_at', 'last_used')
+    exclude = ('embedding',)
 
 
 @admin.register(GeminiAPIUsage)
@@ -16,7 +16,7 @@ from django.core.files.base import ContentFile
 from .crawler_tasks import crawl_and_ingest_webpage
 
 from .vtt import parse, to_text, coalesce_captions
-from .models import Document, PDFDocument, TeXDocument, VTTDocument, Collection, CollectionPermission, EmailWhitelist, DESCENDED_FROM_DOCUMENT, DuplicateDocumentError, RawTextDocument
+from .models import Document, DocumentRegistry, PDFDocument, TeXDocument, VTTDocument, Collection, CollectionPermission, EmailWhitelist, DuplicateDocumentError, IngestionJob, CHUNKING_STRATEGIES
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import get_user_model
 
@@ -227,7 +227,7 @@ def delete_collection(request, collection_id):
     
     # Get children before deletion for notification purposes
     children_count = collection.children.count()
-    documents_count = sum(len(x.objects.filter(collection=collection)) for x in DESCENDED_FROM_DOCUMENT)
+    documents_count = DocumentRegistry.objects.filter(collection=collection).count()
     
     try:
         # Django will cascade delete children collections and documents
@@ -240,6 +240,69 @@ def delete_collection(request, collection_id):
         logger.error(f"Error deleting collection {collection_id}: {e}")
         return JsonResponse({'error': f'Failed to delete collection: {str(e)}'}, status=500)
 
+@login_required
+@require_http_methods(['GET'])
+def document(request, doc_id):
+    # served from the registry, so a document's size can be checked without loading its text
+    entry = DocumentRegistry.objects.filter(id=doc_id).select_related('collection').first()
+    if entry is None:
+        return JsonResponse({'error': 'Document not found'}, status=404)
+    if not entry.collection.user_can_view(request.user):
+        return JsonResponse({'error': 'Permission denied'}, status=403)
+    return JsonResponse({
+        'id': str(entry.id),
+        'title': entry.title,
+        'type': entry.document_class.__name__,
+        'collection': entry.collection.id,
+        'ingestion_date': entry.ingestion_date.isoformat() if entry.ingestion_date else None,
+        'ingestion_complete': entry.ingestion_complete,
+        'ingestion_state': entry.ingestion_state,
+        'ingestion_job': ingestion_job_dict(IngestionJob.latest_for(entry.id)),
+        **entry.size_metadata,
+    })
+
+
+def ingestion_job_dict(job: IngestionJob | None) -> dict | None:
+    if job is None:
+        return None
+    return {
+        'state': job.state,
+        'attempts': job.attempts,
+        'batches_done': job.batches_done,
+        'chunks_done': job.chunks_done,
+        'chunks_total': job.chunks_total,
+        'error': job.error,
+        'updated_at': job.updated_at.isoformat() if job.updated_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+@login_required
+@require_http_methods(['POST'])
+def retry_ingestion(request, doc_id):
+    # resumes after the last batch the failed job stored, rather than re-embedding the whole document
+    entry = DocumentRegistry.objects.filter(id=doc_id).select_related('collection').first()
+    if entry is None:
+        return JsonResponse({'error': 'Document not found'}, status=404)
+    if not entry.collection.user_can_edit(request.user):
+        return JsonResponse({'error': 'You do not have permission to edit this document'}, status=403)
+    job = IngestionJob.latest_for(entry.id)
+    if job is None and entry.ingestion_state == 'failed':
+        # failed before ingestion jobs were recorded
+        job = IngestionJob.objects.create(document=entry, state='failed')
+    if job is None or job.state != 'failed':
+        return JsonResponse({'error': 'Only failed ingestions can be retried'}, status=400)
+    try:
+        job.retry()
+    except ValidationError as e:
+        # retried by another request in the meantime
+        return JsonResponse({'error': 'Only failed ingestions can be retried'}, status=400)
+    except DatabaseError as e:
+        logger.error(f"Error retrying ingestion of document {doc_id}: {e}")
+        return JsonResponse({'error': f'Failed to retry ingestion: {str(e)}'}, status=500)
+    return JsonResponse({'status_message': 'Ingestion queued', 'ingestion_job': ingestion_job_dict(job)})
+
+
 @login_required
 @require_http_methods(["DELETE"])
 def delete_document(request, doc_id):
@@ -275,9 +338,12 @@ def collections(request):
         name = data.get('name')
         if not name:
             return JsonResponse({'error': 'Name is required'}, status=400)
+        chunking_strategy = data.get('chunking_strategy', 'auto')
+        if chunking_strategy not in dict(CHUNKING_STRATEGIES):
+            return JsonResponse({'error': f'Unknown chunking strategy {chunking_strategy}'}, status=400)
 
         with transaction.atomic():
-            collection = Collection.objects.create(name=name)
+            collection = Collection.objects.create(name=name, chunking_strategy=chunking_strategy)
             CollectionPermission.objects.create(
                 collection=collection,
                 user=request.user,
@@ -309,21 +375,23 @@ def collections(request):
                 'name': collection.name,
                 'parent': collection.parent.id if collection.parent else None,
                 'path': collection.get_path(),
-                'document_count': len(collection.documents),
+                'chunking_strategy': collection.chunking_strategy,
+                'document_count': 0,
                 'children_count': collection.children.count(),
                 'permission': 'MANAGE'
             })
 
     # For GET requests, get all collections where the user has any permission
-    colperms = CollectionPermission.objects.filter(user=request.user)
+    colperms = list(CollectionPermission.objects.filter(user=request.user).select_related('collection'))
+    paths = Collection.get_paths(colperm.collection for colperm in colperms)
     collections = []
     for colperm in colperms:
         collections.append({
             'id': colperm.collection.id,
             'name': colperm.collection.name,
-            'parent': colperm.collection.parent.id if colperm.collection.parent else None,
-            'path': colperm.collection.get_path(),
-            'document_count': len(colperm.collection.documents),
+            'parent': colperm.collection.parent_id,
+            'path': paths[colperm.collection.id],
+            'document_count': colperm.collection.registered_documents.count(),
             'children_count': colperm.collection.children.count(),
             'permission': colperm.permission
         })
@@ -483,22 +551,19 @@ def collection(request, col_id):
             return JsonResponse({'error': 'Permission denied'}, status=403)
         
         # Get documents from all document types
-        documents = []
-        for model in DESCENDED_FROM_DOCUMENT:
-            docs = model.objects.filter(collection=collection)
-            for doc in docs:
-                documents.append({
-                    'id': str(doc.id),
-                    'title': getattr(doc, 'title', None) or getattr(doc, 'name', 'Untitled'),
-                    'type': doc.__class__.__name__,
-                    'ingestion_date': doc.ingestion_date.isoformat() if hasattr(doc, 'ingestion_date') and doc.ingestion_date else None,
-                })
+        documents = [{
+            'id': str(entry.id),
+            'title': entry.title or 'Untitled',
+            'type': entry.document_class.__name__,
+            'ingestion_date': entry.ingestion_date.isoformat() if entry.ingestion_date else None,
+            **entry.size_metadata,
+        } for entry in collection.registered_documents.order_by('-ingestion_date', 'title')]
 
         # Get child collections
         children = [{
             'id': child.id,
             'name': child.name,
-            'document_count': len([doc for doc in child.documents]) if hasattr(child, 'documents') else 0,
+            'document_count': child.registered_documents.count(),
             'created_at': child.created_at.isoformat() if hasattr(child, 'created_at') and child.created_at else None,
         } for child in collection.children.all()]
 
@@ -510,6 +575,9 @@ def collection(request, col_id):
                 'parent': collection.parent.id if collection.parent else None,
                 'created_at': collection.created_at.isoformat() if hasattr(collection, 'created_at') and collection.created_at else None,
                 'updated_at': collection.updated_at.isoformat() if hasattr(collection, 'updated_at') and collection.updated_at else None,
+                'char_count': sum(doc['char_count'] for doc in documents),
+                'token_count': sum(doc['token_count'] for doc in documents),
+                'chunking_strategy': collection.chunking_strategy,
             },
             'documents': documents,
             'children': children,
@@ -521,15 +589,29 @@ def collection(request, col_id):
         logger.error(f"Error processing collection data: {str(e)}")
         return JsonResponse({'error': str(e)}, status=500)
 
+@require_http_methods(["POST"])
+@login_required
+def collection_chunking_strategy(request, col_id):
+    # applies to documents ingested from now on; documents already chunked keep their chunks
+    collection = get_object_or_404(Collection, pk=col_id)
+    if not collection.user_can_manage(request.user):
+        return JsonResponse({'error': 'You do not have permission to change this collection'}, status=403)
+    chunking_strategy = json.loads(request.body).get('chunking_strategy')
+    if chunking_strategy not in dict(CHUNKING_STRATEGIES):
+        return JsonResponse({'error': f'Unknown chunking strategy {chunking_strategy}'}, status=400)
+    collection.chunking_strategy = chunking_strategy
+    collection.save(update_fields=['chunking_strategy', 'updated_at'])
+    return JsonResponse({'id': collection.id, 'chunking_strategy': collection.chunking_strategy})
+
 @login_required
 @require_http_methods(['GET'])
 def ingestion_monitor(request):
-    in_progress = PDFDocument.objects.filter(ingestion_complete=False, ingested_by=request.user)
+    in_progress = DocumentRegistry.objects.filter(ingestion_complete=False, ingested_by=request.user)
     protocol = 'wss://' if request.is_secure() else 'ws://'
     host = request.get_host()
     return JsonResponse([{"documentName": doc.title,
-                          "documentId": doc.id,
-                          "websocketUrl": protocol + host + "/ingest/monitor/" + doc.id + "/"}
+                          "documentId": str(doc.id),
+                          "websocketUrl": protocol + host + "/ingest/monitor/" + str(doc.id) + "/"}
                           for doc in in_progress])
 
 @login_required
@@ -657,9 +739,12 @@ urlpatterns = [
     path("collections/permissions/<int:col_id>/", collection_permissions, name="api_collection_permissions"),
     path("collections/move/<int:collection_id>/", move_collection, name="api_move_collection"),
     path("collections/delete/<int:collection_id>/", delete_collection, name="api_delete_collection"),
+    path("collections/chunking/<int:col_id>/", collection_chunking_strategy, name="api_collection_chunking_strategy"),
     path("ingest_arxiv/", ingest_arxiv, name="api_ingest_arxiv"),
     path("ingest_pdf/", ingest_pdf, name="api_ingest_pdf"),
     path("ingestion/monitor/", ingestion_monitor, name="api_ingestion_monitor"),
+    path("ingestion/retry/<uuid:doc_id>/", retry_ingestion, name="api_retry_ingestion"),
+    path("documents/<uuid:doc_id>/", document, name="api_document"),
     path("documents/move/<uuid:doc_id>/", move_document, name="api_move_document"),
     path("documents/delete/<uuid:doc_id>/", delete_document, name="api_delete_document"),
     path("users/search/", search_users, name="api_search_users"),
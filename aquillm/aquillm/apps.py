@@ -5,11 +5,11 @@ import cohere
 import openai
 import anthropic
 import google.generativeai as genai
-from os import getenv
+from os import getenv, cpu_count
 from typing import TypedDict
 
 
-from .llm import LLMInterface, ClaudeInterface, OpenAIInterface
+from .llm import LLMInterface, ClaudeInterface, OpenAIInterface, ContextBudgeter
 from .settings import DEBUG
 RAG_PROMPT_STRING = """
 <context>
@@ -60,7 +60,11 @@ class AquillmConfig(AppConfig):
     
     
     vector_top_k = 30
+    fulltext_top_k = 30
     trigram_top_k = 30
+    rrf_k = 60 # reciprocal rank fusion constant: score = sum of 1 / (rrf_k + rank) over the candidate lists
+    rerank_enabled = True
+    rerank_timeout = 3.0 # seconds to wait for the reranker before falling back to the fused ranking
     rag_prompt_template = Engine().from_string(RAG_PROMPT_STRING)
 
 
@@ -71,6 +75,35 @@ class AquillmConfig(AppConfig):
 #   <---------chunk_size-------->
 #                       <------->  chunk_overlap
 #                       |-----------CHUNK-----------|
+    # for the 'tokens' chunking strategy, which measures chunks in tokens instead of characters
+    chunk_tokens = 512
+    chunk_overlap_tokens = 128
+
+    # PDFs are extracted in the ingestion task, this many pages per process pool job. Each of the ingest
+    # worker's threads (run.sh, --concurrency=INGEST_CONCURRENCY) starts its own pool, so they share the CPUs.
+    ingest_concurrency = int(getenv('INGEST_CONCURRENCY', 4))
+    pdf_extraction_workers = max(1, (cpu_count() or 1) // ingest_concurrency)
+    pdf_pages_per_range = 20
+    # a running ingestion job that has stored no batch for this long is assumed dead and may be taken over
+    ingestion_stale_seconds = 30 * 60
+
+    # Cohere accepts at most 96 texts per embed call.
+    embedding_batch_size = 96
+    embedding_batch_tokens = 100000
+    # least recently used cached embeddings are evicted past this many rows (~4KB each)
+    embedding_cache_max_entries = 2000000
+    query_embedding_cache_size = 1024
+    query_embedding_cache_ttl = 3600 # seconds
+
+    # new conversations are titled in the background, several per LLM call
+    title_debounce_seconds = 10
+    title_batch_size = 20
+
+    # estimated tokens per LLM request, including tool definitions and the response. Older tool results are
+    # elided and then older turns summarized to stay under it; the last context_keep_recent_turns are always kept whole.
+    context_budget = 120000
+    context_keep_recent_turns = 2
+
     def ready(self):
 
         self.cohere_client = cohere.Client(getenv('COHERE_KEY'))
@@ -85,4 +118,5 @@ class AquillmConfig(AppConfig):
             self.llm_interface = OpenAIInterface(self.openai_client, "gpt-4o")
         else:
             raise ValueError(f"Invalid LLM choice: {llm_choice}")
+        self.llm_interface.context_budgeter = ContextBudgeter(self.context_budget, keep_recent_turns=self.context_keep_recent_turns)
 
@@ -0,0 +1,294 @@
+import re
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, Optional
+
+
+def window_chunks(pieces: Iterable[str], chunk_size: int, overlap: int, first: int = 0) -> Iterator[tuple[int, int, str]]:
+    """
+    Splits text into fixed windows of chunk_size characters, each starting chunk_size - overlap after the last,
+    yielding (start, end, content) for each. The text arrives as consecutive pieces, and a window is yielded
+    as soon as all of its text has arrived, so only about one window's worth of text is held at a time.
+    To resume part way through, pass the text from the start of window number `first` on; positions
+    are still relative to the start of the whole text.
+    """
+    pitch = chunk_size - overlap
+    if pitch < 1:
+        raise ValueError("Chunk overlap must be smaller than the chunk size")
+    buffer = '' # the text from offset on
+    offset = pitch * first
+    total = offset
+    i = first
+    for piece in pieces:
+        buffer += piece
+        total += len(piece)
+        while pitch * i + chunk_size <= total:
+            start = pitch * i
+            yield start, start + chunk_size, buffer[start - offset:start - offset + chunk_size]
+            i += 1
+        # no window from here on needs text before its start
+        buffer = buffer[pitch * i - offset:]
+        offset = pitch * i
+    # the last windows are cut short by the end of the text
+    while total and pitch * i <= total - 1:
+        start = pitch * i
+        end = min(start + chunk_size, total)
+        yield start, end, buffer[start - offset:end - offset]
+        i += 1
+
+
+@dataclass
+class Chunk:
+    start: int # offsets into the whole text, end exclusive
+    end: int
+    content: str
+    start_time: Optional[float] = None # seconds into the recording, for transcripts
+
+
+# Separators are regexes, tried in order; text is cut at the end of each match, so a zero-width
+# lookahead cuts before what it matches (e.g. a LaTeX heading) and anything else stays with the text before it.
+PARAGRAPH = r'\n[ \t]*\n\s*'
+LINE = r'\n'
+SENTENCE = r'(?<=[.!?])["\')\]]*\s+'
+WORD = r'\s+'
+LATEX_SECTION = r'(?=^[ \t]*\\(?:part|chapter|section|subsection|subsubsection|paragraph)\*?[\[{])'
+CAPTION = r'\n\n(?=\d{2}:\d{2}:\d{2} )' # the blank line between captions in a VTTDocument's text (see vtt.to_text)
+
+
+def cut_at(text: str, start: int, end: int, separator: str) -> list[tuple[int, int]]:
+    """Cuts text[start:end] into consecutive spans at every match of separator."""
+    cuts = sorted({start + match.end() for match in re.finditer(separator, text[start:end], re.MULTILINE)
+                   if 0 < match.end() < end - start})
+    return list(zip([start] + cuts, cuts + [end]))
+
+
+def split_spans(text: str, start: int, end: int, separators: list[str], max_len: int,
+                length: Callable[[str], int]) -> list[tuple[int, int]]:
+    """
+    Cuts text[start:end] into consecutive spans of at most max_len, at the first separator that occurs in it,
+    and recursively at later separators within spans that are still too long. Text with none of the separators
+    is cut every max_len characters.
+    """
+    if length(text[start:end]) <= max_len:
+        return [(start, end)]
+    for i, separator in enumerate(separators):
+        pieces = cut_at(text, start, end, separator)
+        if len(pieces) == 1:
+            continue
+        return [span for a, b in pieces for span in split_spans(text, a, b, separators[i + 1:], max_len, length)]
+    return [(a, min(a + max_len, end)) for a in range(start, end, max_len)]
+
+
+def pack_spans(text: str, spans: list[tuple[int, int]], max_len: int, overlap: int,
+               length: Callable[[str], int]) -> list[tuple[int, int, int]]:
+    """
+    Joins consecutive spans into chunks of at most max_len, so that chunks end where spans do. Each chunk
+    starts with the last spans of the one before that fit within overlap. Returns (start, end, index of the
+    chunk's first span) for each chunk.
+    """
+    chunks = []
+    window: list[tuple[int, int]] = [] # (index, length) of the spans in the chunk being built
+    size = 0
+    for i, (a, b) in enumerate(spans):
+        n = length(text[a:b])
+        if window and size + n > max_len:
+            chunks.append((spans[window[0][0]][0], spans[window[-1][0]][1], window[0][0]))
+            # the trailing spans that fit within the overlap carry over into the next chunk
+            while window and (size > overlap or size + n > max_len):
+                size -= window.pop(0)[1]
+        window.append((i, n))
+        size += n
+    if window:
+        chunks.append((spans[window[0][0]][0], spans[window[-1][0]][1], window[0][0]))
+    return chunks
+
+
+class Chunker:
+    """
+    A chunking strategy. Subclasses are registered by name with @register and picked per collection
+    (Collection.chunking_strategy); 'auto' leaves the choice to the document type.
+    """
+    name: str = ''
+    description: str = ''
+
+    def __init__(self, chunk_size: int, overlap: int):
+        if overlap >= chunk_size:
+            raise ValueError("Chunk overlap must be smaller than the chunk size")
+        self.chunk_size = chunk_size
+        self.overlap = overlap
+
+    @classmethod
+    def from_config(cls, config, count_tokens: Callable[[str], int]) -> 'Chunker':
+        return cls(config.chunk_size, config.chunk_overlap)
+
+    def resume_point(self, next_chunk: int) -> tuple[int, int]:
+        """
+        Where to restart chunking so as to reach chunk number next_chunk: (chunk number, offset into the text).
+        By default chunk boundaries depend on the text before them, so chunking restarts from the beginning.
+        """
+        return 0, 0
+
+    def expected_chunks(self, n_chars: int) -> Optional[int]:
+        """How many chunks a text of n_chars characters makes, if that is known before chunking it."""
+        return None
+
+    def chunks(self, pieces: Iterable[str], first: int = 0) -> Iterator[Chunk]:
+        raise NotImplementedError
+
+
+CHUNKERS: dict[str, type[Chunker]] = {}
+
+def register(cls: type[Chunker]) -> type[Chunker]:
+    CHUNKERS[cls.name] = cls
+    return cls
+
+def get_chunker(name: str, config, count_tokens: Callable[[str], int]) -> Chunker:
+    if name not in CHUNKERS:
+        raise ValueError(f"Unknown chunking strategy {name}")
+    return CHUNKERS[name].from_config(config, count_tokens)
+
+
+@register
+class FixedChunker(Chunker):
+    name = 'fixed'
+    description = 'Fixed windows of chunk_size characters'
+
+    def resume_point(self, next_chunk: int) -> tuple[int, int]:
+        return next_chunk, (self.chunk_size - self.overlap) * next_chunk
+
+    def expected_chunks(self, n_chars: int) -> Optional[int]:
+        return (n_chars - 1) // (self.chunk_size - self.overlap) + 1 if n_chars else 0
+
+    def chunks(self, pieces: Iterable[str], first: int = 0) -> Iterator[Chunk]:
+        for start, end, content in window_chunks(pieces, self.chunk_size, self.overlap, first=first):
+            yield Chunk(start, end, content)
+
+
+class SpanChunker(Chunker):
+    """
+    Cuts the text into spans at separators, then packs consecutive spans into chunks of up to chunk_size,
+    measured by length(). The text is read in blocks of horizon characters; chunks ending more than
+    horizon / 2 before the end of what has been read are yielded, and the rest is cut again with the next
+    block, so memory stays bounded and the chunks depend only on the text, not on how it arrives.
+    """
+    separators: list[str] = []
+    horizon = 1000000
+
+    def length(self, text: str) -> int:
+        return len(text)
+
+    def spans(self, text: str) -> list[tuple[int, int]]:
+        return split_spans(text, 0, len(text), self.separators, self.chunk_size, self.length)
+
+    def split(self, text: str, offset: int) -> list[Chunk]:
+        """Chunks text, which starts offset characters into the document."""
+        spans = self.spans(text)
+        return [Chunk(offset + a, offset + b, text[a:b])
+                for a, b, _ in pack_spans(text, spans, self.chunk_size, self.overlap, self.length)]
+
+    def chunks(self, pieces: Iterable[str], first: int = 0) -> Iterator[Chunk]:
+        buffer = ''
+        offset = 0
+        for block in blocks(pieces, self.horizon):
+            buffer += block
+            settled = offset + len(buffer) - self.horizon // 2
+            cut = None
+            for chunk in self.split(buffer, offset):
+                if chunk.end > settled:
+                    cut = chunk.start
+                    break
+                if chunk.content.strip():
+                    yield chunk
+            if cut is not None:
+                buffer = buffer[cut - offset:]
+                offset = cut
+            else:
+                buffer, offset = '', offset + len(buffer)
+        for chunk in self.split(buffer, offset):
+            if chunk.content.strip():
+                yield chunk
+
+
+def blocks(pieces: Iterable[str], size: int) -> Iterator[str]:
+    """Regroups text arriving in pieces of any size into blocks of exactly size characters, and a shorter last one."""
+    buffer = ''
+    for piece in pieces:
+        buffer += piece
+        while len(buffer) >= size:
+            yield buffer[:size]
+            buffer = buffer[size:]
+    if buffer:
+        yield buffer
+
+
+@register
+class RecursiveChunker(SpanChunker):
+    name = 'recursive'
+    description = 'Up to chunk_size characters, cut at paragraphs, then lines, sentences and words'
+    separators = [PARAGRAPH, LINE, SENTENCE, WORD]
+
+
+@register
+class SentenceWindowChunker(SpanChunker):
+    name = 'sentence'
+    description = 'Windows of whole sentences up to chunk_size characters, overlapping by whole sentences'
+    separators = [WORD]
+
+    def spans(self, text: str) -> list[tuple[int, int]]:
+        # every sentence is its own span, so windows start and end between sentences; only a sentence
+        # longer than a whole chunk is cut, between words
+        return [span for a, b in cut_at(text, 0, len(text), SENTENCE + '|' + PARAGRAPH)
+                for span in split_spans(text, a, b, self.separators, self.chunk_size, self.length)]
+
+
+@register
+class LatexSectionChunker(SpanChunker):
+    name = 'latex'
+    description = 'Up to chunk_size characters, cut at LaTeX sectioning commands, then paragraphs, lines and sentences'
+    separators = [LATEX_SECTION, PARAGRAPH, LINE, SENTENCE, WORD]
+
+
+@register
+class CaptionChunker(SpanChunker):
+    name = 'captions'
+    description = 'Whole transcript captions up to chunk_size characters, with the start time of the first'
+    separators = [CAPTION, PARAGRAPH, SENTENCE, WORD]
+
+    @staticmethod
+    def caption_time(text: str) -> Optional[float]:
+        match = re.match(r'(\d{2}):(\d{2}):(\d{2}) ', text)
+        if not match:
+            return None
+        hours, minutes, seconds = map(int, match.groups())
+        return hours * 3600.0 + minutes * 60.0 + seconds
+
+    def split(self, text: str, offset: int) -> list[Chunk]:
+        spans = self.spans(text)
+        # spans cut out of a long caption take its start time
+        times = []
+        for a, b in spans:
+            time = self.caption_time(text[a:b])
+            times.append(time if time is not None else (times[-1] if times else None))
+        return [Chunk(offset + a, offset + b, text[a:b], start_time=times[i])
+                for a, b, i in pack_spans(text, spans, self.chunk_size, self.overlap, self.length)]
+
+
+@register
+class TokenBudgetChunker(SpanChunker):
+    name = 'tokens'
+    description = 'Up to chunk_tokens tokens, cut at paragraphs, then lines, sentences and words'
+    separators = [PARAGRAPH, LINE, SENTENCE, WORD]
+
+    def __init__(self, chunk_size: int, overlap: int, count_tokens: Callable[[str], int]):
+        super().__init__(chunk_size, overlap)
+        self.count_tokens = count_tokens
+
+    @classmethod
+    def from_config(cls, config, count_tokens: Callable[[str], int]) -> 'Chunker':
+        return cls(config.chunk_tokens, config.chunk_overlap_tokens, count_tokens)
+
+    def length(self, text: str) -> int:
+        return self.count_tokens(text)
+
+
+# the choices for Collection.chunking_strategy; 'auto' chunks each document with its type's default_chunking_strategy
+CHUNKING_STRATEGIES = [('auto', 'By document type')] + [(name, chunker.description) for name, chunker in CHUNKERS.items()]
@@ -94,16 +94,19 @@ Return the output as a JSON object with the following structure:
     return ret
 
 
-images = convert_from_path("/home/chandler/software1-3.pdf")
-
-ret: list[Chunk] = []
-for page in images:
-    print("doing page")
-    response = do_page_with_llm(page, ret[-1] if ret else None)
-    if response.expanded_chunk and ret:
-        ret[-1] = response.expanded_chunk
-    ret += response.new_chunks
-   
-with open("/home/chandler/chunked.json", "w") as f:
-    f.write(dumps([chunk.model_dump() for chunk in ret]))
-
+# Standalone experiment, not used by ingestion (see chunkers.py for the chunking strategies).
+# Usage: python chunking.py input.pdf output.json
+if __name__ == '__main__':
+    from sys import argv
+    images = convert_from_path(argv[1])
+
+    ret: list[Chunk] = []
+    for page in images:
+        print("doing page")
+        response = do_page_with_llm(page, ret[-1] if ret else None)
+        if response.expanded_chunk and ret:
+            ret[-1] = response.expanded_chunk
+        ret += response.new_chunks
+
+    with open(argv[2], "w") as f:
+        f.write(dumps([chunk.model_dump() for chunk in ret]))
@@ -0,0 +1,267 @@
+from typing import Any, Callable, Iterator, Optional, Protocol, Sequence
+from collections import OrderedDict
+import hashlib
+import logging
+import threading
+import time
+
+from tenacity import Retrying, wait_exponential, stop_after_attempt
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_MODEL = "embed-english-v3.0"
+INPUT_TYPES = ('search_document', 'search_query', 'classification', 'clustering')
+
+
+# Cohere doesn't ship a local tokenizer, and the batch budget only needs to be roughly right.
+# English prose averages a little under 4 characters per token.
+def estimate_embedding_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class EmbeddingCache(Protocol):
+    def get_many(self, model: str, input_type: str, texts: Sequence[str]) -> list[Optional[list[float]]]:
+        ...
+
+    def set_many(self, model: str, input_type: str, texts: Sequence[str], embeddings: Sequence[list[float]]) -> None:
+        ...
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class DatabaseEmbeddingCache:
+    """
+    Persistent embedding cache backed by the EmbeddingCacheEntry table, keyed by
+    (model, input_type, sha256 of the text). Hit and miss counts are kept per process;
+    each entry also records how many times it has been served.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def entries(self):
+        from django.apps import apps
+        return apps.get_model('aquillm', 'EmbeddingCacheEntry').objects
+
+    def get_many(self, model: str, input_type: str, texts: Sequence[str]) -> list[Optional[list[float]]]:
+        from django.db.models import F
+        from django.utils import timezone
+        hashes = [content_hash(text) for text in texts]
+        found = {h: embedding for h, embedding in
+                 self.entries.filter(model=model, input_type=input_type, content_hash__in=set(hashes))
+                             .values_list('content_hash', 'embedding')}
+        if found:
+            self.entries.filter(model=model, input_type=input_type, content_hash__in=found.keys()).update(
+                last_used=timezone.now(), hit_count=F('hit_count') + 1)
+        ret = [found.get(h) for h in hashes]
+        n_hits = sum(1 for embedding in ret if embedding is not None)
+        self.hits += n_hits
+        self.misses += len(ret) - n_hits
+        # pgvector hands back numpy arrays
+        return [embedding.tolist() if hasattr(embedding, 'tolist') else embedding for embedding in ret]
+
+    def set_many(self, model: str, input_type: str, texts: Sequence[str], embeddings: Sequence[list[float]]) -> None:
+        Entry = self.entries.model
+        self.entries.bulk_create([Entry(model=model,
+                                        input_type=input_type,
+                                        content_hash=content_hash(text),
+                                        embedding=embedding)
+                                  for text, embedding in zip(texts, embeddings)],
+                                 ignore_conflicts=True)
+
+    def evict(self, max_entries: int) -> int:
+        """Deletes the least recently used entries until at most max_entries remain. Returns the number deleted."""
+        excess = self.entries.count() - max_entries
+        if excess <= 0:
+            return 0
+        stale = list(self.entries.order_by('last_used').values_list('pk', flat=True)[:excess])
+        deleted, _ = self.entries.filter(pk__in=stale).delete()
+        logger.info(f"Evicted {deleted} embedding cache entries")
+        return deleted
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+class QueryEmbeddingCache:
+    """
+    Short-lived cache for query embeddings: an in-process LRU in front of a shared TTL cache.
+
+    Chat tool loops and paginated searches reissue the same queries over and over, so this sits in front
+    of the provider for input_type='search_query'. Keys ignore case and whitespace differences.
+    `shared` is anything with Django's cache get_many/set_many interface (Redis in production);
+    if it is unreachable the cache degrades to the local LRU instead of failing the search.
+    """
+    def __init__(self, max_local_entries: int = 1024, ttl: float = 3600, shared: Any = None):
+        self.max_local_entries = max_local_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._local: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model: str, input_type: str, text: str) -> str:
+        normalized = ' '.join(text.split()).casefold()
+        return f'query-embedding:{model}:{input_type}:{content_hash(normalized)}'
+
+    def _get_local(self, key: str) -> Optional[list[float]]:
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            expires, embedding = entry
+            if expires < time.monotonic():
+                del self._local[key]
+                return None
+            self._local.move_to_end(key)
+            return embedding
+
+    def _set_local(self, key: str, embedding: list[float]) -> None:
+        with self._lock:
+            self._local[key] = (time.monotonic() + self.ttl, embedding)
+            self._local.move_to_end(key)
+            while len(self._local) > self.max_local_entries:
+                self._local.popitem(last=False)
+
+    def get_many(self, model: str, input_type: str, texts: Sequence[str]) -> list[Optional[list[float]]]:
+        keys = [self.key(model, input_type, text) for text in texts]
+        ret = [self._get_local(key) for key in keys]
+        self.local_hits += sum(1 for embedding in ret if embedding is not None)
+        missing = [key for key, embedding in zip(keys, ret) if embedding is None]
+        if missing and self.shared is not None:
+            try:
+                found = self.shared.get_many(missing)
+            except Exception as e:
+                logger.warning(f"Shared query embedding cache unavailable: {e}")
+                found = {}
+            for i, key in enumerate(keys):
+                if ret[i] is None and key in found:
+                    ret[i] = found[key]
+                    self._set_local(key, found[key])
+                    self.shared_hits += 1
+        self.misses += sum(1 for embedding in ret if embedding is None)
+        return ret
+
+    def set_many(self, model: str, input_type: str, texts: Sequence[str], embeddings: Sequence[list[float]]) -> None:
+        entries = {self.key(model, input_type, text): list(embedding) for text, embedding in zip(texts, embeddings)}
+        for key, embedding in entries.items():
+            self._set_local(key, embedding)
+        if self.shared is not None:
+            try:
+                self.shared.set_many(entries, timeout=self.ttl)
+            except Exception as e:
+                logger.warning(f"Shared query embedding cache unavailable: {e}")
+
+    def stats(self) -> dict:
+        total = self.local_hits + self.shared_hits + self.misses
+        return {'local_hits': self.local_hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'hit_rate': (self.local_hits + self.shared_hits) / total if total else 0.0,
+                'local_size': len(self._local)}
+
+
+class EmbeddingBatcher:
+    """
+    Packs texts into provider-sized batches and embeds each batch with a single request.
+
+    A batch is closed when it reaches either max_batch_items texts or max_batch_tokens estimated tokens,
+    whichever comes first. Failed requests are retried per batch, so a transient error late in a large
+    document doesn't re-embed the batches that already succeeded. Vectors are returned in input order.
+
+    If a cache is given, texts it already holds are never sent to the provider, identical texts are only
+    embedded once, and each completed batch is written back to the cache before the next one starts.
+
+    The client only needs an `embed(texts=..., model=..., input_type=...)` method returning an object
+    with an `embeddings` list, so tests can pass a local fake instead of a cohere.Client.
+    """
+    def __init__(self,
+                 client: Any,
+                 input_type: str = 'search_document',
+                 model: str = EMBEDDING_MODEL,
+                 max_batch_items: int = 96,
+                 max_batch_tokens: int = 100000,
+                 max_attempts: int = 5,
+                 retry_multiplier: float = 1,
+                 cache: Optional[EmbeddingCache] = None):
+        if input_type not in INPUT_TYPES:
+            raise ValueError(f'bad input type to embedding call: {input_type}')
+        if max_batch_items < 1 or max_batch_tokens < 1:
+            raise ValueError("Embedding batch limits must be positive")
+        self.client = client
+        self.input_type = input_type
+        self.model = model
+        self.max_batch_items = max_batch_items
+        self.max_batch_tokens = max_batch_tokens
+        self.max_attempts = max_attempts
+        self.retry_multiplier = retry_multiplier
+        self.cache = cache
+
+    def batches(self, texts: Sequence[str]) -> Iterator[range]:
+        """Yields index ranges into texts, each of which fits within the batch budget."""
+        start = 0
+        tokens = 0
+        for i, text in enumerate(texts):
+            text_tokens = estimate_embedding_tokens(text)
+            if i > start and (i - start >= self.max_batch_items or tokens + text_tokens > self.max_batch_tokens):
+                yield range(start, i)
+                start = i
+                tokens = 0
+            tokens += text_tokens
+        if start < len(texts):
+            yield range(start, len(texts))
+
+    def embed_batch(self, texts: Sequence[str]) -> list[list[float]]:
+        for attempt in Retrying(wait=wait_exponential(multiplier=self.retry_multiplier, max=30),
+                                stop=stop_after_attempt(self.max_attempts),
+                                reraise=True):
+            with attempt:
+                response = self.client.embed(
+                    texts=list(texts),
+                    model=self.model,
+                    input_type=self.input_type
+                )
+                embeddings = list(response.embeddings)
+                if len(embeddings) != len(texts):
+                    raise ValueError(f"Embedding provider returned {len(embeddings)} vectors for {len(texts)} texts")
+                return embeddings
+        raise AssertionError("unreachable") # keeps type checker happy
+
+    def embed(self, texts: Sequence[str], callback: Optional[Callable[[int], None]] = None) -> list[list[float]]:
+        """
+        Embeds texts, returning one vector per text in the same order.
+        If provided, callback is called with the number of texts served from the cache, then with
+        the number of texts in each batch as it completes.
+        """
+        ret: list[Optional[list[float]]] = [None] * len(texts)
+        if self.cache:
+            ret = self.cache.get_many(self.model, self.input_type, texts)
+        pending: dict[str, list[int]] = {} # text -> indices still needing that text's embedding
+        for i, text in enumerate(texts):
+            if ret[i] is None:
+                pending.setdefault(text, []).append(i)
+        n_cached = len(texts) - sum(len(indices) for indices in pending.values())
+        if callback and n_cached:
+            callback(n_cached)
+
+        unique_texts = list(pending.keys())
+        for batch in self.batches(unique_texts):
+            batch_texts = [unique_texts[i] for i in batch]
+            embeddings = self.embed_batch(batch_texts)
+            if self.cache:
+                self.cache.set_many(self.model, self.input_type, batch_texts, embeddings)
+            for text, embedding in zip(batch_texts, embeddings):
+                for i in pending[text]:
+                    ret[i] = embedding
+            if callback:
+                callback(sum(len(pending[text]) for text in batch_texts))
+        return ret # type: ignore
@@ -1,8 +1,10 @@
-from typing import Callable, Any, get_type_hints, Protocol, Optional, Literal, override, List, Dict, TypeAliasType
-from pydantic import BaseModel, model_validator, validate_call, Field
+from typing import Callable, Any, get_type_hints, Protocol, Optional, Literal, override, List, Dict, TypeAliasType, AsyncIterator, Awaitable
+from pydantic import BaseModel, model_validator, validate_call, Field, PrivateAttr
 from types import NoneType, GenericAlias
 import inspect
-from functools import wraps, partial
+import asyncio
+from functools import wraps, partial, lru_cache
+import math
 from abc import ABC, abstractmethod
 from pprint import pformat
 from copy import copy
@@ -15,7 +17,8 @@ from django.apps import apps
 from asgiref.sync import sync_to_async
 
 from django.core import signing
-from json import loads
+from json import loads, dumps
+import logging
 
 from tiktoken import encoding_for_model
 
@@ -23,6 +26,18 @@ import uuid
 if DEBUG:
     from pprint import pp
 
+logger = logging.getLogger(__name__)
+
+gpt_enc = encoding_for_model('gpt-4o')
+
+# Token counts are computed in one reference encoding (gpt-4o's) and scaled per provider by LLMInterface.token_ratio,
+# so a document's count can be stored once at ingestion and reused whichever LLM is configured.
+def count_tokens(text: str) -> int:
+    return len(gpt_enc.encode(text, disallowed_special=()))
+
+# for the strings sent with every request: system prompts, tool definitions
+cached_count_tokens = lru_cache(maxsize=256)(count_tokens)
+
 # TypeAliasType necessary for Pydantic to not shit its pants
 __ToolResultDictInner = TypeAliasType('__ToolResultDictInner', str | int | bool | float | Dict[str, '__ToolResultDictInner' | List['__ToolResultDictInner']] )
 type ToolResultDict = Dict[Literal['exception', 'result'], __ToolResultDictInner]
@@ -30,7 +45,8 @@ type ToolResultDict = Dict[Literal['exception', 'result'], __ToolResultDictInner
 class LLMTool(BaseModel):
     llm_definition: dict
     for_whom: Literal['user', 'assistant']
-    _function: Callable[..., ToolResultDict]
+    timeout: float = 15 # seconds
+    _function: Callable[..., ToolResultDict | Awaitable[ToolResultDict]]
     
     def __init__(self, **data):
         super().__init__(**data)
@@ -43,16 +59,22 @@ class LLMTool(BaseModel):
     def name(self) -> str:
         return self.llm_definition['name']
 
+    @property
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self._function)
+
 
 @validate_call
-def llm_tool(for_whom: Literal['user', 'assistant'], description: Optional[str] = None, param_descs: dict[str, str] = {}, required: list[str] = []) -> Callable[..., LLMTool]:
+def llm_tool(for_whom: Literal['user', 'assistant'], description: Optional[str] = None, param_descs: dict[str, str] = {}, required: list[str] = [], timeout: float = 15) -> Callable[..., LLMTool]:
     """
     Decorator to convert a function into an LLM-compatible tool with runtime type checking.
+    The function can be sync or async. Sync tools run on LLMInterface's tool thread pool.
     
     Args:
         description: Description of what the tool does
         param_descs: Dictionary of parameter descriptions
         required: List of required parameter names
+        timeout: Seconds the tool may run before the call is abandoned and reported to the LLM as timed out
     """
     @validate_call
     def decorator(func: Callable[..., ToolResultDict]) -> LLMTool:
@@ -68,17 +90,30 @@ def llm_tool(for_whom: Literal['user', 'assistant'], description: Optional[str]
         func_param_descs = param_descs or {}
         func_required = required or []
         
-        @wraps(type_checked_func)
-        def wrapper(*args, **kwargs) -> ToolResultDict:
-            if DEBUG:
-                print(f"{func_name} called!")
-            try:
-                return type_checked_func(*args, **kwargs)
-            except Exception as e:
+        if inspect.iscoroutinefunction(func):
+            @wraps(type_checked_func)
+            async def wrapper(*args, **kwargs) -> ToolResultDict:
                 if DEBUG:
-                    raise e
-                else:
-                    return {"exception": str(e)}
+                    print(f"{func_name} called!")
+                try:
+                    return await type_checked_func(*args, **kwargs)
+                except Exception as e:
+                    if DEBUG:
+                        raise e
+                    else:
+                        return {"exception": str(e)}
+        else:
+            @wraps(type_checked_func)
+            def wrapper(*args, **kwargs) -> ToolResultDict:
+                if DEBUG:
+                    print(f"{func_name} called!")
+                try:
+                    return type_checked_func(*args, **kwargs)
+                except Exception as e:
+                    if DEBUG:
+                        raise e
+                    else:
+                        return {"exception": str(e)}
         
         def translate_type(t: type | GenericAlias) -> dict:
             allowed_primitives = {
@@ -117,7 +152,7 @@ def llm_tool(for_whom: Literal['user', 'assistant'], description: Optional[str]
             },
         }
         
-        return LLMTool(llm_definition=llm_definition, _function=wrapper, for_whom=for_whom)
+        return LLMTool(llm_definition=llm_definition, _function=wrapper, for_whom=for_whom, timeout=timeout)
     return decorator
 
 class ToolChoice(BaseModel):
@@ -140,6 +175,7 @@ class __LLMMessage(BaseModel, ABC):
     tool_choice: Optional[ToolChoice] = None
     rating: Literal[None, 1,2,3,4,5] = None
     message_uuid: uuid.UUID = Field(default_factory=uuid.uuid4)
+    _token_count: Optional[tuple[str, int]] = PrivateAttr(default=None) # (content it was counted for, count_tokens of the rendered message)
     
     @classmethod
     @model_validator(mode='after')
@@ -151,6 +187,12 @@ class __LLMMessage(BaseModel, ABC):
     def render(self, *args, **kwargs) -> dict:
         return self.model_dump(*args, **kwargs)
 
+    def base_token_count(self) -> int:
+        """count_tokens of the message as rendered for the LLM, memoised until the content changes."""
+        if self._token_count is None or self._token_count[0] is not self.content:
+            self._token_count = (self.content, count_tokens(self.render(include={'role', 'content'})['content']))
+        return self._token_count[1]
+
 
 
 class UserMessage(__LLMMessage):
@@ -160,9 +202,16 @@ class UserMessage(__LLMMessage):
 
 
 
+class ToolCall(BaseModel):
+    id: str
+    name: str
+    input: dict = {}
+
+
 class ToolMessage(__LLMMessage):
     role: Literal['tool'] = 'tool'
     tool_name: str
+    tool_call_id: Optional[str] = None # the ToolCall this is the result of
     arguments: Optional[dict] = None
     for_whom: Literal['assistant', 'user']
     result_dict: ToolResultDict = {}
@@ -180,17 +229,21 @@ class AssistantMessage(__LLMMessage):
     role: Literal['assistant'] = 'assistant'
     model: Optional[str] = None
     stop_reason: str
-    tool_call_id: Optional[str] = None
-    tool_call_name: Optional[str] = None
-    tool_call_input: Optional[dict] = None
+    tool_calls: list[ToolCall] = [] # every tool the assistant called in this turn; each gets its own ToolMessage
     usage: int = 0
+    cache_read_usage: int = 0 # input tokens served from the provider's prompt cache, included in usage
+    cache_write_usage: int = 0 # input tokens written to the provider's prompt cache, included in usage
 
+    # messages stored before multiple tool calls were supported have a single tool_call_id/name/input
+    @model_validator(mode='before')
     @classmethod
-    @model_validator(mode='after')
-    def validate_tool_call(cls, data: Any) -> Any:
-        if (any([data.tool_call_id, data.tool_call_name]) and
-        not all([data.tool_call_id, data.tool_call_name])):
-            raise ValueError("If a tool call is made, both tool_call_id and tool_call_name must have values")
+    def convert_single_tool_call(cls, data: Any) -> Any:
+        if isinstance(data, dict) and 'tool_call_id' in data:
+            data = dict(data)
+            call_id, name, input = data.pop('tool_call_id'), data.pop('tool_call_name', None), data.pop('tool_call_input', None)
+            if call_id and name and not data.get('tool_calls'):
+                data['tool_calls'] = [{'id': call_id, 'name': name, 'input': input or {}}]
+        return data
 
 
     # @override
@@ -207,6 +260,9 @@ LLM_Message = UserMessage|ToolMessage|AssistantMessage
 class Conversation(BaseModel):
     system: str
     messages: list[LLM_Message] = []
+    # rolling summary of messages[:summarized_through], which are no longer sent to the LLM. See ContextBudgeter.
+    summary: Optional[str] = None
+    summarized_through: int = 0
 
     def __len__(self):
         return len(self.messages)
@@ -219,11 +275,17 @@ class Conversation(BaseModel):
     
     def __add__(self, other) -> 'Conversation':
         if isinstance(other, (list, Conversation)):
-            return (Conversation(system=self.system, messages=self.messages + list(other)))
+            return self.model_copy(update={'messages': self.messages + list(other)})
         if isinstance(other, (UserMessage, AssistantMessage, ToolMessage)):
-            return (Conversation(system=self.system, messages=self.messages + [other]))
+            return self.model_copy(update={'messages': self.messages + [other]})
         return NotImplemented
 
+    @property
+    def system_with_summary(self) -> str:
+        if not self.summary:
+            return self.system
+        return f'{self.system}\n\nSummary of the earlier part of this conversation, which is no longer shown in full:\n{self.summary}'
+
 
     def rebind_tools(self, tools: list[LLMTool]) -> None:
         def deprecated_func(*args, **kwargs):
@@ -252,20 +314,145 @@ class Conversation(BaseModel):
         for a, b in zip(data.messages, data.messages[1:]):
             if isinstance(a, AssistantMessage) and isinstance(b, AssistantMessage):
                 raise ValueError("Conversation has adjacent assistant messages")
-            if isUser(a) and isUser(b):
+            # several tool results in a row come from one assistant turn that made several calls
+            if isUser(a) and isUser(b) and not (isinstance(a, ToolMessage) and isinstance(b, ToolMessage)):
                 raise ValueError("Conversation has adjacent user messages")
         return data
 
 class LLMResponse(BaseModel):
     text: Optional[str]
-    tool_call: Optional[dict]
+    tool_calls: list[ToolCall] = []
     stop_reason: str
-    input_usage: int
+    input_usage: int # includes cache reads and writes
     output_usage: int
+    cache_read_usage: int = 0
+    cache_write_usage: int = 0
     model: Optional[str] = None
 
+class LLMStreamEvent(BaseModel):
+    """
+    One increment of a streamed completion. 'text' events carry the next piece of the response text,
+    'tool_call' events announce the name of a tool the model has started calling, and the stream
+    ends with a single 'done' event carrying the complete response.
+    """
+    type: Literal['text', 'tool_call', 'done']
+    text: Optional[str] = None
+    tool_name: Optional[str] = None
+    response: Optional[LLMResponse] = None
+
+type StreamFunc = Callable[[LLMStreamEvent], Awaitable[Any]]
+
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a user and an assistant in a retrieval augmented generation system.
+You will be given the previous summary, if there is one, followed by the next part of the conversation.
+Write an updated summary covering both. Keep what the user asked for, what was found (with document titles),
+conclusions reached and anything left unresolved. Leave out raw search results and document text.
+Respond with only the summary.
+"""
+
+
+class ContextBudgeter:
+    """
+    Keeps each request to the LLM under a token budget without touching the stored conversation.
+
+    The most recent keep_recent_turns turns (a turn starts at each user message) are always sent in full.
+    If a request would exceed the budget, tool results older than that are elided, oldest first, leaving a
+    note with the tool's name and arguments so the assistant can call it again if it needs them.
+    If that still isn't enough, the oldest turns are folded into a rolling summary that is sent as part of
+    the system prompt. Folding goes down to summary_target of the budget, so the summary is only rewritten
+    every so often rather than on every request. The summary is kept on the Conversation, and saved with it.
+    """
+    def __init__(self,
+                 budget: int,
+                 keep_recent_turns: int = 2,
+                 summary_target: float = 0.6,
+                 summary_max_tokens: int = 1024,
+                 min_elided_tokens: int = 200,
+                 summary_message_chars: int = 8000):
+        if keep_recent_turns < 1:
+            raise ValueError("At least the current turn must be kept")
+        self.budget = budget
+        self.keep_recent_turns = keep_recent_turns
+        self.summary_target = summary_target
+        self.summary_max_tokens = summary_max_tokens
+        self.min_elided_tokens = min_elided_tokens
+        self.summary_message_chars = summary_message_chars
+
+    @staticmethod
+    def elided(message: ToolMessage) -> str:
+        return (f'The result of an earlier call to tool {message.tool_name} with arguments {message.arguments} '
+                'was removed to save space. Call the tool again if you need it.')
+
+    async def summarize(self, llm: 'LLMInterface', previous: Optional[str], messages: list[LLM_Message]) -> str:
+        transcript = '\n\n'.join(f'{message.role.upper()}: {message.render(include={"role", "content"})["content"][:self.summary_message_chars]}'
+                                  for message in messages)
+        if previous:
+            transcript = f'PREVIOUS SUMMARY:\n{previous}\n\nCONVERSATION CONTINUES:\n{transcript}'
+        response = await llm.get_message(**(llm.base_args | {'system': SUMMARY_PROMPT,
+                                                              'messages': [{'role': 'user', 'content': transcript}],
+                                                              'max_tokens': self.summary_max_tokens}))
+        return response.text or previous or ''
+
+    async def fit(self, llm: 'LLMInterface', conversation: Conversation, overhead_tokens: int = 0) -> tuple[Conversation, list[dict]]:
+        """
+        Returns the conversation (with an updated summary, if one was needed) and the message dicts to send.
+        overhead_tokens covers whatever else goes into the request, such as tool definitions.
+        """
+        if conversation.summarized_through > len(conversation):
+            conversation = conversation.model_copy(update={'summary': None, 'summarized_through': 0})
+        # tool results meant for the user aren't shown to the LLM at all
+        messages = [message for message in conversation.messages[conversation.summarized_through:]
+                    if not (isinstance(message, ToolMessage) and message.for_whom == 'user')]
+        dicts = [message.render(include={'role', 'content'}) for message in messages]
+        tokens = [llm.message_tokens(message) for message in messages]
+        total = overhead_tokens + llm.estimate_tokens(conversation.system_with_summary) + sum(tokens)
+        if total <= self.budget:
+            return conversation, dicts
+
+        turn_starts = [i for i, message in enumerate(messages) if isinstance(message, UserMessage)]
+        recent_start = turn_starts[-self.keep_recent_turns] if len(turn_starts) >= self.keep_recent_turns else 0
+        for i in range(recent_start):
+            if total <= self.budget:
+                return conversation, dicts
+            message = messages[i]
+            if isinstance(message, ToolMessage) and tokens[i] > self.min_elided_tokens:
+                dicts[i] = dicts[i] | {'content': self.elided(message)}
+                elided_tokens = llm.estimate_tokens(dicts[i]['content'])
+                total -= tokens[i] - elided_tokens
+                tokens[i] = elided_tokens
+        if total <= self.budget:
+            return conversation, dicts
+
+        # fold whole turns, so the first message sent is still a user message
+        target = self.budget * self.summary_target - self.summary_max_tokens
+        cut = recent_start
+        for start in turn_starts:
+            if start == 0:
+                continue
+            if start >= recent_start or total - sum(tokens[:start]) <= target:
+                cut = min(start, recent_start)
+                break
+        if cut == 0:
+            logger.warning(f"Conversation is over its context budget ({total} > {self.budget} tokens) with nothing left to fold")
+            return conversation, dicts
+        folded = messages[:cut]
+        summarized_through = conversation.messages.index(messages[cut])
+        try:
+            summary = await self.summarize(llm, conversation.summary, folded)
+        except Exception as e:
+            # send the request without the folded turns anyway; summarising is retried on the next request
+            logger.error(f"Could not summarize conversation: {str(e)}")
+            return conversation, dicts[cut:]
+        if DEBUG:
+            print(f"Folded {len(folded)} messages into the conversation summary")
+        return conversation.model_copy(update={'summary': summary, 'summarized_through': summarized_through}), dicts[cut:]
+
 class LLMInterface(ABC):
-    tool_executor = ThreadPoolExecutor(max_workers=10)
+    # Sync tools run here rather than on the event loop. A tool that times out is abandoned, but its thread can't
+    # be killed, so the pool is bounded to keep runaway tools from starving the process.
+    tool_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='llm-tool')
+    context_budgeter: Optional[ContextBudgeter] = None # if None, the whole conversation is sent every time
     base_args: dict = {}
     client: Any = None
     @abstractmethod
@@ -276,60 +463,120 @@ class LLMInterface(ABC):
     async def get_message(self, *args, **kwargs) -> LLMResponse:
         pass
 
-    @abstractmethod
-    async def token_count(self, conversation: Conversation, new_message: Optional[str] = None) -> int:
-        pass
+    # Interfaces that can stream override this. The fallback waits for the whole response and emits it as one delta.
+    async def stream_message(self, *args, **kwargs) -> AsyncIterator[LLMStreamEvent]:
+        response = await self.get_message(*args, **kwargs)
+        if response.text:
+            yield LLMStreamEvent(type='text', text=response.text)
+        yield LLMStreamEvent(type='done', response=response)
+
+    # provider tokens per count_tokens token. Overestimating is safer than underestimating.
+    token_ratio: float = 1.0
+
+    def estimate_tokens(self, text: str) -> int:
+        return math.ceil(cached_count_tokens(text) * self.token_ratio)
+
+    def message_tokens(self, message: LLM_Message) -> int:
+        return math.ceil(message.base_token_count() * self.token_ratio)
+
+    def document_tokens(self, base_token_count: int) -> int:
+        """Scales a document's stored token count (see Document.token_count) to this provider."""
+        return math.ceil(base_token_count * self.token_ratio)
+
+    def token_count(self, conversation: Conversation, new_message: Optional[str] = None) -> int:
+        """Estimates the input tokens of the conversation as it would be sent, plus new_message, without calling the provider."""
+        messages_for_bot = [message for message in conversation[conversation.summarized_through:]
+                            if not(isinstance(message, ToolMessage) and message.for_whom == 'user')]
+        return (self.estimate_tokens(conversation.system_with_summary) +
+                sum(self.message_tokens(message) for message in messages_for_bot) +
+                (self.estimate_tokens(new_message) if new_message else 0))
+
+    async def run_tool(self, tool: LLMTool, input: Optional[dict]) -> ToolResultDict:
+        """Runs one tool call within the tool's timeout without blocking the event loop."""
+        call = partial(tool, **input) if input else tool # None can't be unpacked
+        try:
+            if tool.is_async:
+                return await asyncio.wait_for(call(), timeout=tool.timeout)
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(loop.run_in_executor(self.tool_executor, call), timeout=tool.timeout)
+        except asyncio.TimeoutError:
+            return {'exception': f"Tool call timed out after {tool.timeout} seconds"}
 
     # This shouldn't raise exceptions in cases where it was called correctly, ie the LLM really did attempt to call a tool. 
     # The results are going back to the LLM, so they need to just be strings. Tools themselves can raise, because the llm_tool wrapper
     # converts exceptions to dicts and returns them. 
-    def call_tool(self, message: AssistantMessage) -> ToolMessage:
+    async def call_tools(self, message: AssistantMessage) -> list[ToolMessage]:
+        """Runs all of the message's tool calls concurrently, returning one ToolMessage per call, in order."""
         tools = message.tools
-        if tools:
-            name = message.tool_call_name
-            input = message.tool_call_input
-            tools_dict = {tool.llm_definition['name'] : tool for tool in tools}
-            if not name or name not in tools_dict.keys():
-                result = str({'exception': ValueError("Function name is not valid")})
+        if not tools:
+            raise ValueError("call_tools called on a message with no tools!")
+        tools_dict = {tool.llm_definition['name'] : tool for tool in tools}
+
+        async def call(tool_call: ToolCall) -> ToolMessage:
+            if tool_call.name not in tools_dict.keys():
+                result_dict: ToolResultDict = {'exception': f"Function name {tool_call.name} is not valid"}
+                for_whom = 'assistant'
             else:
-                tool = tools_dict[name]
-                if input:
-                    future = self.tool_executor.submit(partial(tool, **input))
-                else:
-                    future = self.tool_executor.submit(tool) # necessary because None can't be unpacked
-                try:
-                    result_dict = future.result(timeout=15)
-                    result = str(result_dict)
-                except TimeoutError:
-                    result = str({'exception': TimeoutError("Tool call timed out")})
-            return ToolMessage(tool_name=tool.name,
-                                content=result,
-                                arguments=input,
-                                result_dict=result_dict,
-                                for_whom=tool.for_whom,
-                                tools=message.tools,
-                                tool_choice=message.tool_choice)
-        else:
-            raise ValueError("call_tool called on a message with no tools!")
+                tool = tools_dict[tool_call.name]
+                result_dict = await self.run_tool(tool, tool_call.input)
+                for_whom = tool.for_whom
+            return ToolMessage(tool_name=tool_call.name,
+                               tool_call_id=tool_call.id,
+                               content=str(result_dict),
+                               arguments=tool_call.input,
+                               result_dict=result_dict,
+                               for_whom=for_whom,
+                               tools=message.tools,
+                               tool_choice=message.tool_choice)
+
+        return list(await asyncio.gather(*(call(tool_call) for tool_call in message.tool_calls)))
+
+    @staticmethod
+    def merge_adjacent(message_dicts: list[dict]) -> list[dict]:
+        # the results of several tool calls from one turn are separate ToolMessages, but go back to the LLM as one user turn
+        merged: list[dict] = []
+        for message in message_dicts:
+            if merged and merged[-1]['role'] == message['role']:
+                merged[-1] = merged[-1] | {'content': merged[-1]['content'] + '\n\n' + message['content']}
+            else:
+                merged.append(message)
+        return merged
         
 
     
+    async def get_streamed_message(self, stream_func: StreamFunc, *args, **kwargs) -> LLMResponse:
+        """Streams a completion, passing text and tool call events to stream_func, and returns the complete response."""
+        response = None
+        async for event in self.stream_message(*args, **kwargs):
+            if event.type == 'done':
+                response = event.response
+            else:
+                await stream_func(event)
+        if response is None:
+            raise ValueError("LLM stream ended without a response")
+        return response
+
+    @staticmethod
+    def awaiting_assistant(conversation: Conversation) -> bool:
+        """Whether the trailing tool results include any meant for the assistant, so it should respond to them."""
+        for message in reversed(conversation.messages):
+            if not isinstance(message, ToolMessage):
+                return False
+            if message.for_whom == 'assistant':
+                return True
+        return False
+
     @validate_call
-    async def complete(self, conversation: Conversation, max_tokens: int) -> tuple[Conversation, Literal['changed', 'unchanged']]:
+    async def complete(self, conversation: Conversation, max_tokens: int, stream_func: Optional[StreamFunc] = None) -> tuple[Conversation, Literal['changed', 'unchanged']]:
         if len(conversation) < 1:
             return conversation, 'unchanged'
-        system_prompt = conversation.system
-        # if you show the bot the tool messages intended to be rendered for the user, the conversation won't be alternating
-        # user, assistant, user, assistant, etc, which is a requirement.
-        messages_for_bot = [message for message in conversation if not(isinstance(message, ToolMessage) and message.for_whom == 'user')] 
         last_message = conversation[-1]
-        message_dicts = [message.render(include={'role', 'content'}) for message in messages_for_bot]
-        if isinstance(last_message, ToolMessage) and last_message.for_whom == 'user':
+        if isinstance(last_message, ToolMessage) and not self.awaiting_assistant(conversation):
             return conversation, 'unchanged' # nothing to do
         elif isinstance(last_message, AssistantMessage):
-            if last_message.tools and last_message.tool_call_id:
-                new_tool_msg = self.call_tool(last_message)
-                return conversation + [new_tool_msg], 'changed'
+            if last_message.tools and last_message.tool_calls:
+                new_tool_msgs = await self.call_tools(last_message)
+                return conversation + new_tool_msgs, 'changed'
             else:
                 return conversation, 'unchanged'
         else:
@@ -339,23 +586,36 @@ class LLMInterface(ABC):
                 tools = {'tools': [tool.llm_definition for tool in last_message.tools], 'tool_choice': last_message.tool_choice.dict(exclude_none=True)}
             else:
                 tools = {}
+            if self.context_budgeter:
+                conversation, message_dicts = await self.context_budgeter.fit(self, conversation,
+                                                                              overhead_tokens=self.estimate_tokens(dumps(tools)) + max_tokens)
+            else:
+                # if you show the bot the tool messages intended to be rendered for the user, the conversation won't be alternating
+                # user, assistant, user, assistant, etc, which is a requirement.
+                message_dicts = [message.render(include={'role', 'content'}) for message in conversation[conversation.summarized_through:]
+                                 if not(isinstance(message, ToolMessage) and message.for_whom == 'user')]
             sdk_args = {**(self.base_args | tools |
-                                                    {'system': system_prompt,
-                                                    'messages': message_dicts,
+                                                    {'system': conversation.system_with_summary,
+                                                    'messages': self.merge_adjacent(message_dicts),
                                                     'max_tokens': max_tokens})}
             if DEBUG:
                 print("LLM called with the following args:")
                 pp(sdk_args)
             
-            response = await self.get_message(**sdk_args)
+            if stream_func:
+                response = await self.get_streamed_message(stream_func, **sdk_args)
+            else:
+                response = await self.get_message(**sdk_args)
             new_msg = AssistantMessage(
                             content=response.text if response.text else "** Empty Message, tool call **",
                             stop_reason=response.stop_reason,
                             tools=last_message.tools,
                             tool_choice=last_message.tool_choice,
                             usage = response.input_usage + response.output_usage,
+                            cache_read_usage=response.cache_read_usage,
+                            cache_write_usage=response.cache_write_usage,
                             model=response.model,
-                            **response.tool_call)
+                            tool_calls=response.tool_calls)
             if DEBUG:
                 print("Response from LLM:")
                 pp(new_msg.model_dump)
@@ -364,15 +624,17 @@ class LLMInterface(ABC):
 
 
 
-    async def spin(self, convo: Conversation, max_func_calls: int, send_func: Callable[[Conversation], Any], max_tokens: int) -> None:
+    # send_func receives the conversation after each step. If stream_func is given, responses are streamed
+    # and it receives the text and tool call events as they arrive, before send_func gets the finished message.
+    async def spin(self, convo: Conversation, max_func_calls: int, send_func: Callable[[Conversation], Any], max_tokens: int, stream_func: Optional[StreamFunc] = None) -> None:
         calls = 0
         while calls < max_func_calls:
-            convo, changed = await self.complete(convo, max_tokens)
+            convo, changed = await self.complete(convo, max_tokens, stream_func)
             await send_func(convo)
             if changed == 'unchanged':
                 return
             last_message = convo[-1]    
-            if isinstance(last_message, AssistantMessage) and last_message.tool_call_id:
+            if isinstance(last_message, AssistantMessage) and last_message.tool_calls:
                 calls += 1
                 
 
@@ -381,49 +643,81 @@ class LLMInterface(ABC):
 class ClaudeInterface(LLMInterface):
     
     base_args: dict = {'model': 'claude-3-7-sonnet-latest'}
+    prompt_caching: bool = True
+    # Claude's tokenizer isn't available locally. It produces somewhat more tokens than gpt-4o's on English text,
+    # so counts are scaled up to stay on the safe side of the context limit.
+    token_ratio: float = 1.25
 
     @override
     def __init__(self, anthropic_client):
         self.client = anthropic_client
 
+    @staticmethod
+    def _with_cache_breakpoints(kwargs: dict) -> dict:
+        """
+        Marks cache breakpoints on the system prompt, the last tool definition and the last message.
+        Within a tool loop each request extends the previous one, so everything up to the previous
+        request's last message is read from the cache instead of being processed again.
+        Prefixes shorter than the model's minimum cacheable length are silently not cached.
+        """
+        cache_control = {'type': 'ephemeral'}
+        kwargs = dict(kwargs)
+        if isinstance(kwargs.get('system'), str) and kwargs['system']:
+            kwargs['system'] = [{'type': 'text', 'text': kwargs['system'], 'cache_control': cache_control}]
+        if kwargs.get('tools'):
+            kwargs['tools'] = kwargs['tools'][:-1] + [kwargs['tools'][-1] | {'cache_control': cache_control}]
+        if kwargs.get('messages'):
+            last = kwargs['messages'][-1]
+            if isinstance(last['content'], str):
+                content = [{'type': 'text', 'text': last['content']}]
+            else:
+                content = list(last['content'])
+            content[-1] = content[-1] | {'cache_control': cache_control}
+            kwargs['messages'] = kwargs['messages'][:-1] + [last | {'content': content}]
+        return kwargs
+
+    def _sdk_args(self, kwargs: dict) -> dict:
+        return self._with_cache_breakpoints(kwargs) if self.prompt_caching else kwargs
+
     @override
     async def get_message(self, *args, **kwargs) -> LLMResponse:
-        response = await self.client.messages.create(**kwargs)
+        response = await self.client.messages.create(**self._sdk_args(kwargs))
         if DEBUG:
             print("Claude SDK Response:")
             pp(response)
-        text_block = None
-        tool_block = None
-        content = response.content
-        for block in content:
-            if hasattr(block, 'input'):
-                tool_block = block
-            if hasattr(block, "text"):
-                text_block = block
-
-        tool_call = {
-            'tool_call_id' :tool_block.id,
-            'tool_call_name' :tool_block.name,
-            'tool_call_input' : tool_block.input,
-        } if tool_block else {}
+        return self._response_from_message(response)
+
+    @override
+    async def stream_message(self, *args, **kwargs) -> AsyncIterator[LLMStreamEvent]:
+        async with self.client.messages.stream(**self._sdk_args(kwargs)) as stream:
+            async for event in stream:
+                if event.type == 'text':
+                    yield LLMStreamEvent(type='text', text=event.text)
+                elif event.type == 'content_block_start' and event.content_block.type == 'tool_use':
+                    yield LLMStreamEvent(type='tool_call', tool_name=event.content_block.name)
+            response = await stream.get_final_message()
+        if DEBUG:
+            print("Claude SDK Response:")
+            pp(response)
+        yield LLMStreamEvent(type='done', response=self._response_from_message(response))
+
+    def _response_from_message(self, response) -> LLMResponse:
+        texts = [block.text for block in response.content if block.type == 'text']
+        tool_calls = [ToolCall(id=block.id, name=block.name, input=block.input)
+                      for block in response.content if block.type == 'tool_use']
         
-        return LLMResponse(text=text_block.text,
-                           tool_call=tool_call, 
+        # Anthropic reports cached input separately from input_tokens
+        cache_read = response.usage.cache_read_input_tokens or 0
+        cache_write = response.usage.cache_creation_input_tokens or 0
+        return LLMResponse(text='\n\n'.join(texts) if texts else None,
+                           tool_calls=tool_calls, 
                            stop_reason=response.stop_reason, 
-                           input_usage=response.usage.input_tokens, 
+                           input_usage=response.usage.input_tokens + cache_read + cache_write, 
                            output_usage=response.usage.output_tokens,
+                           cache_read_usage=cache_read,
+                           cache_write_usage=cache_write,
                            model=self.base_args['model'])
 
-    @override
-    async def token_count(self, conversation: Conversation, new_message: Optional[str] = None) -> int:
-        messages_for_bot = [message for message in conversation if not(isinstance(message, ToolMessage) and message.for_whom == 'user')]
-        new_user_message = UserMessage(content=new_message) if new_message else None
-        response = await self.client.messages.count_tokens(**(self.base_args | 
-                                                         {'system': conversation.system,
-                                                          'messages': [message.render(include={'role', 'content'}) for message in messages_for_bot + ([new_user_message] if new_user_message else [])]}))
-        return response.input_tokens
-
-gpt_enc = encoding_for_model('gpt-4o')
 
 class OpenAIInterface(LLMInterface):
 
@@ -449,34 +743,77 @@ class OpenAIInterface(LLMInterface):
                 },
             } for tool in tools])
 
+    async def _arguments(self, kwargs: dict) -> dict:
+        arguments = {"model": self.base_args['model'],
+                     "messages": [{"role": "developer", "content": kwargs.pop('system')}] + kwargs.pop('messages')}
+        # requests without tools, such as summaries, must leave the parameter out rather than send an empty list
+        tools = kwargs.pop('tools', None)
+        if tools:
+            arguments["tools"] = await self._transform_tools(tools)
+        return arguments
+
     @override
     async def get_message(self, *args, **kwargs) -> LLMResponse:
 
-        arguments = {"model": self.base_args['model'],
-                    "messages": [{"role": "developer", "content": kwargs.pop('system')}] + kwargs.pop('messages'),
-                     "tools": await self._transform_tools(kwargs.pop('tools')),}
+        arguments = await self._arguments(kwargs)
         
         response = await self.client.chat.completions.create(**arguments)
         if DEBUG:
             print("OpenAI SDK Response:")
             pp(response)
-        tool_call = response.choices[0].message.tool_calls[0] if response.choices[0].message.tool_calls else None
         return LLMResponse(text=response.choices[0].message.content,
-                           tool_call={"tool_call_id": tool_call.id,
-                                        "tool_call_name": tool_call.function.name,
-                                        "tool_call_input": loads(tool_call.function.arguments)} 
-                                        if tool_call else {},
+                           tool_calls=[ToolCall(id=tool_call.id,
+                                                name=tool_call.function.name,
+                                                input=loads(tool_call.function.arguments))
+                                       for tool_call in response.choices[0].message.tool_calls or []],
                            stop_reason=response.choices[0].finish_reason,
                            input_usage=response.usage.prompt_tokens,
-                           output_usage=response.usage.completion_tokens
+                           output_usage=response.usage.completion_tokens,
+                           cache_read_usage=self._cached_tokens(response.usage)
                            )
-                        
-    @override 
-    async def token_count(self, conversation: Conversation, new_message: Optional[str] = None) -> int:
-        assistant_messages = [message for message in conversation if isinstance(message, AssistantMessage)]
-        if assistant_messages:
-            return assistant_messages[-1].usage + (len(gpt_enc.encode(new_message)) if new_message else 0)
-        return len(gpt_enc.encode(new_message)) if new_message else 0
+
+    # OpenAI caches long prompt prefixes automatically; it only reports how much was read from the cache.
+    @staticmethod
+    def _cached_tokens(usage) -> int:
+        details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+        return (details.cached_tokens or 0) if details else 0
+
+    @override
+    async def stream_message(self, *args, **kwargs) -> AsyncIterator[LLMStreamEvent]:
+        arguments = await self._arguments(kwargs)
+        stream = await self.client.chat.completions.create(**arguments, stream=True, stream_options={"include_usage": True})
+        text = ""
+        tool_calls: dict[int, dict] = {} # tool call deltas arrive in pieces, keyed by index
+        finish_reason = None
+        usage = None
+        async for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            finish_reason = choice.finish_reason or finish_reason
+            if choice.delta.content:
+                text += choice.delta.content
+                yield LLMStreamEvent(type='text', text=choice.delta.content)
+            for delta in choice.delta.tool_calls or []:
+                call = tool_calls.setdefault(delta.index, {"id": None, "name": None, "arguments": ""})
+                if delta.id:
+                    call["id"] = delta.id
+                if delta.function and delta.function.name:
+                    call["name"] = delta.function.name
+                    yield LLMStreamEvent(type='tool_call', tool_name=delta.function.name)
+                if delta.function and delta.function.arguments:
+                    call["arguments"] += delta.function.arguments
+        yield LLMStreamEvent(type='done', response=LLMResponse(
+            text=text or None,
+            tool_calls=[ToolCall(id=call["id"], name=call["name"], input=loads(call["arguments"] or "{}"))
+                        for _, call in sorted(tool_calls.items())],
+            stop_reason=finish_reason or "stop",
+            input_usage=usage.prompt_tokens if usage else 0,
+            output_usage=usage.completion_tokens if usage else 0,
+            cache_read_usage=self._cached_tokens(usage)))
+
     
     
 class GeminiInterface(LLMInterface):
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.contrib.contenttypes.models import ContentType
+
+from aquillm.models import DocumentRegistry, DESCENDED_FROM_DOCUMENT
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the document registry from the document tables. Safe to run repeatedly."
+
+    def handle(self, *args, **options):
+        for model in DESCENDED_FROM_DOCUMENT:
+            docs = model.objects.defer('full_text')
+            DocumentRegistry.sync(docs)
+            stale = (DocumentRegistry.objects
+                     .filter(doc_type=ContentType.objects.get_for_model(model))
+                     .exclude(id__in=model.objects.values('id')))
+            removed, _ = stale.delete()
+            self.stdout.write(f"{model.__name__}: {docs.count()} registered, {removed} stale entries removed")
@@ -0,0 +1,73 @@
+import json
+import math
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+
+from aquillm.chunkers import CHUNKERS, get_chunker
+from aquillm.llm import count_tokens
+from aquillm.models import Collection, DocumentRegistry
+from aquillm.utils import get_embeddings
+
+
+def cosine(a: list[float], b: list[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def normalize(text: str) -> str:
+    return ' '.join(text.split()).lower()
+
+
+class Command(BaseCommand):
+    help = ("Chunks a collection's documents with each chunking strategy and reports chunk counts and the tokens "
+            "they would cost to embed. With --queries, also embeds the chunks and reports retrieval quality.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('collection', type=int, help="id of the collection to chunk")
+        parser.add_argument('--strategy', action='append', choices=list(CHUNKERS), dest='strategies',
+                            help="a strategy to benchmark; repeat for several (default: all)")
+        parser.add_argument('--max-documents', type=int, default=20)
+        parser.add_argument('--queries', help=('JSON file of [{"query": ..., "answer": ...}]. A query counts as answered '
+                                               'when one of its top k chunks contains the answer text. Embeds every chunk.'))
+        parser.add_argument('--top-k', type=int, default=5)
+
+    def handle(self, *args, **options):
+        collection = Collection.objects.filter(pk=options['collection']).first()
+        if collection is None:
+            raise CommandError(f"No collection with id {options['collection']}")
+        queries = []
+        if options['queries']:
+            with open(options['queries']) as f:
+                queries = json.load(f)
+        config = apps.get_app_config('aquillm')
+        entries = list(DocumentRegistry.objects.filter(collection=collection, ingestion_state='complete')
+                       .order_by('ingestion_date')[:options['max_documents']])
+        docs = [doc for doc in (entry.document_class.objects.defer('full_text').filter(id=entry.id).first() for entry in entries) if doc]
+        query_embeddings = get_embeddings([q['query'] for q in queries], input_type='search_query') if queries else []
+
+        self.stdout.write(f"{len(docs)} documents from {collection.name}")
+        for strategy in options['strategies'] or list(CHUNKERS):
+            chunker = get_chunker(strategy, config, count_tokens)
+            contents = []
+            for doc in docs:
+                contents += [chunk.content for chunk in chunker.chunks(piece for piece, _ in doc.iter_text())]
+            if not contents:
+                self.stdout.write(f"{strategy:>10}: no chunks")
+                continue
+            tokens = sum(count_tokens(content) for content in contents)
+            line = (f"{strategy:>10}: {len(contents)} chunks, {sum(len(c) for c in contents) / len(contents):.0f} chars "
+                    f"and {tokens / len(contents):.0f} tokens on average, {tokens} tokens to embed")
+            if queries:
+                embeddings = get_embeddings(contents, input_type='search_document')
+                hits, reciprocal_ranks = 0, 0.0
+                for query, query_embedding in zip(queries, query_embeddings):
+                    ranked = sorted(range(len(contents)), key=lambda i: -cosine(query_embedding, embeddings[i]))[:options['top_k']]
+                    answer = normalize(query['answer'])
+                    rank = next((r for r, i in enumerate(ranked, start=1) if answer in normalize(contents[i])), None)
+                    if rank:
+                        hits += 1
+                        reciprocal_ranks += 1 / rank
+                line += f", recall@{options['top_k']} {hits / len(queries):.2f}, MRR {reciprocal_ranks / len(queries):.2f}"
+            self.stdout.write(line)
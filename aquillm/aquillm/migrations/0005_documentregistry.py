@@ -0,0 +1,54 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+DOCUMENT_MODELS = ['PDFDocument', 'TeXDocument', 'RawTextDocument', 'VTTDocument', 'HandwrittenNotesDocument']
+
+
+def backfill_registry(apps, schema_editor):
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    DocumentRegistry = apps.get_model('aquillm', 'DocumentRegistry')
+    for model_name in DOCUMENT_MODELS:
+        model = apps.get_model('aquillm', model_name)
+        doc_type, _ = ContentType.objects.get_or_create(app_label='aquillm', model=model_name.lower())
+        docs = model.objects.only('id', 'collection_id', 'title', 'ingested_by_id', 'ingestion_date', 'ingestion_complete')
+        DocumentRegistry.objects.bulk_create([DocumentRegistry(id=doc.id,
+                                                               doc_type=doc_type,
+                                                               collection_id=doc.collection_id,
+                                                               title=doc.title,
+                                                               ingested_by_id=doc.ingested_by_id,
+                                                               ingestion_date=doc.ingestion_date,
+                                                               ingestion_complete=doc.ingestion_complete)
+                                              for doc in docs.iterator()],
+                                             batch_size=1000,
+                                             ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0004_embeddingcacheentry'),
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DocumentRegistry',
+            fields=[
+                ('id', models.UUIDField(editable=False, primary_key=True, serialize=False)),
+                ('title', models.CharField(max_length=200)),
+                ('ingestion_date', models.DateTimeField()),
+                ('ingestion_complete', models.BooleanField(default=True)),
+                ('collection', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='registered_documents', to='aquillm.collection')),
+                ('doc_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.contenttype')),
+                ('ingested_by', models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['collection', 'doc_type'], name='docregistry_collection_type'),
+                            models.Index(fields=['ingested_by', 'ingestion_complete'], name='docregistry_in_progress')],
+            },
+        ),
+        migrations.RunPython(backfill_registry, migrations.RunPython.noop),
+    ]
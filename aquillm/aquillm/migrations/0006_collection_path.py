@@ -0,0 +1,44 @@
+from django.db import migrations, models
+
+
+def backfill_paths(apps, schema_editor):
+    Collection = apps.get_model('aquillm', 'Collection')
+    parents = dict(Collection.objects.values_list('id', 'parent_id'))
+    paths = {}
+
+    def path_of(pk):
+        if pk not in paths:
+            parent = parents[pk]
+            paths[pk] = (path_of(parent) if parent else '') + f'{pk}/'
+        return paths[pk]
+
+    collections = list(Collection.objects.all())
+    for collection in collections:
+        collection.path = path_of(collection.id)
+        collection.depth = collection.path.count('/') - 1
+    Collection.objects.bulk_update(collections, ['path', 'depth'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0005_documentregistry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='path',
+            field=models.TextField(default='', editable=False),
+        ),
+        migrations.AddField(
+            model_name='collection',
+            name='depth',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(backfill_paths, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='collection',
+            index=models.Index(fields=['path'], name='collection_path_idx', opclasses=['text_pattern_ops']),
+        ),
+    ]
@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0006_collection_path'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textchunk',
+            name='collection',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='text_chunks', to='aquillm.collection'),
+        ),
+        migrations.RunSQL(
+            """
+            UPDATE aquillm_textchunk chunk
+            SET collection_id = registry.collection_id
+            FROM aquillm_documentregistry registry
+            WHERE registry.id = chunk.doc_id
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,26 @@
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0007_textchunk_collection'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='textchunk',
+            name='search_vector',
+            field=models.GeneratedField(db_persist=True, expression=django.contrib.postgres.search.SearchVector('content', config='english'), output_field=django.contrib.postgres.search.SearchVectorField()),
+        ),
+        migrations.AddIndex(
+            model_name='textchunk',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='chunk_search_vector_index'),
+        ),
+        migrations.AddIndex(
+            model_name='textchunk',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['content'], name='chunk_content_trigram_index', opclasses=['gin_trgm_ops']),
+        ),
+    ]
@@ -0,0 +1,69 @@
+import json
+import uuid
+
+import aquillm.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def split_conversations(apps, schema_editor):
+    WSConversation = apps.get_model('aquillm', 'WSConversation')
+    WSConversationMessage = apps.get_model('aquillm', 'WSConversationMessage')
+    for convo in WSConversation.objects.iterator():
+        data = convo.convo or {}
+        if isinstance(data, str):
+            data = json.loads(data)
+        if data.get('system'):
+            convo.system = data['system']
+            convo.save(update_fields=['system'])
+        WSConversationMessage.objects.bulk_create([
+            WSConversationMessage(conversation=convo,
+                                  seq=seq,
+                                  message_uuid=message.get('message_uuid') or uuid.uuid4(),
+                                  role=message['role'],
+                                  data=message)
+            for seq, message in enumerate(data.get('messages', []))])
+
+
+def join_conversations(apps, schema_editor):
+    WSConversation = apps.get_model('aquillm', 'WSConversation')
+    for convo in WSConversation.objects.iterator():
+        convo.convo = {'system': convo.system,
+                       'messages': list(convo.messages.order_by('seq').values_list('data', flat=True))}
+        convo.save(update_fields=['convo'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0008_textchunk_search_vector'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wsconversation',
+            name='system',
+            field=models.TextField(default=aquillm.models.default_system_prompt),
+        ),
+        migrations.CreateModel(
+            name='WSConversationMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('message_uuid', models.UUIDField()),
+                ('role', models.CharField(max_length=20)),
+                ('data', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='aquillm.wsconversation')),
+            ],
+            options={
+                'ordering': ['conversation', 'seq'],
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'seq'), name='unique_message_seq_per_conversation')],
+            },
+        ),
+        migrations.RunPython(split_conversations, join_conversations),
+        migrations.RemoveField(
+            model_name='wsconversation',
+            name='convo',
+        ),
+    ]
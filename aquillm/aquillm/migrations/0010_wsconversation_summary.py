@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0009_wsconversationmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wsconversation',
+            name='summary',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='wsconversation',
+            name='summarized_through',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
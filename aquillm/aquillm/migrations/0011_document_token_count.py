@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+from aquillm.llm import count_tokens
+
+DOCUMENT_MODELS = ['PDFDocument', 'TeXDocument', 'RawTextDocument', 'VTTDocument', 'HandwrittenNotesDocument']
+
+
+def count_document_tokens(apps, schema_editor):
+    DocumentRegistry = apps.get_model('aquillm', 'DocumentRegistry')
+    for model_name in DOCUMENT_MODELS:
+        model = apps.get_model('aquillm', model_name)
+        batch = []
+        for doc in model.objects.only('pkid', 'id', 'full_text').iterator(chunk_size=100):
+            doc.token_count = count_tokens(doc.full_text)
+            batch.append(doc)
+            if len(batch) >= 100:
+                model.objects.bulk_update(batch, ['token_count'])
+                batch = []
+        model.objects.bulk_update(batch, ['token_count'])
+        for doc_id, token_count in model.objects.values_list('id', 'token_count').iterator():
+            DocumentRegistry.objects.filter(id=doc_id).update(token_count=token_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0010_wsconversation_summary'),
+    ]
+
+    operations = [
+        *[migrations.AddField(
+            model_name=model_name.lower(),
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ) for model_name in DOCUMENT_MODELS],
+        migrations.AddField(
+            model_name='documentregistry',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_document_tokens, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,69 @@
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce, Length
+
+DOCUMENT_MODELS = ['PDFDocument', 'TeXDocument', 'RawTextDocument', 'VTTDocument', 'HandwrittenNotesDocument']
+
+
+# Page counts would mean opening every stored file, so existing documents get one when they are next chunked.
+def measure_documents(apps, schema_editor):
+    TextChunk = apps.get_model('aquillm', 'TextChunk')
+    DocumentRegistry = apps.get_model('aquillm', 'DocumentRegistry')
+    for model_name in DOCUMENT_MODELS:
+        model = apps.get_model('aquillm', model_name)
+        model.objects.update(
+            char_count=Length('full_text'),
+            chunk_count=Coalesce(Subquery(
+                TextChunk.objects.filter(doc_id=OuterRef('id'))
+                                 .order_by().values('doc_id')
+                                 .annotate(n=Count('*')).values('n')), 0))
+        schema_editor.execute(
+            f"UPDATE {DocumentRegistry._meta.db_table} r "
+            f"SET char_count = d.char_count, chunk_count = d.chunk_count, page_count = d.page_count "
+            f"FROM {model._meta.db_table} d WHERE r.id = d.id")
+        if model_name == 'HandwrittenNotesDocument':
+            model.objects.update(page_count=1)
+            DocumentRegistry.objects.filter(id__in=model.objects.values('id')).update(page_count=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0011_document_token_count'),
+    ]
+
+    operations = [
+        *[op for model_name in DOCUMENT_MODELS for op in [
+            migrations.AddField(
+                model_name=model_name.lower(),
+                name='char_count',
+                field=models.PositiveIntegerField(default=0),
+            ),
+            migrations.AddField(
+                model_name=model_name.lower(),
+                name='page_count',
+                field=models.PositiveIntegerField(blank=True, null=True),
+            ),
+            migrations.AddField(
+                model_name=model_name.lower(),
+                name='chunk_count',
+                field=models.PositiveIntegerField(default=0),
+            ),
+        ]],
+        migrations.AddField(
+            model_name='documentregistry',
+            name='char_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='documentregistry',
+            name='page_count',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='documentregistry',
+            name='chunk_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(measure_documents, migrations.RunPython.noop),
+    ]
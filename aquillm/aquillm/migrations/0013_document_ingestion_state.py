@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+DOCUMENT_MODELS = ['PDFDocument', 'TeXDocument', 'RawTextDocument', 'VTTDocument', 'HandwrittenNotesDocument']
+
+INGESTION_STATES = [('queued', 'Queued'), ('processing', 'Processing'), ('complete', 'Complete'), ('failed', 'Failed')]
+
+
+def mark_unfinished(apps, schema_editor):
+    for model_name in DOCUMENT_MODELS + ['DocumentRegistry']:
+        apps.get_model('aquillm', model_name).objects.filter(ingestion_complete=False).update(ingestion_state='processing')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0012_document_size_metadata'),
+    ]
+
+    operations = [
+        *[migrations.AddField(
+            model_name=model_name.lower(),
+            name='ingestion_state',
+            field=models.CharField(choices=INGESTION_STATES, default='complete', max_length=20),
+        ) for model_name in DOCUMENT_MODELS + ['DocumentRegistry']],
+        migrations.RunPython(mark_unfinished, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('aquillm', '0014_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='collection',
+            name='chunking_strategy',
+            field=models.CharField(choices=[('auto', 'By document type'), ('fixed', 'Fixed windows of chunk_size characters'), ('recursive', 'Up to chunk_size characters, cut at paragraphs, then lines, sentences and words'), ('sentence', 'Windows of whole sentences up to chunk_size characters, overlapping by whole sentences'), ('latex', 'Up to chunk_size characters, cut at LaTeX sectioning commands, then paragraphs, lines and sentences'), ('captions', 'Whole transcript captions up to chunk_size characters, with the start time of the first'), ('tokens', 'Up to chunk_tokens tokens, cut at paragraphs, then lines, sentences and words')], default='auto', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='ingestionjob',
+            name='chunking_strategy',
+            field=models.CharField(blank=True, default='', max_length=20),
+        ),
+    ]
@@ -1,15 +1,18 @@
-from typing import Optional, Callable, Awaitable
+from typing import Optional, Awaitable, Iterable, Iterator
 from django.db import models, transaction
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField
-from pgvector.django import VectorField, L2Distance, HnswIndex
+from pgvector.django import VectorField, HnswIndex
 from django.apps import apps
-from django.core.exceptions import ValidationError, ObjectDoesNotExist
-from django.db.models import Q
+from django.core.exceptions import ValidationError, ObjectDoesNotExist, EmptyResultSet
+from django.db.models import Q, F, Value, Count, Max
+from django.core.cache import cache
+from django.db.models.functions import Concat, Substr, Length, Coalesce, SHA256
+from django.db.models.expressions import RawSQL
 
-from tenacity import retry, wait_exponential
 import uuid
+from datetime import timedelta
 
 from django.contrib.auth.models import User
 from pypdf import PdfReader
@@ -23,29 +26,31 @@ from django.template import Context
 from django.core.serializers.json import DjangoJSONEncoder
 import json
 import logging
+import re
 from django.db.models.query import QuerySet
 from typing import  List, Type, Tuple
-import time
 
 from django.core.exceptions import ValidationError
-from django.contrib.postgres.search import TrigramSimilarity
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.contrib.postgres.indexes import GinIndex
 from django.core.validators import FileExtensionValidator
 import concurrent.futures
 
 from django.db import DatabaseError
-from django.db.models import Case, When
 from django.utils import timezone
-from .utils import get_embedding
+from .utils import get_embedding, get_embeddings, evict_embedding_cache, get_query_embedding_cache
 from .settings import BASE_DIR
 
-from .llm import Conversation as convo_model
+from .llm import Conversation as convo_model, count_tokens
+from .chunkers import CHUNKING_STRATEGIES, get_chunker
+from .pdf_extraction import extract_pages
 
 logger = logging.getLogger(__name__)
 
 from pydantic_core import to_jsonable_python
 
 from .celery import app
-from celery.states import state, RECEIVED, STARTED, SUCCESS, FAILURE
+from celery.states import FAILURE
 
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
@@ -96,25 +101,47 @@ from .ocr_utils import extract_text_from_image
 
 from django.core.files.storage import default_storage
 
+# Permissions are inherited down the collection tree: a permission on a collection applies to all of its descendants.
+# This walks the tree inside Postgres so that listing accessible collections is one query regardless of nesting depth.
+# Ids of every collection the user holds one of the given permissions on, directly or through an ancestor.
+ACCESSIBLE_COLLECTIONS_SQL = """
+WITH RECURSIVE accessible(id) AS (
+    SELECT collection_id FROM aquillm_collectionpermission
+    WHERE user_id = %s AND permission = ANY(%s)
+  UNION
+    SELECT child.id FROM aquillm_collection child
+    JOIN accessible ON child.parent_id = accessible.id
+)
+SELECT id FROM accessible
+"""
+
+
 class CollectionQuerySet(models.QuerySet):
-    def filter_by_user_perm(self, user, perm='VIEW') -> 'CollectionQuerySet':
-        perm_options = []
+    @staticmethod
+    def perm_options(perm: str) -> list[str]:
         if perm == 'VIEW':
-            perm_options = ['VIEW', 'EDIT', 'MANAGE']
+            return ['VIEW', 'EDIT', 'MANAGE']
         elif perm == 'EDIT':
-            perm_options = ['EDIT', 'MANAGE']
+            return ['EDIT', 'MANAGE']
         elif perm == 'MANAGE':
-            perm_options = ['MANAGE']
+            return ['MANAGE']
         else:
             raise ValueError(f"Invalid Permission type {perm}")
 
-        return self.filter(id__in=[col_perm.collection.pk for col_perm in CollectionPermission.objects.filter(user=user, permission__in=perm_options)])
+    def filter_by_user_perm(self, user, perm='VIEW') -> 'CollectionQuerySet':
+        return self.filter(id__in=RawSQL(ACCESSIBLE_COLLECTIONS_SQL, [user.pk, self.perm_options(perm)]))
 
 
 class Collection(models.Model):
     name = models.CharField(max_length=100)
     users = models.ManyToManyField(User, through='CollectionPermission')
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='children')
+    # Materialised path of ids from the root down to and including this collection, e.g. "1/5/12/".
+    # Maintained by save(), so a subtree is everything whose path starts with this one.
+    path = models.TextField(default='', editable=False)
+    depth = models.PositiveIntegerField(default=0, editable=False)
+    # how documents added to this collection are chunked; see chunkers.CHUNKERS
+    chunking_strategy = models.CharField(max_length=20, choices=CHUNKING_STRATEGIES, default='auto')
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     objects = CollectionQuerySet.as_manager()
@@ -122,40 +149,65 @@ class Collection(models.Model):
     class Meta:
         unique_together = ('name', 'parent')
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['path'], name='collection_path_idx', opclasses=['text_pattern_ops']),
+        ]
+
+    @property
+    def ancestor_ids(self) -> list[int]:
+        """Ids from the root down to and including this collection."""
+        return [int(pk) for pk in self.path.split('/') if pk]
 
     def get_path(self):
-        path = [self.name]
-        current = self
-        while current.parent:
-            current = current.parent
-            path.append(current.name)
-        return '/'.join(reversed(path))
+        return Collection.get_paths([self])[self.pk]
+
+    @classmethod
+    def get_paths(cls, collections) -> dict[int, str]:
+        """Renders the name paths of many collections with a single query. Returns {collection id: path}."""
+        collections = list(collections)
+        ids = {pk for collection in collections for pk in collection.ancestor_ids}
+        names = dict(cls.objects.filter(id__in=ids).values_list('id', 'name'))
+        return {collection.pk: '/'.join(names[pk] for pk in collection.ancestor_ids if pk in names)
+                for collection in collections}
 
     def get_all_children(self):
-        children = list(self.children.all()) # type: ignore
-        for child in self.children.all(): # type: ignore
-            children.extend(child.get_all_children())
-        return children
+        return list(Collection.objects.filter(path__startswith=self.path).exclude(pk=self.pk))
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            parent_path = ''
+            if self.parent_id: # type: ignore
+                # read from the database, in case the parent instance we hold is stale
+                parent_path = Collection.objects.filter(pk=self.parent_id).values_list('path', flat=True).get() # type: ignore
+            new_path = f'{parent_path}{self.pk}/'
+            if new_path != self.path:
+                self._rebase_subtree(new_path)
+
+    def _rebase_subtree(self, new_path: str):
+        old_path = self.path
+        new_depth = new_path.count('/') - 1
+        if not old_path:
+            Collection.objects.filter(pk=self.pk).update(path=new_path, depth=new_depth)
+        else:
+            Collection.objects.filter(path__startswith=old_path).update(
+                path=Concat(Value(new_path), Substr('path', len(old_path) + 1)),
+                depth=F('depth') + (new_depth - self.depth))
+        self.path = new_path
+        self.depth = new_depth
 
     # returns a list of documents, not a queryset.
     @property
     def documents(self):
-        return functools.reduce(lambda l, r: l + r, [list(x.objects.filter(collection=self)) for x in DESCENDED_FROM_DOCUMENT])
+        return Document.filter(collection=self)
 
     def user_has_permission_in(self, user, permissions):
-        # First check permissions directly on this collection
-        if CollectionPermission.objects.filter(
+        # a permission on this collection or on any of its ancestors counts
+        return CollectionPermission.objects.filter(
             user=user,
-            collection=self,
+            collection_id__in=self.ancestor_ids,
             permission__in=permissions
-        ).exists():
-            return True
-        
-        # If no direct permission, check parent collections recursively
-        if self.parent:
-            return self.parent.user_has_permission_in(user, permissions)
-        
-        return False
+        ).exists()
     
 
     def user_can_view(self, user):
@@ -174,21 +226,16 @@ class Collection(models.Model):
             collections = cls.objects.all() # type: ignore
         # pylance doesn't understand custom querysets
         collections = collections.filter_by_user_perm(user, perm) # type: ignore
-        documents = functools.reduce(lambda l, r: l + r, [list(x.objects.filter(collection__in=collections)) for x in DESCENDED_FROM_DOCUMENT])
-        return documents
+        return Document.filter(collection__in=collections)
 
     def move_to(self, new_parent=None):
         """Move this collection to a new parent"""
         if new_parent and new_parent.id == self.pk:
             raise ValidationError("Cannot move a collection to itself")
         
-        # Check for circular reference
-        if new_parent:
-            parent_check = new_parent
-            while parent_check is not None:
-                if parent_check.id == self.pk:
-                    raise ValidationError("Cannot create circular reference in collection hierarchy")
-                parent_check = parent_check.parent
+        # Check for circular reference: the new parent can't be inside this collection's subtree
+        if new_parent and Collection.objects.filter(pk=new_parent.pk, path__startswith=self.path).exists():
+            raise ValidationError("Cannot create circular reference in collection hierarchy")
         
         self.parent = new_parent
         self.save()
@@ -219,16 +266,14 @@ class Collection(models.Model):
         Returns tuple: (source_collection, permission_level)
         If no permission found, returns (None, None)
         """
-        # Check direct permissions
-        permission = CollectionPermission.objects.filter(user=user, collection=self).first()
-        if permission:
-            return (self, permission.permission)
-        
-        # Check parent permissions
-        if self.parent:
-            return self.parent.get_user_permission_source(user)
-            
-        return (None, None)
+        permission = (CollectionPermission.objects
+                      .filter(user=user, collection_id__in=self.ancestor_ids)
+                      .select_related('collection')
+                      .order_by('-collection__depth')
+                      .first())
+        if permission is None:
+            return (None, None)
+        return (permission.collection, permission.permission)
 
 
 class CollectionPermission(models.Model):
@@ -260,64 +305,130 @@ class CollectionPermission(models.Model):
 
             super().save(*args, **kwargs)
             
-@app.task(serializer='pickle', bind=True, track_started=True)
+# acks_late: if the worker dies mid-document, the task is redelivered and resumes from its last stored batch
+@app.task(serializer='pickle', bind=True, track_started=True, acks_late=True, reject_on_worker_lost=True)
 def create_chunks(self, doc_id:str): #naive method, just number of characters
     channel_layer = get_channel_layer()
-    doc = Document.get_by_id(uuid.UUID(doc_id))
+    # the text is streamed from the database in pieces, never loaded whole
+    doc = Document.get_by_id(uuid.UUID(doc_id), defer_text=True)
     if not doc:
         raise ObjectDoesNotExist(f"No document with id {doc_id}")
+    config = apps.get_app_config('aquillm')
+    job = IngestionJob.latest_for(doc.id) or IngestionJob.objects.create(document_id=doc.id)
+    # the broker may deliver the same job twice (and retry() may race a redelivery); only one delivery runs it
+    if not job.claim(self.request.id or str(uuid.uuid4()), config.ingestion_stale_seconds): # type: ignore
+        logger.info(f"Not running ingestion of document {doc.id}: its job is {job.state}")
+        return
     try:
+        doc.set_ingestion_state('processing')
         async_to_sync(channel_layer.group_send)(f'ingestion-dashboard-{doc.ingested_by.id}', {
             'type': 'document.ingestion.start',
             'documentId': str(doc.id),
             'documentName': doc.title,
         })
-        chunk_size = apps.get_app_config('aquillm').chunk_size # type: ignore
-        overlap = apps.get_app_config('aquillm').chunk_overlap # type: ignore
-        chunk_pitch = chunk_size - overlap
-        # Delete existing chunks for this document
-        TextChunk.objects.filter(doc_id=doc.id).delete()
-        last_character = len(doc.full_text) - 1
-        # Create new chunks
-        
-        chunks = list([TextChunk(
-                    content = doc.full_text[chunk_pitch * i : min((chunk_pitch * i) + chunk_size, last_character + 1)],
-                    start_position=chunk_pitch * i,
-                    end_position=min((chunk_pitch * i) + chunk_size, last_character + 1),
-                    doc_id = doc.id,
-                    chunk_number = i) for i in range(last_character // chunk_pitch + 1)])
-        n_chunks = len(chunks)
-        done_chunks = [0] # this has to be a list because of the way python handles closures
-
-        def send_progress():
-            done_chunks[0] += 1
+        job.chunking_strategy = job.chunking_strategy or doc.chunking_strategy()
+        chunker = get_chunker(job.chunking_strategy, config, count_tokens)
+        # Chunks are stored a batch at a time, so a run that failed or was interrupted resumes after the
+        # last stored batch. Document.save deletes the chunks when the text changes, so any found here belong to this text.
+        next_chunk = (TextChunk.objects.filter(doc_id=doc.id).aggregate(last=Coalesce(Max('chunk_number'), -1))['last']) + 1
+
+        # Documents whose text hasn't been extracted yet (PDFs) produce it here, piece by piece. Chunks are
+        # embedded and stored as soon as their text is in. The text is written to full_text once, at the end:
+        # appending each piece in the database would rewrite the whole growing value every time.
+        extracting = doc.needs_extraction()
+        extracted: list[str] = []
+        if extracting:
+            # extraction can't resume part way through a file, so an interrupted run's extraction starts over
+            first, start = 0, 0
+            source = doc.extract_text_pieces()
+            job.set_state('extracting', chunking_strategy=job.chunking_strategy, chunks_done=next_chunk, chunks_total=None)
+        else:
+            # chunkers whose boundaries depend only on position skip straight to the next chunk; the rest re-read the text
+            first, start = chunker.resume_point(next_chunk)
+            source = doc.iter_text(start=start)
+            n_chars = type(doc).objects.filter(pk=doc.pk).annotate(n=Length('full_text')).values_list('n', flat=True).get()
+            job.set_state('chunking', chunking_strategy=job.chunking_strategy, chunks_done=next_chunk, chunks_total=chunker.expected_chunks(n_chars))
+        text_hash = hashlib.sha256()
+        read = {'fraction': 0.0, 'chars': start, 'tokens': 0} # how much of the document has been read so far
+
+        def text_pieces() -> Iterator[str]:
+            for piece, fraction in source:
+                read['fraction'], read['chars'] = fraction, read['chars'] + len(piece)
+                if extracting:
+                    extracted.append(piece)
+                    text_hash.update(piece.encode('utf-8'))
+                    read['tokens'] += count_tokens(piece)
+                yield piece
+
+        batch: list[TextChunk] = []
+
+        def store_batch():
+            embeddings = get_embeddings([chunk.content for chunk in batch], input_type='search_document')
+            for chunk, embedding in zip(batch, embeddings):
+                chunk.embedding = embedding
+            with transaction.atomic():
+                job.check_owner()
+                TextChunk.objects.bulk_create(batch)
+                job.record_batch(len(batch))
+            embedded_fraction = read['fraction'] * batch[-1].end_position / read['chars'] if read['chars'] else 1.0
             async_to_sync(channel_layer.group_send)(f'document-ingest-{doc.id}', {
                 'type': 'document.ingest.progress',
-                'progress': int((done_chunks[0] / n_chunks) * 100),
+                'progress': int(embedded_fraction * 100),
             })
-
-        with concurrent.futures.ThreadPoolExecutor(max_workers=20) as e:
-            e.map(functools.partial(TextChunk.get_chunk_embedding, callback=send_progress), chunks)
-        
-        TextChunk.objects.bulk_create(chunks)
+            batch.clear()
+
+        for chunk_number, chunk in enumerate(chunker.chunks(text_pieces(), first=first), start=first):
+            if chunk_number < next_chunk:
+                continue # stored by an earlier run
+            batch.append(TextChunk(content=chunk.content,
+                                   start_position=chunk.start,
+                                   end_position=chunk.end,
+                                   start_time=chunk.start_time,
+                                   doc_id=doc.id,
+                                   collection_id=doc.collection_id, # type: ignore
+                                   chunk_number=chunk_number))
+            if len(batch) >= config.embedding_batch_size: # type: ignore
+                store_batch()
+        if batch:
+            store_batch()
+
+        if extracting:
+            doc.full_text = ''.join(extracted)
+            doc.full_text_hash = text_hash.hexdigest()
+            doc.token_count = read['tokens']
+            doc.char_count = len(doc.full_text)
+        else:
+            doc.char_count = type(doc).objects.filter(pk=doc.pk).annotate(n=Length('full_text')).values_list('n', flat=True).get()
+        doc.chunk_count = TextChunk.objects.filter(doc_id=doc.id).count()
+        if doc.page_count is None:
+            try:
+                doc.page_count = doc.count_pages()
+            except Exception as e:
+                logger.warning(f"Could not count pages of document {doc.id}: {str(e)}")
+        doc.ingestion_state = 'complete'
         doc.ingestion_complete = True
-        doc.save(dont_rechunk=True)
+        with transaction.atomic():
+            job.check_owner()
+            doc.save(dont_rechunk=True)
+            job.set_state('indexed', chunks_done=doc.chunk_count, chunks_total=doc.chunk_count)
+        evict_embedding_cache()
         async_to_sync(channel_layer.group_send)(f'document-ingest-{doc.id}', {
             'type': 'document.ingest.complete',
             'complete' : True
         })
+    except IngestionJobLost as e:
+        # superseded by a newer version of the document, or taken over by another delivery; leave the job to that
+        logger.warning(f"Stopped ingesting document {doc.id}: {str(e)}")
     except Exception as e:
         logger.error(f"Error creating chunks for document {doc.id}: {str(e)}")
         self.update_state(state=FAILURE)
-        
-        # TEMPORARY FIX: Don't delete documents on error
-        # doc.delete()
-        
-        # Instead, mark the document as complete but with error status
-        doc.ingestion_complete = True
-        doc.full_text += f"\n\nERROR DURING PROCESSING: {str(e)}"
-        doc.save(dont_rechunk=True)
-        
+        # The document's text is left as it is, and the chunks stored so far are kept for a retry to resume from.
+        if job.is_owned():
+            job.fail(str(e))
+        async_to_sync(channel_layer.group_send)(f'document-ingest-{doc.id}', {
+            'type': 'document.ingest.failed',
+            'exception': f"Ingestion failed: {str(e)}",
+        })
         raise e    
 
 class DuplicateDocumentError(ValidationError):
@@ -325,6 +436,14 @@ class DuplicateDocumentError(ValidationError):
         super().__init__(message)
 
 
+INGESTION_STATES = (
+    ('queued', 'Queued'), # saved, waiting for a worker to chunk it
+    ('processing', 'Processing'),
+    ('complete', 'Complete'),
+    ('failed', 'Failed'),
+)
+
+
 class Document(models.Model):
     pkid = models.BigAutoField(primary_key=True, editable=False)
     id = models.UUIDField(default=uuid.uuid4, editable=False, db_index=True)
@@ -334,7 +453,13 @@ class Document(models.Model):
     full_text_hash = models.CharField(max_length=64, db_index=True)
     ingested_by = models.ForeignKey(User, on_delete=models.RESTRICT)
     ingestion_date = models.DateTimeField(auto_now_add=True)
-    ingestion_complete = models.BooleanField(default=True)
+    ingestion_complete = models.BooleanField(default=True) # True once ingestion_state is complete or failed
+    ingestion_state = models.CharField(max_length=20, choices=INGESTION_STATES, default='complete')
+    # Size metadata, so nothing needs to load full_text just to measure it. Mirrored to DocumentRegistry.
+    token_count = models.PositiveIntegerField(default=0) # count_tokens(full_text), kept up to date by save()
+    char_count = models.PositiveIntegerField(default=0)
+    page_count = models.PositiveIntegerField(null=True, blank=True) # None for documents without pages
+    chunk_count = models.PositiveIntegerField(default=0) # set once create_chunks finishes
     class Meta:
         abstract = True
         constraints = [
@@ -345,67 +470,116 @@ class Document(models.Model):
         ]
         ordering = ['-ingestion_date', 'title']
 
+    default_chunking_strategy = 'fixed'
+
     @staticmethod
     def hash_fn(text: str) -> str:
         return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
+    def chunking_strategy(self) -> str:
+        strategy = Collection.objects.filter(pk=self.collection_id).values_list('chunking_strategy', flat=True).first() # type: ignore
+        return self.default_chunking_strategy if strategy in (None, 'auto') else strategy
+
     @property
     def chunks(self):
         return TextChunk.objects.filter(doc_id=self.id)
 
+    def content_hash(self) -> str:
+        return self.hash_fn(self.full_text)
+
+    def iter_text(self, start: int = 0, piece_chars: int = 1000000) -> Iterator[tuple[str, float]]:
+        """
+        Yields the document's text from character `start` on, in consecutive pieces read straight from the database,
+        each with the fraction of the document read so far. full_text itself is never loaded.
+        """
+        rows = type(self).objects.filter(pk=self.pk)
+        length = rows.annotate(n=Length('full_text')).values_list('n', flat=True).get()
+        for offset in range(start, length, piece_chars):
+            piece = rows.annotate(piece=Substr('full_text', offset + 1, piece_chars)).values_list('piece', flat=True).get()
+            yield piece, min(offset + piece_chars, length) / length
+
+    def needs_extraction(self) -> bool:
+        """Whether full_text still has to be produced from a source file, by extract_text_pieces."""
+        return False
+
+    def extract_text_pieces(self) -> Iterator[tuple[str, float]]:
+        raise NotImplementedError(f"{type(self).__name__} has no source to extract text from")
+
+    # When filtering only on fields the registry also has, the registry narrows down which
+    # document tables need to be queried at all.
     @staticmethod
     def filter(*args, **kwargs) -> List[DocumentChild]:
-        return functools.reduce(lambda l, r: l + r, [list(x.objects.filter(*args, **kwargs)) for x in DESCENDED_FROM_DOCUMENT])
+        types = DESCENDED_FROM_DOCUMENT
+        if not args and kwargs and all(k.split('__')[0] in DocumentRegistry.FILTERABLE_FIELDS for k in kwargs):
+            types = DocumentRegistry.document_types(**kwargs)
+        return functools.reduce(lambda l, r: l + r, [list(x.objects.filter(*args, **kwargs)) for x in types], [])
 
     @staticmethod
-    def get_by_id(doc_id: uuid.UUID) -> Optional[DocumentChild]:
-        for t in DESCENDED_FROM_DOCUMENT:
-            doc = t.objects.filter(id=doc_id).first()
-            if doc:
-                return doc
-        return None
+    def get_by_id(doc_id: uuid.UUID, defer_text: bool = False) -> Optional[DocumentChild]:
+        entry = DocumentRegistry.objects.filter(id=doc_id).only('doc_type').first()
+        if entry is None:
+            return None
+        docs = entry.document_class.objects.filter(id=doc_id)
+        return (docs.defer('full_text') if defer_text else docs).first()
 
     
     def save(self, *args, dont_rechunk=False, **kwargs):
         if dont_rechunk:
-            super().save(*args, **kwargs)
+            with transaction.atomic():
+                super().save(*args, **kwargs)
+                DocumentRegistry.sync([self])
+                self._sync_chunk_collection()
             return
         
         # Skip short document validation for now to help diagnose the issue
         #if len(self.full_text) < 100:
         #    raise ValidationError("The full text of a document must be at least 100 characters long.")
         
-        self.full_text_hash = self.hash_fn(self.full_text)
+        self.full_text_hash = self.content_hash()
         
         # TEMPORARY FIX: Skip duplicate check to allow documents through
         # if Document.filter(collection=self.collection, full_text_hash=self.full_text_hash):
         #    raise DuplicateDocumentError(f"Document with title `{self.title}` has the same contents as another document in the same collection.")
         
         is_new = (not (d := Document.get_by_id(doc_id=self.id))) or (self.full_text_hash != d.full_text_hash)
-        super().save(*args, **kwargs)
-        
+        if is_new or not self.token_count:
+            self.token_count = count_tokens(self.full_text)
+            self.char_count = len(self.full_text)
         if is_new:
+            self.ingestion_state = 'queued'
             self.ingestion_complete = False
-            result = None
-            try:
-                result = create_chunks.delay(str(self.id)) # type: ignore
-                for _ in range(4):
-                    if state(result.status) == state(FAILURE):
-                        raise Exception(f"Task failed")
-                    if state(result.status) in [state(RECEIVED), state(STARTED), state(SUCCESS)]:
-                        return
-                    time.sleep(1)
-                raise Exception("Task was not received in time")
-            except Exception as e:
-                logger.error(f"Error creating chunks for document {self.id}: {str(e)}")
-                if result:
-                    result.revoke()
-                # TEMPORARY FIX: Don't delete documents on error
-                # self.delete()
-                
-                # Instead, mark the document as complete but with error
-                self.ingestion_complete = True
-                super().save(dont_rechunk=True)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            DocumentRegistry.sync([self])
+            if is_new:
+                # A job still running on the old text has nothing left to index. Its rows are locked first, which
+                # waits out any batch it is storing (see IngestionJob.check_owner), so no old chunks land after
+                # the delete below.
+                active = list(IngestionJob.objects.select_for_update().filter(
+                    document_id=self.id, state__in=IngestionJob.ACTIVE_STATES).values_list('pk', flat=True))
+                IngestionJob.objects.filter(pk__in=active).update(
+                    state='failed', error='Superseded by a newer version of the document', finished_at=timezone.now())
+                # chunks of the old text; create_chunks resumes from whatever chunks it finds
+                TextChunk.objects.filter(doc_id=self.id).delete()
+            self._sync_chunk_collection()
+            if is_new:
+                job = IngestionJob.objects.create(document_id=self.id)
+                # Chunking is queued once the document is committed, so the worker is sure to find it.
+                # The request doesn't wait on the worker; create_chunks reports its own progress and failures.
+                transaction.on_commit(job.dispatch)
+
+    def set_ingestion_state(self, ingestion_state: str):
+        """Records the ingestion state without going through save(), which would rehash and maybe rechunk the document."""
+        self.ingestion_state = ingestion_state
+        self.ingestion_complete = ingestion_state in ('complete', 'failed')
+        fields = {'ingestion_state': self.ingestion_state, 'ingestion_complete': self.ingestion_complete}
+        with transaction.atomic():
+            type(self).objects.filter(pk=self.pk).update(**fields)
+            DocumentRegistry.objects.filter(id=self.id).update(**fields)
+
+    def _sync_chunk_collection(self):
+        # chunks carry their document's collection so search can filter by collection without joining documents
+        TextChunk.objects.filter(doc_id=self.id).exclude(collection_id=self.collection_id).update(collection_id=self.collection_id) # type: ignore
 
     def move_to(self, new_collection):
         """Move this document to a new collection"""
@@ -415,8 +589,10 @@ class Document(models.Model):
         self.save()
 
     def delete(self, *args, **kwargs):
-        TextChunk.objects.filter(doc_id=self.id).delete()
-        return super().delete(*args, **kwargs)
+        with transaction.atomic():
+            TextChunk.objects.filter(doc_id=self.id).delete()
+            DocumentRegistry.objects.filter(id=self.id).delete()
+            return super().delete(*args, **kwargs)
 
 
     
@@ -428,6 +604,9 @@ class Document(models.Model):
     def original_text(self):
         return self.full_text
 
+    def count_pages(self) -> Optional[int]:
+        return None
+
 
 class VTTDocument(Document):
     audio_file = models.FileField(upload_to='stt_audio/',
@@ -438,6 +617,7 @@ class VTTDocument(Document):
                                                                     'm4a',
                                                                     'aac'
                                                                     ])])
+    default_chunking_strategy = 'captions'
 
 
     
@@ -514,6 +694,9 @@ class HandwrittenNotesDocument(Document):
             self.full_text_hash = hashlib.sha256(self.full_text.encode('utf-8')).hexdigest()
         super().save(*args, **kwargs)
 
+    def count_pages(self) -> Optional[int]:
+        return 1 # one image per document
+
     def extract_text(self):
         try:
             # Process directly with the file object or storage file
@@ -572,25 +755,39 @@ class HandwrittenNotesDocument(Document):
 class PDFDocument(Document):
     pdf_file = models.FileField(upload_to= 'pdfs/', max_length=500, validators=[FileExtensionValidator(['pdf'])])
 
-    def save(self, dont_rechunk=False, *args, **kwargs):
-        
-        if not dont_rechunk:
-            self.extract_text()
-        super().save(*args, **kwargs)
-
-    def extract_text(self):
-        text = ""
-       
-        reader = PdfReader(self.pdf_file)
-        for page in reader.pages:
-            text += page.extract_text() + '\n'
-        self.full_text = text.replace('\0', '')
+    # Text is extracted by create_chunks rather than on save, so uploads return as soon as the file is stored.
+    # Until then the document is identified by the hash of its file.
+    def content_hash(self) -> str:
+        if self.full_text or not self.pdf_file:
+            return super().content_hash()
+        file_hash = hashlib.sha256()
+        for chunk in self.pdf_file.chunks():
+            file_hash.update(chunk)
+        return file_hash.hexdigest()
+
+    # full_text_hash only becomes the hash of the text once extraction finishes
+    def needs_extraction(self) -> bool:
+        return bool(self.pdf_file) and not PDFDocument.objects.filter(pk=self.pk, full_text_hash=SHA256('full_text')).exists()
+
+    def extract_text_pieces(self) -> Iterator[tuple[str, float]]:
+        config = apps.get_app_config('aquillm')
+        with self.pdf_file.open('rb') as f:
+            pdf_bytes = f.read()
+        n_pages, ranges = extract_pages(pdf_bytes, config.pdf_extraction_workers, config.pdf_pages_per_range) # type: ignore
+        self.page_count = n_pages
+        for text, pages_done in ranges:
+            yield text, pages_done / n_pages
+
+    def count_pages(self) -> Optional[int]:
+        return len(PdfReader(self.pdf_file).pages)
 
 
 class TeXDocument(Document):
     pdf_file = models.FileField(upload_to= 'pdfs/', null=True)
+    default_chunking_strategy = 'latex'
 
-    pass
+    def count_pages(self) -> Optional[int]:
+        return len(PdfReader(self.pdf_file).pages) if self.pdf_file else None
 
 class RawTextDocument(Document):
     source_url = models.URLField(max_length=2000, null=True, blank=True)
@@ -606,14 +803,278 @@ DESCENDED_FROM_DOCUMENT = [
 
 DocumentChild = PDFDocument | TeXDocument | RawTextDocument | VTTDocument | HandwrittenNotesDocument
 
+
+class DocumentRegistry(models.Model):
+    """
+    One row per document of any type, mapping its UUID to the concrete table it lives in.
+    Kept in sync by Document.save and Document.delete, so lookups by id or collection
+    are a single indexed query instead of one query per document table.
+    Rebuild it with `manage.py backfill_document_registry`.
+    """
+    SIZE_FIELDS = ['char_count', 'token_count', 'page_count', 'chunk_count']
+    SYNCED_FIELDS = ['doc_type', 'collection', 'title', 'ingested_by', 'ingestion_date', 'ingestion_complete', 'ingestion_state'] + SIZE_FIELDS
+    FILTERABLE_FIELDS = SYNCED_FIELDS + ['id', 'collection_id', 'ingested_by_id']
+
+    id = models.UUIDField(primary_key=True, editable=False)
+    doc_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, related_name='registered_documents')
+    title = models.CharField(max_length=200)
+    ingested_by = models.ForeignKey(User, on_delete=models.RESTRICT)
+    ingestion_date = models.DateTimeField()
+    ingestion_complete = models.BooleanField(default=True)
+    ingestion_state = models.CharField(max_length=20, choices=INGESTION_STATES, default='complete')
+    char_count = models.PositiveIntegerField(default=0)
+    token_count = models.PositiveIntegerField(default=0)
+    page_count = models.PositiveIntegerField(null=True, blank=True)
+    chunk_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['collection', 'doc_type'], name='docregistry_collection_type'),
+            models.Index(fields=['ingested_by', 'ingestion_complete'], name='docregistry_in_progress'),
+        ]
+
+    def __str__(self):
+        return f'{self.doc_type.model} -- {self.title}'
+
+    @property
+    def document_class(self) -> Type[DocumentChild]:
+        return ContentType.objects.get_for_id(self.doc_type_id).model_class() # type: ignore
+
+    def get_document(self) -> Optional[DocumentChild]:
+        return self.document_class.objects.filter(id=self.id).first()
+
+    @property
+    def size_metadata(self) -> dict:
+        return {field: getattr(self, field) for field in self.SIZE_FIELDS}
+
+    @classmethod
+    def entry_for(cls, doc: DocumentChild) -> 'DocumentRegistry':
+        return cls(id=doc.id,
+                   doc_type=ContentType.objects.get_for_model(doc),
+                   collection_id=doc.collection_id, # type: ignore
+                   title=doc.title,
+                   ingested_by_id=doc.ingested_by_id, # type: ignore
+                   ingestion_date=doc.ingestion_date,
+                   ingestion_complete=doc.ingestion_complete,
+                   ingestion_state=doc.ingestion_state,
+                   **{field: getattr(doc, field) for field in cls.SIZE_FIELDS})
+
+    @classmethod
+    def sync(cls, docs) -> None:
+        cls.objects.bulk_create([cls.entry_for(doc) for doc in docs],
+                                update_conflicts=True,
+                                unique_fields=['id'],
+                                update_fields=cls.SYNCED_FIELDS)
+
+    @classmethod
+    def document_types(cls, **kwargs) -> List[Type[DocumentChild]]:
+        """The concrete document classes that have at least one document matching kwargs."""
+        type_ids = cls.objects.filter(**kwargs).order_by().values_list('doc_type', flat=True).distinct()
+        return [ContentType.objects.get_for_id(type_id).model_class() for type_id in type_ids] # type: ignore
+
+
+class IngestionJobLost(Exception):
+    pass
+
+
+class IngestionJob(models.Model):
+    """
+    One run of a document through ingestion: text extraction if the document needs it, then chunking
+    and embedding in batches. Every stored batch is a checkpoint, so retry() picks a failed job
+    up after its last completed batch instead of re-embedding the whole document.
+    """
+    STATES = [
+        ('queued', 'Queued'),
+        ('extracting', 'Extracting'),
+        ('chunking', 'Chunking'),
+        ('embedding', 'Embedding'),
+        ('indexed', 'Indexed'),
+        ('failed', 'Failed'),
+    ]
+    RUNNING_STATES = ['extracting', 'chunking', 'embedding']
+    ACTIVE_STATES = ['queued'] + RUNNING_STATES
+
+    document = models.ForeignKey(DocumentRegistry, on_delete=models.CASCADE, related_name='ingestion_jobs')
+    state = models.CharField(max_length=20, choices=STATES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    batches_done = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    chunks_total = models.PositiveIntegerField(null=True, blank=True) # unknown until the text is chunked, for most strategies
+    chunking_strategy = models.CharField(max_length=20, blank=True, default='') # fixed by the first attempt, so a retry resumes the same chunks
+    error = models.TextField(blank=True, default='')
+    task_id = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['document', '-created_at'], name='ingestionjob_latest'),
+        ]
+
+    def __str__(self):
+        return f'{self.document_id} -- {self.state}'
+
+    @classmethod
+    def latest_for(cls, doc_id) -> Optional['IngestionJob']:
+        return cls.objects.filter(document_id=doc_id).order_by('-created_at').first()
+
+    def set_state(self, state: str, **fields):
+        """Records progress with a queryset update, so the worker never overwrites fields it didn't change."""
+        fields['state'] = state
+        fields['updated_at'] = timezone.now()
+        if state in ('indexed', 'failed'):
+            fields['finished_at'] = fields['updated_at']
+        for field, value in fields.items():
+            setattr(self, field, value)
+        IngestionJob.objects.filter(pk=self.pk).update(**fields)
+
+    def claim(self, task_id: str, stale_after: float) -> bool:
+        """
+        Marks the job as being run by task_id, unless another delivery is already running it. A running job
+        is only taken over once it has made no progress for stale_after seconds, i.e. its worker died.
+        """
+        now = timezone.now()
+        claimable = Q(state='queued') | Q(state__in=self.RUNNING_STATES, updated_at__lt=now - timedelta(seconds=stale_after))
+        claimed = IngestionJob.objects.filter(claimable, pk=self.pk).update(
+            state='chunking', task_id=task_id, attempts=F('attempts') + 1, updated_at=now)
+        self.refresh_from_db()
+        return bool(claimed)
+
+    def is_owned(self) -> bool:
+        """Whether this run still holds the job: it hasn't been superseded, failed, or taken over by another delivery."""
+        return IngestionJob.objects.filter(pk=self.pk, task_id=self.task_id, state__in=self.RUNNING_STATES).exists()
+
+    def check_owner(self):
+        """Locks the job row until the end of the transaction, or raises IngestionJobLost if this run no longer holds it."""
+        if not IngestionJob.objects.select_for_update().filter(pk=self.pk, task_id=self.task_id, state__in=self.RUNNING_STATES).exists():
+            raise IngestionJobLost(f"ingestion job {self.pk} is no longer run by task {self.task_id}")
+
+    def record_batch(self, n_chunks: int):
+        self.batches_done += 1
+        self.chunks_done += n_chunks
+        self.set_state('embedding', batches_done=self.batches_done, chunks_done=self.chunks_done)
+
+    def fail(self, error: str):
+        self.set_state('failed', error=error)
+        doc = Document.get_by_id(self.document_id, defer_text=True)
+        if doc:
+            doc.set_ingestion_state('failed')
+
+    def dispatch(self):
+        try:
+            result = create_chunks.delay(str(self.document_id)) # type: ignore
+            IngestionJob.objects.filter(pk=self.pk).update(task_id=result.id)
+        except Exception as e:
+            # the broker is unreachable, so nothing will ever pick this job up
+            logger.error(f"Could not queue ingestion of document {self.document_id}: {str(e)}")
+            self.fail(f"Could not queue ingestion: {str(e)}")
+
+    def retry(self):
+        """
+        Queues a failed job again. The chunks it stored before failing are kept, so the new run
+        starts after the last completed batch.
+        """
+        with transaction.atomic():
+            # conditional, so that retrying twice at once queues the job only once
+            if not IngestionJob.objects.filter(pk=self.pk, state='failed').update(
+                    state='queued', error='', finished_at=None, updated_at=timezone.now()):
+                raise ValidationError("Only failed ingestion jobs can be retried")
+            self.refresh_from_db()
+            doc = Document.get_by_id(self.document_id, defer_text=True)
+            if doc:
+                doc.set_ingestion_state('queued')
+            transaction.on_commit(self.dispatch)
+
+
+# Vector, full-text and fuzzy trigram candidates in one round trip, fused with reciprocal rank fusion.
+# Each channel is served by its own index: HNSW on embedding, GIN on search_vector, GIN trigram on content.
+# {where} filters by collection and/or document; its parameters are passed once per channel.
+HYBRID_SEARCH_SQL = """
+WITH vector AS (
+    SELECT id, row_number() OVER (ORDER BY distance) AS rank FROM (
+        SELECT id, embedding <-> %s::vector AS distance
+        FROM aquillm_textchunk
+        WHERE {where} AND embedding IS NOT NULL
+        ORDER BY distance
+        LIMIT %s
+    ) nearest
+),
+fulltext AS (
+    SELECT id, row_number() OVER (ORDER BY score DESC) AS rank FROM (
+        SELECT id, ts_rank_cd(search_vector, query) AS score
+        FROM aquillm_textchunk, websearch_to_tsquery('english', %s) query
+        WHERE {where} AND search_vector @@ query
+        ORDER BY score DESC
+        LIMIT %s
+    ) matches
+),
+trigram AS (
+    SELECT id, row_number() OVER (ORDER BY score DESC) AS rank FROM (
+        SELECT id, word_similarity(%s, content) AS score
+        FROM aquillm_textchunk
+        WHERE {where} AND %s <%% content
+        ORDER BY score DESC
+        LIMIT %s
+    ) matches
+),
+candidates AS (
+    SELECT COALESCE(vector.id, fulltext.id, trigram.id) AS id,
+           vector.rank AS vector_rank, fulltext.rank AS fulltext_rank, trigram.rank AS trigram_rank
+    FROM vector
+    FULL OUTER JOIN fulltext ON fulltext.id = vector.id
+    FULL OUTER JOIN trigram ON trigram.id = COALESCE(vector.id, fulltext.id)
+)
+SELECT chunk.id, chunk.content, chunk.start_position, chunk.end_position, chunk.start_time,
+       chunk.chunk_number, chunk.doc_id, chunk.collection_id,
+       vector_rank, fulltext_rank, trigram_rank,
+       COALESCE(1.0 / (%s + vector_rank), 0)
+         + COALESCE(1.0 / (%s + fulltext_rank), 0)
+         + COALESCE(1.0 / (%s + trigram_rank), 0) AS rrf_score
+FROM candidates
+JOIN aquillm_textchunk chunk ON chunk.id = candidates.id
+ORDER BY rrf_score DESC, chunk.id
+"""
+
+# Reranker calls run here so that search can stop waiting on them after rerank_timeout.
+rerank_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='rerank')
+
+
+def attach_documents(chunks: Iterable['TextChunk']) -> None:
+    """
+    Resolves the documents of all the given chunks in bulk and caches them on the chunks,
+    so that chunk.document doesn't cost a query per chunk. One registry query, plus one query
+    per document type present. full_text is deferred, since results only need the metadata.
+    """
+    chunks = [chunk for chunk in chunks if not hasattr(chunk, '_document')]
+    doc_ids = {chunk.doc_id for chunk in chunks}
+    if not doc_ids:
+        return
+    ids_by_type: dict[int, list[uuid.UUID]] = {}
+    for doc_id, type_id in DocumentRegistry.objects.filter(id__in=doc_ids).values_list('id', 'doc_type'):
+        ids_by_type.setdefault(type_id, []).append(doc_id)
+    docs = {}
+    for type_id, ids in ids_by_type.items():
+        model = ContentType.objects.get_for_id(type_id).model_class()
+        docs.update({doc.id: doc for doc in model.objects.filter(id__in=ids).defer('full_text')}) # type: ignore
+    for chunk in chunks:
+        if chunk.doc_id in docs:
+            chunk._document = docs[chunk.doc_id]
+
+
 class TextChunkQuerySet(models.QuerySet):
     def filter_by_documents(self, docs):
         ids = [doc.id for doc in docs]
         return self.filter(doc_id__in=ids)
 
+    def filter_by_collections(self, collections):
+        """collections can be a queryset, in which case the filter is a subquery rather than a list of ids."""
+        return self.filter(collection__in=collections)
+
 def doc_id_validator(id):
-    if sum([t.objects.filter(id=id).exists() for t in DESCENDED_FROM_DOCUMENT]) != 1:
-        raise ValidationError("Invalid Document UUID -- either no such document or multiple")
+    if not DocumentRegistry.objects.filter(id=id).exists():
+        raise ValidationError("Invalid Document UUID -- no such document")
     
 
 class TextChunk(models.Model):
@@ -628,22 +1089,27 @@ class TextChunk(models.Model):
     
     doc_id = models.UUIDField(editable=False,
                                 validators=[doc_id_validator])
+    # denormalised from the document, so search can filter by collection in SQL
+    collection = models.ForeignKey(Collection, on_delete=models.CASCADE, null=True, related_name='text_chunks')
+    search_vector = models.GeneratedField(expression=SearchVector('content', config='english'),
+                                          output_field=SearchVectorField(),
+                                          db_persist=True)
     
 
     @property
     def document(self) -> DocumentChild:
-        ret = None
-        for t in DESCENDED_FROM_DOCUMENT:
-            doc = t.objects.filter(id=self.doc_id).first()
-            if doc:
-                ret = doc
-        if not ret:
-            raise ValidationError(f"TextChunk {self.pk} is not associated with a document!")
+        ret = getattr(self, '_document', None)
+        if ret is None or ret.id != self.doc_id:
+            ret = Document.get_by_id(self.doc_id)
+            if not ret:
+                raise ValidationError(f"TextChunk {self.pk} is not associated with a document!")
+            self._document = ret
         return ret
 
     @document.setter
     def document(self, doc):
         self.doc_id = doc.id
+        self._document = doc
 
 
     objects = TextChunkQuerySet.as_manager()
@@ -668,6 +1134,15 @@ class TextChunk(models.Model):
                 ef_construction=64,
                 opclasses=['vector_l2_ops']
             ),
+            GinIndex(
+                name='chunk_search_vector_index',
+                fields=['search_vector'],
+            ),
+            GinIndex(
+                name='chunk_content_trigram_index',
+                fields=['content'],
+                opclasses=['gin_trgm_ops']
+            ),
         ]
         ordering = ['doc_id', 'chunk_number']
 
@@ -675,17 +1150,16 @@ class TextChunk(models.Model):
         if self.start_position >= self.end_position:
             raise ValueError("end_position must be greater than start_position")
         if not self.embedding:
-            self.get_chunk_embedding()
+            # through the batcher, so a chunk saved on its own still hits the embedding cache
+            self.embedding = get_embeddings([self.content], input_type='search_document')[0]
 
         super().save(*args, **kwargs)
 
-    @retry(wait=wait_exponential())
-    def get_chunk_embedding(self, callback:Optional[Callable[[], None]]=None):
-        self.embedding = get_embedding(self.content, input_type='search_document')
-        if callback:
-            callback()
     @classmethod
     def rerank(cls, query:str, chunks, top_k: int):
+        """Reorders chunks (a list) with the Cohere reranker and returns the top_k of them."""
+        if not chunks:
+            return []
         cohere = apps.get_app_config('aquillm').cohere_client # type: ignore
         response = cohere.rerank(
             model="rerank-english-v3.0",
@@ -695,22 +1169,78 @@ class TextChunk(models.Model):
             top_n=top_k,
             return_documents=True 
         )
-        ranked_list = list([result.document.id for result in response.results])
-        preserved = Case(*[When(pk=pk, then=pos) for pos, pk in enumerate(ranked_list)])
-        return cls.objects.filter(pk__in=ranked_list).order_by(preserved)
+        by_id = {chunk.pk: chunk for chunk in chunks}
+        return [by_id[result.document.id] for result in response.results]
+
+
+    @classmethod
+    def hybrid_candidates(cls, query: str, query_embedding: list[float], docs=None, collections=None) -> list['TextChunk']:
+        """
+        Runs the vector, full-text and trigram searches in one statement and fuses them with reciprocal rank fusion.
+        Each returned chunk has vector_rank, fulltext_rank and trigram_rank (None if it wasn't in that list)
+        and rrf_score, and the list is ordered by rrf_score.
+        """
+        config = apps.get_app_config('aquillm')
+        conditions, where_params = [], []
+        if collections is not None:
+            if isinstance(collections, QuerySet):
+                try:
+                    subquery, subquery_params = collections.values('id').query.sql_with_params()
+                except EmptyResultSet: # e.g. collections.none(), when no collection was picked
+                    return []
+                conditions.append(f"collection_id IN ({subquery})")
+                where_params.extend(subquery_params)
+            else:
+                collections = list(collections)
+                if not collections:
+                    return []
+                conditions.append("collection_id = ANY(%s)")
+                where_params.append(collections)
+        if docs is not None:
+            if not docs:
+                return []
+            conditions.append("doc_id = ANY(%s::uuid[])")
+            where_params.append([str(doc.id) for doc in docs])
+        where = ' AND '.join(conditions)
+        embedding = '[' + ','.join(str(x) for x in query_embedding) + ']'
+        params = ([embedding] + where_params + [config.vector_top_k] + # type: ignore
+                  [query] + where_params + [config.fulltext_top_k] + # type: ignore
+                  [query] + where_params + [query, config.trigram_top_k] + # type: ignore
+                  [config.rrf_k] * 3) # type: ignore
+        chunks = list(cls.objects.raw(HYBRID_SEARCH_SQL.format(where=where), params))
+        attach_documents(chunks)
+        return chunks
 
 
     @classmethod
-    def text_chunk_search(cls, query:str, top_k: int, docs: List[DocumentChild]):
-        vector_top_k = apps.get_app_config('aquillm').vector_top_k # type: ignore
-        trigram_top_k = apps.get_app_config('aquillm').trigram_top_k # type: ignore
+    def text_chunk_search(cls, query:str, top_k: int, docs: Optional[List[DocumentChild]] = None, collections=None):
+        """
+        Searches the chunks of the given documents and/or collections (a Collection queryset or list of ids).
+        Pass collections rather than their documents where possible: the collection filter stays in SQL.
+
+        Returns (vector results, lexical results, final results). The final results come from the reranker if
+        it is enabled and answers within rerank_timeout, and from the fused ranking otherwise.
+        """
+        if docs is None and collections is None:
+            raise ValueError("text_chunk_search needs documents or collections to search")
+        config = apps.get_app_config('aquillm')
 
         try:
-            vector_results = cls.objects.filter_by_documents(docs).order_by(L2Distance('embedding', get_embedding(query)))[:vector_top_k] # type: ignore
-            trigram_results = cls.objects.filter_by_documents(docs).annotate(similarity = TrigramSimilarity('content', query) # type: ignore
-            ).filter(similarity__gt=0.000001).order_by('-similarity')[:trigram_top_k]
-            reranked_results = cls.rerank(query, vector_results | trigram_results, top_k)
-            return vector_results, trigram_results, reranked_results
+            candidates = cls.hybrid_candidates(query, get_embedding(query), docs=docs, collections=collections)
+            vector_results = sorted([chunk for chunk in candidates if chunk.vector_rank is not None], key=lambda chunk: chunk.vector_rank)
+            lexical_results = sorted([chunk for chunk in candidates if chunk.fulltext_rank or chunk.trigram_rank],
+                                     key=lambda chunk: min(rank for rank in (chunk.fulltext_rank, chunk.trigram_rank) if rank))
+            final_results = candidates[:top_k]
+            if config.rerank_enabled and candidates: # type: ignore
+                future = rerank_executor.submit(cls.rerank, query, candidates, top_k)
+                try:
+                    final_results = future.result(timeout=config.rerank_timeout) # type: ignore
+                except concurrent.futures.TimeoutError:
+                    logger.warning(f"Reranker took longer than {config.rerank_timeout}s, using fused ranking") # type: ignore
+                except Exception as e:
+                    logger.warning(f"Reranker failed, using fused ranking: {str(e)}")
+            logger.debug(f"Query embedding cache: {get_query_embedding_cache().stats()}")
+            return vector_results, lexical_results, final_results
         except DatabaseError as e:
             logger.error(f"Database error during search: {str(e)}")
             raise e
@@ -722,26 +1252,69 @@ class TextChunk(models.Model):
             raise e
 
 
+class EmbeddingCacheEntry(models.Model):
+    """Embeddings keyed by content, so identical text is never sent to the embedding provider twice."""
+    model = models.CharField(max_length=100)
+    input_type = models.CharField(max_length=20)
+    content_hash = models.CharField(max_length=64)
+    embedding = VectorField(dimensions=1024)
+    hit_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used = models.DateTimeField(default=timezone.now, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['model', 'input_type', 'content_hash'],
+                name='unique_embedding_per_content'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.model} {self.input_type} {self.content_hash[:12]}'
+
+
+def default_system_prompt():
+    return apps.get_app_config('aquillm').system_prompt # type: ignore
+
+
 class WSConversation(models.Model):
+    """
+    A chat. Its messages live in WSConversationMessage, one row each, so saving a turn
+    only inserts the new messages instead of rewriting the whole conversation.
+    """
     owner = models.ForeignKey(User, related_name='ws_conversations', on_delete=models.CASCADE)
-    convo = models.JSONField(blank=True, null=True, default=convo_model.get_empty_conversation)
+    system = models.TextField(default=default_system_prompt)
     name = models.TextField(blank=True, null=True)
+    # rolling summary of the first summarized_through messages, sent in their place once the chat outgrows its context budget
+    summary = models.TextField(blank=True, null=True)
+    summarized_through = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(editable=False)
     updated_at = models.DateTimeField()
 
     @property
     def convo_object(self) -> convo_model:
-        t = type(self.convo)
-        if t == dict:
-            return convo_model.model_validate(self.convo)
-        elif t == str:
-            return convo_model.model_validate_json(self.convo)
-        else: 
-            raise ValueError(f"Invalid type for convo from database: {t}")
-
-    @convo_object.setter
-    def convo_object(self, convo: convo_model):
-        self.convo = to_jsonable_python(convo)
+        return convo_model.model_validate({'system': self.system,
+                                           'summary': self.summary,
+                                           'summarized_through': self.summarized_through,
+                                           'messages': list(self.messages.order_by('seq').values_list('data', flat=True))}) # type: ignore
+
+    def append_messages(self, messages, start_seq: int):
+        """Stores messages as the conversation's messages from start_seq onward, replacing any already there."""
+        with transaction.atomic():
+            self.messages.filter(seq__gte=start_seq).delete() # type: ignore
+            WSConversationMessage.objects.bulk_create([
+                WSConversationMessage(conversation=self,
+                                      seq=seq,
+                                      message_uuid=message.message_uuid,
+                                      role=message.role,
+                                      data=to_jsonable_python(message))
+                for seq, message in enumerate(messages, start=start_seq)])
+            self.save(update_fields=['updated_at'])
+
+    def update_message(self, message):
+        """Rewrites the stored copy of a single message, matched by message_uuid."""
+        self.messages.filter(message_uuid=message.message_uuid).update(data=to_jsonable_python(message)) # type: ignore
 
     def save(self, *args, **kwargs):
         if not self.pk:
@@ -750,24 +1323,111 @@ class WSConversation(models.Model):
         return super().save(*args, **kwargs)
     
         
-    def set_name(self):
+    def request_name(self):
+        """
+        Queues this conversation to be titled. Titles are generated in the background by name_conversations,
+        which waits title_debounce_seconds so that conversations started around the same time share one LLM call.
+        """
+        config = apps.get_app_config('aquillm')
+        if not cache.add(f'convo-title-requested-{self.pk}', True, timeout=300):
+            return
+        if cache.add('convo-title-batch-scheduled', True, timeout=config.title_debounce_seconds + 60): # type: ignore
+            name_conversations.apply_async(countdown=config.title_debounce_seconds) # type: ignore
+
+    @classmethod
+    def set_names(cls, convos: list['WSConversation']) -> list['WSConversation']:
+        """
+        Titles several conversations with a single LLM call and pushes each title to the conversation's open chats.
+        Returns the conversations that were named.
+        """
         system_prompt="""
-        This is a conversation between a large langauge model and a user.
-        Come up with a brief, roughly 3 to 10 word title for the conversation capturing what the user asked.
-        Respond only with the title. 
-        As an example, if the conversation begins 'What is apple pie made of?', your response should be 'Apple Pie Ingredients'.
+        You will be given the opening messages of several conversations between a large language model and a user, as JSON.
+        For each conversation, come up with a brief, roughly 3 to 10 word title capturing what the user asked.
+        As an example, if a conversation begins 'What is apple pie made of?', its title should be 'Apple Pie Ingredients'.
         The title should capture what is being asked, not what the assistant responded with.
-        If there is not enough information to name the conversation, simply return 'Conversation'.
+        If there is not enough information to name a conversation, its title should be 'Conversation'.
+        Respond only with a JSON object mapping each conversation's id to its title.
         """
         anthropic_client = apps.get_app_config('aquillm').anthropic_client # type: ignore
-        first_two_messages = str(self.convo['messages'][:2])
+        openings = [{'id': convo.pk,
+                     'messages': [{'role': data['role'], 'content': data['content'][:2000]}
+                                  for data in convo.messages.order_by('seq').values_list('data', flat=True)[:2]]} # type: ignore
+                    for convo in convos]
         claude_args = {'model': 'claude-3-5-sonnet-20240620',
-            'max_tokens': 30,
+            'max_tokens': 40 * len(convos) + 50,
             'system': system_prompt,
-            'messages': [{'role': 'user', 'content': first_two_messages}]}
+            'messages': [{'role': 'user', 'content': json.dumps(openings)}]}
         message = anthropic_client.messages.create(**claude_args)
-        self.name = message.content[0].text
-        self.save()
+        try:
+            names = {int(k): str(v).strip() for k, v in cls.parse_names(message.content[0].text).items()}
+        except (ValueError, AttributeError, IndexError) as e:
+            logger.error(f"Could not parse conversation titles: {str(e)}")
+            names = {}
+        named = [convo for convo in convos if names.get(convo.pk)]
+        for convo in named:
+            convo.name = names[convo.pk]
+            # update() rather than save(), so titling doesn't reorder the conversation list by updated_at
+            cls.objects.filter(pk=convo.pk).update(name=convo.name)
+            async_to_sync(channel_layer.group_send)(f'chat-convo-{convo.pk}', {
+                'type': 'convo.name',
+                'name': convo.name,
+            })
+        # the rest stay unnamed, and are requested again with their next message
+        cache.delete_many([f'convo-title-requested-{convo.pk}' for convo in convos if convo not in named])
+        return named
+
+    @staticmethod
+    def parse_names(text: str) -> dict:
+        """The JSON object in the titling reply, which may be wrapped in a markdown code fence or surrounded by prose."""
+        fenced = re.search(r'```(?:json)?\s*(.*?)\s*```', text, re.DOTALL)
+        if fenced:
+            text = fenced.group(1)
+        start, end = text.find('{'), text.rfind('}')
+        if start == -1 or end < start:
+            raise ValueError(f"No JSON object in {text!r}")
+        names = json.loads(text[start:end + 1])
+        if not isinstance(names, dict):
+            raise ValueError(f"Expected a JSON object, got {text!r}")
+        return names
+
+
+class WSConversationMessage(models.Model):
+    conversation = models.ForeignKey(WSConversation, related_name='messages', on_delete=models.CASCADE)
+    seq = models.PositiveIntegerField()
+    message_uuid = models.UUIDField()
+    role = models.CharField(max_length=20)
+    data = models.JSONField() # the serialized LLM_Message
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['conversation', 'seq'],
+                name='unique_message_seq_per_conversation'
+            ),
+        ]
+        ordering = ['conversation', 'seq']
+
+    def __str__(self):
+        return f'{self.conversation_id} #{self.seq} ({self.role})' # type: ignore
+
+
+@app.task(track_started=True)
+def name_conversations():
+    cache.delete('convo-title-batch-scheduled')
+    batch_size = apps.get_app_config('aquillm').title_batch_size # type: ignore
+    unnamed = (WSConversation.objects
+               .filter(Q(name__isnull=True) | Q(name=''))
+               .annotate(n_messages=Count('messages'))
+               .filter(n_messages__gte=2)
+               .order_by('-updated_at'))
+    convos = list(unnamed[:batch_size + 1])
+    if not convos:
+        return
+    named = WSConversation.set_names(convos[:batch_size])
+    # only carry on if the whole batch was named; otherwise the next batch would be the same conversations again
+    if len(convos) > batch_size and len(named) == batch_size:
+        name_conversations.delay()
 
 
 class EmailWhitelist(models.Model):
@@ -0,0 +1,66 @@
+from typing import Iterator
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+import multiprocessing
+import logging
+
+from pypdf import PdfReader
+
+logger = logging.getLogger(__name__)
+
+
+def page_ranges(n_pages: int, pages_per_range: int) -> list[range]:
+    return [range(start, min(start + pages_per_range, n_pages)) for start in range(0, n_pages, pages_per_range)]
+
+
+def extract_range(reader: PdfReader, pages: range) -> str:
+    # NUL bytes can't be stored in a Postgres text column
+    return ''.join([reader.pages[i].extract_text() + '\n' for i in pages]).replace('\0', '')
+
+
+# each pool process parses the PDF once, in the initializer, rather than once per page range
+_worker_reader: PdfReader | None = None
+
+def _init_worker(pdf_bytes: bytes):
+    global _worker_reader
+    _worker_reader = PdfReader(BytesIO(pdf_bytes))
+
+def _extract_range_in_worker(pages: range) -> str:
+    assert _worker_reader is not None
+    return extract_range(_worker_reader, pages)
+
+
+def extract_pages(pdf_bytes: bytes, max_workers: int, pages_per_range: int = 20) -> tuple[int, Iterator[tuple[str, int]]]:
+    """
+    Returns the PDF's page count and an iterator over (text, pages done so far) for consecutive page ranges.
+
+    Ranges are extracted in parallel by a process pool and yielded in page order as soon as they and
+    every range before them are done, so the text can be chunked while later pages are still being read.
+    The pool's processes are spawned rather than forked, since the caller is usually a threaded Celery
+    worker (the ingest queue runs with --pool=threads, see run.sh). Extraction runs in this process instead
+    when a pool can't be started here (a daemonic process, such as a prefork pool child, can't have children)
+    or the document is too small to be worth it.
+    """
+    reader = PdfReader(BytesIO(pdf_bytes))
+    n_pages = len(reader.pages)
+    ranges = page_ranges(n_pages, pages_per_range)
+
+    def in_process() -> Iterator[tuple[str, int]]:
+        for pages in ranges:
+            yield extract_range(reader, pages), pages.stop
+
+    def in_pool() -> Iterator[tuple[str, int]]:
+        with ProcessPoolExecutor(max_workers=min(max_workers, len(ranges)),
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=_init_worker,
+                                 initargs=(pdf_bytes,)) as pool:
+            for pages, text in zip(ranges, pool.map(_extract_range_in_worker, ranges)):
+                yield text, pages.stop
+
+    if max_workers <= 1 or len(ranges) <= 1:
+        return n_pages, in_process()
+    if multiprocessing.current_process().daemon:
+        logger.warning("Extracting PDF pages in a single process: this worker's process is daemonic. "
+                       "Run the ingest queue's worker with --pool=threads to extract in parallel.")
+        return n_pages, in_process()
+    return n_pages, in_pool()
@@ -113,6 +113,11 @@ DATABASES = {
         "PASSWORD": POSTGRES_PASSWORD,
         "HOST": POSTGRES_HOST,
         "PORT": "5432",
+        # Filtered HNSW scans otherwise stop after ef_search candidates and can return fewer than top_k rows.
+        # The trigram search channel matches on word similarity; the 0.6 default is too strict for whole questions.
+        "OPTIONS": {
+            "options": "-c hnsw.iterative_scan=strict_order -c pg_trgm.word_similarity_threshold=0.3",
+        },
         "TEST": {
             'NAME': 'test'
         }
@@ -244,9 +249,22 @@ CHANNEL_LAYERS = {
     }
 }
 
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://redis:6379/1",
+    }
+}
+
 CELERY_BROKER_URL = "redis://redis:6379"
 CELERY_RESULT_BACKEND = "redis://redis:6379"
 CELERY_ACCEPT_CONTENT = ['pickle', 'json']
+# Ingestion runs on its own queue, served by a worker with a thread pool (see run.sh): prefork pool children
+# are daemonic and can't start the process pool that PDF pages are extracted in.
+CELERY_TASK_ROUTES = {'aquillm.models.create_chunks': {'queue': 'ingest'}}
+# Redis hands an unacknowledged task to another worker after visibility_timeout. create_chunks acknowledges late,
+# so this has to outlast the longest ingestion (the default is an hour); IngestionJob.claim stops any overlap anyway.
+CELERY_BROKER_TRANSPORT_OPTIONS = {'visibility_timeout': 12 * 60 * 60}
 
 LOGS_DIR = os.path.join(BASE_DIR, 'logs')
 os.makedirs(LOGS_DIR, exist_ok=True)
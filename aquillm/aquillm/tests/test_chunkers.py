@@ -0,0 +1,115 @@
+import random
+
+import pytest
+from aquillm.chunkers import window_chunks, get_chunker, CHUNKERS, CHUNKING_STRATEGIES, CaptionChunker
+
+
+def whole_text_chunks(text, chunk_size, overlap):
+    # the original create_chunks windows, computed over the whole text at once
+    pitch = chunk_size - overlap
+    last = len(text) - 1
+    return [(pitch * i, min(pitch * i + chunk_size, last + 1), text[pitch * i:min(pitch * i + chunk_size, last + 1)])
+            for i in range(last // pitch + 1)]
+
+
+def split_randomly(text, rng):
+    cuts = sorted(rng.sample(range(len(text) + 1), min(len(text), 8)))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize('length', [0, 1, 99, 100, 150, 151, 1000, 1234])
+def test_streamed_windows_match_whole_text(length):
+    rng = random.Random(length)
+    text = ''.join(rng.choice('abcdefgh ') for _ in range(length))
+    expected = whole_text_chunks(text, 100, 25)
+    assert list(window_chunks([text], 100, 25)) == expected
+    assert list(window_chunks(split_randomly(text, rng), 100, 25)) == expected
+
+
+def test_resumed_windows_match_whole_text():
+    text = ''.join(chr(ord('a') + i % 26) for i in range(1000))
+    expected = whole_text_chunks(text, 100, 25)
+    assert list(window_chunks([text[75 * 4:]], 100, 25, first=4)) == expected[4:]
+    assert list(window_chunks([text[75 * 13:]], 100, 25, first=13)) == expected[13:]
+
+
+def test_windows_are_yielded_before_the_text_ends():
+    def pieces():
+        yield 'a' * 250
+        raise AssertionError("read past the first piece")
+    windows = window_chunks(pieces(), 100, 25)
+    assert next(windows) == (0, 100, 'a' * 100)
+
+
+def test_rejects_overlap_not_smaller_than_chunk():
+    with pytest.raises(ValueError):
+        list(window_chunks(['text'], 10, 10))
+
+
+class Config:
+    chunk_size = 200
+    chunk_overlap = 50
+    chunk_tokens = 40
+    chunk_overlap_tokens = 10
+
+
+def count_words(text):
+    return len(text.split())
+
+
+def prose(n_paragraphs, seed=0):
+    rng = random.Random(seed)
+    return '\n\n'.join(' '.join(f'Sentence {j} of paragraph {i} goes here.' for j in range(rng.randint(1, 12)))
+                         for i in range(n_paragraphs))
+
+
+@pytest.mark.parametrize('strategy', list(CHUNKERS))
+def test_chunks_cover_the_text_the_same_however_it_arrives(strategy):
+    text = prose(200)
+    chunker = get_chunker(strategy, Config, count_words)
+    chunker.horizon = 1000 # several blocks, to exercise streaming
+    chunks = list(chunker.chunks([text]))
+    assert chunks == list(chunker.chunks(split_randomly(text, random.Random(1))))
+    assert all(text[chunk.start:chunk.end] == chunk.content for chunk in chunks)
+    assert all(chunk.end <= next_chunk.end and chunk.start < next_chunk.start for chunk, next_chunk in zip(chunks, chunks[1:]))
+    covered = set().union(*(range(chunk.start, chunk.end) for chunk in chunks))
+    assert all(i in covered or text[i].isspace() for i in range(len(text)))
+
+
+@pytest.mark.parametrize('strategy', ['recursive', 'sentence', 'latex', 'captions'])
+def test_chunks_end_between_sentences_and_fit_the_chunk_size(strategy):
+    chunks = list(get_chunker(strategy, Config, count_words).chunks([prose(50)]))
+    assert all(len(chunk.content) <= Config.chunk_size for chunk in chunks)
+    assert all(chunk.content.rstrip().endswith('.') for chunk in chunks)
+
+
+def test_token_chunks_fit_the_token_budget():
+    chunks = list(get_chunker('tokens', Config, count_words).chunks([prose(50)]))
+    assert all(count_words(chunk.content) <= Config.chunk_tokens for chunk in chunks)
+
+
+def test_latex_chunks_start_at_sections():
+    sections = [f'\\section{{Part {i}}}\n' + 'Some text. ' * 12 + '\n\n' for i in range(10)]
+    chunks = list(get_chunker('latex', Config, count_words).chunks([''.join(sections)]))
+    assert [chunk.content for chunk in chunks] == sections
+
+
+def test_caption_chunks_carry_their_start_time():
+    captions = [f'00:{i // 60:02}:{i % 60:02} Speaker: ' + 'word ' * 15 + '\n\n' for i in range(0, 300, 7)]
+    chunks = list(get_chunker('captions', Config, count_words).chunks([''.join(captions)]))
+    assert len(chunks) > 1
+    for chunk in chunks:
+        assert chunk.start_time == CaptionChunker.caption_time(chunk.content)
+        assert chunk.content in ''.join(captions) and chunk.content.startswith('00:')
+
+
+def test_fixed_chunks_resume_part_way_through():
+    text = prose(100)
+    chunker = get_chunker('fixed', Config, count_words)
+    first, start = chunker.resume_point(7)
+    assert list(chunker.chunks([text[start:]], first=first)) == list(chunker.chunks([text]))[7:]
+    assert chunker.expected_chunks(len(text)) == len(list(chunker.chunks([text])))
+
+
+def test_chunking_strategies_offer_auto_and_every_chunker():
+    assert [name for name, _ in CHUNKING_STRATEGIES] == ['auto'] + list(CHUNKERS)
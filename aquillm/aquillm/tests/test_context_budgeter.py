@@ -0,0 +1,71 @@
+import asyncio
+import logging
+
+from aquillm.llm import (ContextBudgeter, Conversation, LLMInterface, LLMResponse, OpenAIInterface,
+                         UserMessage, AssistantMessage)
+
+
+class FakeLLM(LLMInterface):
+    def __init__(self, client=None, fail=False):
+        self.base_args = {'model': 'fake'}
+        self.fail = fail
+        self.calls = []
+
+    async def get_message(self, *args, **kwargs) -> LLMResponse:
+        self.calls.append(kwargs)
+        if self.fail:
+            raise ConnectionError("simulated provider failure")
+        return LLMResponse(text='The user asked about many things.', stop_reason='end_turn', input_usage=0, output_usage=0)
+
+
+def long_conversation(turns=6, words=300):
+    messages = []
+    for i in range(turns):
+        messages.append(UserMessage(content=f'Question {i}: ' + 'word ' * words))
+        messages.append(AssistantMessage(content=f'Answer {i}: ' + 'word ' * words, stop_reason='end_turn'))
+    return Conversation(system='You are helpful.', messages=messages)
+
+
+def test_conversation_under_budget_is_sent_whole():
+    llm = FakeLLM()
+    conversation = long_conversation(turns=2, words=10)
+    fitted, dicts = asyncio.run(ContextBudgeter(budget=100000).fit(llm, conversation))
+    assert fitted.summary is None
+    assert len(dicts) == len(conversation)
+    assert llm.calls == []
+
+
+def test_old_turns_are_folded_into_a_summary():
+    llm = FakeLLM()
+    conversation = long_conversation()
+    budgeter = ContextBudgeter(budget=1500, keep_recent_turns=2, summary_max_tokens=100)
+    fitted, dicts = asyncio.run(budgeter.fit(llm, conversation))
+    assert fitted.summary == 'The user asked about many things.'
+    assert 0 < fitted.summarized_through <= len(conversation) - 4
+    assert dicts[0]['role'] == 'user'
+    assert len(dicts) == len(conversation) - fitted.summarized_through
+    # the summary request carries no tools
+    assert 'tools' not in llm.calls[0]
+    assert llm.calls[0]['max_tokens'] == 100
+
+
+def test_failed_summary_leaves_the_conversation_unchanged(caplog):
+    llm = FakeLLM(fail=True)
+    conversation = long_conversation()
+    budgeter = ContextBudgeter(budget=1500, keep_recent_turns=2, summary_max_tokens=100)
+    with caplog.at_level(logging.ERROR):
+        fitted, dicts = asyncio.run(budgeter.fit(llm, conversation))
+    assert "Could not summarize conversation" in caplog.text
+    # nothing is marked as summarized, so the folded turns are summarized on the next request
+    assert fitted.summary is None and fitted.summarized_through == 0
+    assert conversation.summary is None
+    # the recent turns are still sent
+    assert dicts[-1]['content'] == conversation[-1].content
+    assert dicts[0]['role'] == 'user'
+
+
+def test_openai_arguments_without_tools():
+    llm = OpenAIInterface(None, 'gpt-4o')
+    arguments = asyncio.run(llm._arguments({'system': 'Summarize.', 'messages': [{'role': 'user', 'content': 'hi'}], 'max_tokens': 10}))
+    assert 'tools' not in arguments
+    assert arguments['messages'][0] == {'role': 'developer', 'content': 'Summarize.'}
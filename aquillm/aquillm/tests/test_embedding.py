@@ -0,0 +1,134 @@
+import pytest
+from aquillm.embedding import EmbeddingBatcher, QueryEmbeddingCache
+
+
+class FakeEmbedResponse:
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+
+class FakeEmbeddingClient:
+    def __init__(self, fail_on_call=None):
+        self.calls = []
+        self.fail_on_call = fail_on_call or set()
+
+    def embed(self, texts, model, input_type):
+        self.calls.append(list(texts))
+        if len(self.calls) in self.fail_on_call:
+            raise ConnectionError("simulated provider failure")
+        return FakeEmbedResponse([[float(len(text))] for text in texts])
+
+
+def test_batcher_respects_item_limit():
+    client = FakeEmbeddingClient()
+    batcher = EmbeddingBatcher(client, max_batch_items=3)
+    texts = [f"text {i}" for i in range(7)]
+    embeddings = batcher.embed(texts)
+    assert [len(call) for call in client.calls] == [3, 3, 1]
+    assert embeddings == [[float(len(text))] for text in texts]
+
+
+def test_batcher_respects_token_limit():
+    client = FakeEmbeddingClient()
+    batcher = EmbeddingBatcher(client, max_batch_items=96, max_batch_tokens=30)
+    texts = ["a" * 80, "b" * 80, "c" * 80]
+    batcher.embed(texts)
+    assert [len(call) for call in client.calls] == [1, 1, 1]
+
+
+def test_batcher_retries_only_failed_batch():
+    client = FakeEmbeddingClient(fail_on_call={2})
+    batcher = EmbeddingBatcher(client, max_batch_items=2, retry_multiplier=0)
+    progress = []
+    texts = ["one", "three", "seven", "eleven"]
+    embeddings = batcher.embed(texts, callback=progress.append)
+    # first batch once, second batch twice (one failure), never the first batch again
+    assert client.calls == [["one", "three"], ["seven", "eleven"], ["seven", "eleven"]]
+    assert progress == [2, 2]
+    assert embeddings == [[3.0], [5.0], [5.0], [6.0]]
+
+
+def test_batcher_rejects_bad_input_type():
+    with pytest.raises(ValueError):
+        EmbeddingBatcher(FakeEmbeddingClient(), input_type='not_a_type')
+
+
+class FakeEmbeddingCache:
+    def __init__(self):
+        self.store = {}
+
+    def get_many(self, model, input_type, texts):
+        return [self.store.get((model, input_type, text)) for text in texts]
+
+    def set_many(self, model, input_type, texts, embeddings):
+        for text, embedding in zip(texts, embeddings):
+            self.store[(model, input_type, text)] = embedding
+
+
+def test_batcher_skips_cached_and_duplicate_texts():
+    client = FakeEmbeddingClient()
+    cache = FakeEmbeddingCache()
+    batcher = EmbeddingBatcher(client, cache=cache)
+    batcher.embed(["alpha", "beta", "alpha"])
+    assert client.calls == [["alpha", "beta"]]
+
+    progress = []
+    embeddings = batcher.embed(["beta", "alpha", "gamma"], callback=progress.append)
+    assert client.calls[1:] == [["gamma"]]
+    assert progress == [2, 1]
+    assert embeddings == [[4.0], [5.0], [5.0]]
+
+    # re-embedding identical content costs no calls at all
+    batcher.embed(["alpha", "beta", "gamma"])
+    assert len(client.calls) == 2
+
+
+def test_cache_is_keyed_by_input_type():
+    client = FakeEmbeddingClient()
+    cache = FakeEmbeddingCache()
+    EmbeddingBatcher(client, cache=cache, input_type='search_document').embed(["alpha"])
+    EmbeddingBatcher(client, cache=cache, input_type='search_query').embed(["alpha"])
+    assert len(client.calls) == 2
+
+
+class FakeSharedCache:
+    def __init__(self):
+        self.store = {}
+
+    def get_many(self, keys):
+        return {key: self.store[key] for key in keys if key in self.store}
+
+    def set_many(self, entries, timeout=None):
+        self.store.update(entries)
+
+
+def test_query_cache_normalizes_and_counts():
+    cache = QueryEmbeddingCache(shared=FakeSharedCache())
+    cache.set_many('m', 'search_query', ["What is  Dark Matter?"], [[1.0]])
+    assert cache.get_many('m', 'search_query', ["what is dark matter?", "something else"]) == [[1.0], None]
+    assert cache.local_hits == 1
+    assert cache.misses == 1
+
+
+def test_query_cache_falls_back_to_shared():
+    shared = FakeSharedCache()
+    QueryEmbeddingCache(shared=shared).set_many('m', 'search_query', ["query"], [[2.0]])
+    other_process = QueryEmbeddingCache(shared=shared)
+    assert other_process.get_many('m', 'search_query', ["query"]) == [[2.0]]
+    assert other_process.shared_hits == 1
+    assert other_process.get_many('m', 'search_query', ["query"]) == [[2.0]]
+    assert other_process.local_hits == 1
+
+
+def test_query_cache_evicts_least_recently_used():
+    cache = QueryEmbeddingCache(max_local_entries=2)
+    cache.set_many('m', 'search_query', ["a", "b"], [[1.0], [2.0]])
+    cache.get_many('m', 'search_query', ["a"])
+    cache.set_many('m', 'search_query', ["c"], [[3.0]])
+    assert cache.get_many('m', 'search_query', ["a", "b", "c"]) == [[1.0], None, [3.0]]
+
+
+def test_query_cache_expires_entries():
+    cache = QueryEmbeddingCache(ttl=-1)
+    cache.set_many('m', 'search_query', ["a"], [[1.0]])
+    assert cache.get_many('m', 'search_query', ["a"]) == [None]
@@ -0,0 +1,116 @@
+import pytest
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from aquillm import models
+from aquillm.models import Collection, CollectionPermission, IngestionJob, RawTextDocument, TextChunk, WSConversation
+
+@pytest.mark.django_db
+def test_collection_permissions_are_inherited():
+    user = User.objects.create_user(username='testuser', password='12345')
+    root = Collection.objects.create(name="Root")
+    child = Collection.objects.create(name="Child", parent=root)
+    grandchild = Collection.objects.create(name="Grandchild", parent=child)
+    Collection.objects.create(name="Unrelated")
+    CollectionPermission.objects.create(user=user, collection=root, permission='EDIT')
+
+    assert grandchild.user_can_edit(user) is True
+    assert grandchild.user_can_manage(user) is False
+    assert set(Collection.objects.filter_by_user_perm(user, 'VIEW')) == {root, child, grandchild}
+    assert grandchild.get_user_permission_source(user) == (root, 'EDIT')
+
+@pytest.mark.django_db
+def test_collection_move_maintains_paths():
+    root = Collection.objects.create(name="Root")
+    child = Collection.objects.create(name="Child", parent=root)
+    grandchild = Collection.objects.create(name="Grandchild", parent=child)
+    other = Collection.objects.create(name="Other")
+
+    assert grandchild.get_path() == "Root/Child/Grandchild"
+    assert set(root.get_all_children()) == {child, grandchild}
+
+    child.move_to(other)
+    grandchild.refresh_from_db()
+    assert grandchild.get_path() == "Other/Child/Grandchild"
+    assert grandchild.depth == 2
+    assert root.get_all_children() == []
+
+    with pytest.raises(ValidationError):
+        other.move_to(grandchild)
+
+
+@pytest.mark.parametrize('reply', [
+    '{"1": "Apple Pie Ingredients", "2": "Conversation"}',
+    '```json\n{"1": "Apple Pie Ingredients", "2": "Conversation"}\n```',
+    'Here are the titles:\n```\n{"1": "Apple Pie Ingredients", "2": "Conversation"}\n```',
+])
+def test_conversation_titles_are_parsed_from_fenced_replies(reply):
+    assert WSConversation.parse_names(reply) == {'1': 'Apple Pie Ingredients', '2': 'Conversation'}
+
+
+def test_unparseable_conversation_titles_raise():
+    with pytest.raises(ValueError):
+        WSConversation.parse_names('Sorry, I cannot title these.')
+
+
+def test_collection_offers_every_chunking_strategy():
+    field = Collection._meta.get_field('chunking_strategy')
+    assert [name for name, _ in field.choices] == [name for name, _ in models.CHUNKING_STRATEGIES]
+
+
+@pytest.fixture
+def searchable_chunks(monkeypatch):
+    """Two collections with one document each; every chunk embeds, like the query, as the same vector."""
+    monkeypatch.setattr(models, 'get_embedding', lambda text, **kwargs: [1.0] * 1024)
+    monkeypatch.setattr(apps.get_app_config('aquillm'), 'rerank_enabled', False)
+    user = User.objects.create_user(username='searcher', password='12345')
+    docs = []
+    for name in ('Apples', 'Pears'):
+        collection = Collection.objects.create(name=name)
+        doc = RawTextDocument(title=name, full_text=f'{name} grow on trees.', collection=collection, ingested_by=user)
+        doc.save()
+        TextChunk.objects.bulk_create([TextChunk(content=doc.full_text, start_position=0, end_position=len(doc.full_text),
+                                                 chunk_number=0, doc_id=doc.id, collection=collection, embedding=[1.0] * 1024)])
+        docs.append(doc)
+    return docs
+
+@pytest.mark.django_db
+def test_search_is_scoped_to_collections(searchable_chunks):
+    apples, pears = searchable_chunks
+    vector_results, lexical_results, results = TextChunk.text_chunk_search(
+        'apples', 5, collections=Collection.objects.filter(id=apples.collection_id))
+    assert [chunk.doc_id for chunk in results] == [apples.id]
+    assert [chunk.doc_id for chunk in vector_results] == [apples.id]
+    assert [chunk.doc_id for chunk in lexical_results] == [apples.id]
+    _, _, results = TextChunk.text_chunk_search('trees', 5, collections=[pears.collection_id])
+    assert [chunk.doc_id for chunk in results] == [pears.id]
+
+@pytest.mark.django_db
+def test_search_is_scoped_to_documents(searchable_chunks):
+    apples, pears = searchable_chunks
+    _, _, results = TextChunk.text_chunk_search('trees', 5, docs=[pears])
+    assert [chunk.doc_id for chunk in results] == [pears.id]
+    assert results[0].document == pears
+
+@pytest.mark.django_db
+def test_search_with_nothing_selected_finds_nothing(searchable_chunks):
+    assert TextChunk.text_chunk_search('trees', 5, collections=Collection.objects.none()) == ([], [], [])
+    assert TextChunk.text_chunk_search('trees', 5, collections=[]) == ([], [], [])
+    assert TextChunk.text_chunk_search('trees', 5, docs=[]) == ([], [], [])
+
+@pytest.mark.django_db
+def test_new_text_supersedes_the_running_ingestion_job():
+    user = User.objects.create_user(username='editor', password='12345')
+    doc = RawTextDocument(title='Notes', full_text='First draft.', collection=Collection.objects.create(name='Notes'), ingested_by=user)
+    doc.save()
+    old_job = IngestionJob.objects.get(document_id=doc.id)
+    assert old_job.claim('old-task', stale_after=60)
+    TextChunk.objects.bulk_create([TextChunk(content=doc.full_text, start_position=0, end_position=len(doc.full_text),
+                                             chunk_number=0, doc_id=doc.id, collection=doc.collection)])
+
+    doc.full_text = 'Second draft.'
+    doc.save()
+    old_job.refresh_from_db()
+    assert old_job.state == 'failed'
+    assert not TextChunk.objects.filter(doc_id=doc.id).exists()
+    assert IngestionJob.objects.get(document_id=doc.id, state='queued') != old_job
@@ -0,0 +1,58 @@
+from aquillm import pdf_extraction
+from aquillm.pdf_extraction import extract_pages, page_ranges
+
+
+def make_pdf(texts):
+    """A minimal PDF with one line of Helvetica text per page."""
+    page_ids = [4 + 2 * i for i in range(len(texts))]
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>",
+               b"<< /Type /Pages /Kids [" + b" ".join(b"%d 0 R" % i for i in page_ids) + b"] /Count %d >>" % len(texts),
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    for page_id, text in zip(page_ids, texts):
+        stream = b"BT /F1 24 Tf 72 720 Td (" + text.encode('ascii') + b") Tj ET"
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % (page_id + 1))
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(pdf)
+    pdf += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    pdf += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    pdf += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return pdf
+
+
+class RecordingPool(pdf_extraction.ProcessPoolExecutor):
+    started = 0
+
+    def __init__(self, *args, **kwargs):
+        RecordingPool.started += 1
+        super().__init__(*args, **kwargs)
+
+
+def test_page_ranges_cover_every_page():
+    assert page_ranges(5, 2) == [range(0, 2), range(2, 4), range(4, 5)]
+    assert page_ranges(0, 2) == []
+
+
+def test_pages_are_extracted_in_parallel_and_in_order(monkeypatch):
+    monkeypatch.setattr(pdf_extraction, 'ProcessPoolExecutor', RecordingPool)
+    texts = [f'Page number {i}' for i in range(7)]
+    n_pages, pieces = extract_pages(make_pdf(texts), max_workers=3, pages_per_range=2)
+    pieces = list(pieces)
+    assert RecordingPool.started == 1
+    assert n_pages == 7
+    assert [pages_done for _, pages_done in pieces] == [2, 4, 6, 7]
+    text = ''.join(piece for piece, _ in pieces)
+    assert [line.strip() for line in text.splitlines()] == texts
+
+
+def test_small_documents_are_extracted_in_process(monkeypatch):
+    monkeypatch.setattr(pdf_extraction, 'ProcessPoolExecutor', RecordingPool)
+    started = RecordingPool.started
+    n_pages, pieces = extract_pages(make_pdf(['Only page']), max_workers=3, pages_per_range=2)
+    assert [piece.strip() for piece, _ in pieces] == ['Only page']
+    assert RecordingPool.started == started
@@ -1,4 +1,3 @@
-
 import logging
 logger = logging.getLogger(__name__)
 
@@ -6,17 +5,39 @@ logger = logging.getLogger(__name__)
 
 
 from django.apps import apps
+from django.core.cache import cache
+from functools import cache as memoize
+
+from .embedding import EmbeddingBatcher, DatabaseEmbeddingCache, QueryEmbeddingCache
+
+embedding_cache = DatabaseEmbeddingCache()
+
+
+# built lazily because the app config isn't ready when this module is imported
+@memoize
+def get_query_embedding_cache() -> QueryEmbeddingCache:
+    config = apps.get_app_config('aquillm')
+    return QueryEmbeddingCache(max_local_entries=config.query_embedding_cache_size, # type: ignore
+                               ttl=config.query_embedding_cache_ttl, # type: ignore
+                               shared=cache)
 
 
 def get_embedding(query: str, input_type: str='search_query'):
-    cohere_client = apps.get_app_config('aquillm').cohere_client
-    if cohere_client is None:
+    return get_embeddings([query], input_type=input_type)[0]
+
+
+def get_embeddings(texts: list[str], input_type: str='search_document', callback=None) -> list[list[float]]:
+    config = apps.get_app_config('aquillm')
+    if config.cohere_client is None:
         raise Exception("Cohere client is still none while app is running")
-    if input_type not in ('search_document', 'search_query', 'classification', 'clustering'):
-        raise ValueError(f'bad input type to embedding call: {input_type}')
-    response = cohere_client.embed(
-        texts=[query],
-        model="embed-english-v3.0",
-        input_type=input_type
-    )
-    return response.embeddings[0]
+    batcher = EmbeddingBatcher(config.cohere_client,
+                               input_type=input_type,
+                               max_batch_items=config.embedding_batch_size, # type: ignore
+                               max_batch_tokens=config.embedding_batch_tokens, # type: ignore
+                               # one-off search queries don't belong in the persistent table
+                               cache=get_query_embedding_cache() if input_type == 'search_query' else embedding_cache)
+    return batcher.embed(texts, callback=callback)
+
+
+def evict_embedding_cache() -> int:
+    return embedding_cache.evict(apps.get_app_config('aquillm').embedding_cache_max_entries) # type: ignore
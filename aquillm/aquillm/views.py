@@ -26,7 +26,7 @@ from django.views.decorators.http import require_http_methods
 from django.views.decorators.csrf import requires_csrf_token
 
 from .forms import SearchForm, ArXiVForm, PDFDocumentForm, VTTDocumentForm, NewCollectionForm, HandwrittenNotesForm
-from .models import TextChunk, TeXDocument, PDFDocument, VTTDocument, Collection, CollectionPermission, WSConversation, DESCENDED_FROM_DOCUMENT, HandwrittenNotesDocument
+from .models import TextChunk, Document, TeXDocument, PDFDocument, VTTDocument, Collection, CollectionPermission, WSConversation, HandwrittenNotesDocument
 from . import vtt
 from .settings import DEBUG
 
@@ -126,8 +126,8 @@ def search(request):
             query = form.cleaned_data['query']
             top_k = form.cleaned_data['top_k']
             collections = form.cleaned_data['collections']
-            searchable_docs = Collection.get_user_accessible_documents(request.user, collections=collections)
-            vector_results, trigram_results, reranked_results = TextChunk.text_chunk_search(query, top_k, searchable_docs)
+            searchable_collections = collections.filter_by_user_perm(request.user)
+            vector_results, trigram_results, reranked_results = TextChunk.text_chunk_search(query, top_k, collections=searchable_collections)
         else:
             error_message = "Invalid form submisison"
     else:
@@ -176,11 +176,7 @@ def search(request):
 
 # helper func, not a view
 def get_doc(request, doc_id):
-    doc = None
-    for t in DESCENDED_FROM_DOCUMENT:
-        doc = t.objects.filter(id=doc_id).first()
-        if doc:
-            break
+    doc = Document.get_by_id(doc_id)
     if not doc:
         raise Http404("Requested document does not exist")
     if not doc.collection.user_can_view(request.user):
@@ -1,8 +1,8 @@
 from typing import Optional
 from json import loads, dumps
+from hashlib import sha256
 from uuid import UUID
 
-from asgiref.sync import async_to_sync
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.auth import AuthMiddlewareStack
 from channels.db import database_sync_to_async, aclose_old_connections
@@ -13,10 +13,10 @@ from django.apps import apps
 from pydantic import ValidationError
 from pydantic_core import to_jsonable_python
 import aquillm.llm
-from aquillm.llm import UserMessage, Conversation, LLMTool, LLMInterface, test_function, ToolChoice, llm_tool, ToolResultDict
+from aquillm.llm import UserMessage, Conversation, LLMTool, LLMInterface, LLMStreamEvent, test_function, ToolChoice, llm_tool, ToolResultDict
 from aquillm.settings import DEBUG
 
-from aquillm.models import TextChunk, Collection, CollectionPermission, WSConversation, Document, DocumentChild
+from aquillm.models import TextChunk, Collection, CollectionPermission, WSConversation, Document, DocumentChild, DocumentRegistry
 
 from anthropic._exceptions import OverloadedError
 
@@ -42,10 +42,10 @@ def get_vector_search_func(user: User, col_ref: CollectionsRef):
         """
         Uses a combination of vector search, trigram search and reranking to search the documents available to the user.
         """
-        docs = Collection.get_user_accessible_documents(user, Collection.objects.filter(id__in=col_ref.collections))
-        if not docs:
+        collections = Collection.objects.filter(id__in=col_ref.collections).filter_by_user_perm(user)
+        if not DocumentRegistry.objects.filter(collection__in=collections).exists():
             return {"exception": "No documents to search! Either no collections were selected, or the selected collections are empty."}
-        _,_,results = TextChunk.text_chunk_search(search_string, top_k, docs)
+        _,_,results = TextChunk.text_chunk_search(search_string, top_k, collections=collections)
         ret = {"result": {f"[Result {i+1}] -- {chunk.document.title} chunk #: {chunk.chunk_number} chunk_id:{chunk.id}": chunk.content for i, chunk in enumerate(results)}}
         return ret
     
@@ -62,7 +62,8 @@ def get_document_ids_func(user: User, col_ref: CollectionsRef) -> LLMTool:
         """
         Get the names and IDs of all documents in the selected collections. When a user asks to see a document in full, or to search a single document, use this to get its ID.
         """
-        docs = Collection.get_user_accessible_documents(user, Collection.objects.filter(id__in=col_ref.collections))
+        collections = Collection.objects.filter(id__in=col_ref.collections).filter_by_user_perm(user)
+        docs = DocumentRegistry.objects.filter(collection__in=collections).only('id', 'title')
         if not docs:
             return {"exception": "No documents to search! Either no collections were selected, or the selected collections are empty."}
         return {"result": {doc.title: str(doc.id) for doc in docs}}
@@ -79,14 +80,20 @@ def get_whole_document_func(user: User, chat_ref: ChatRef) -> LLMTool:
         Get the full text of a document. Use when a user asks you to get a full document. Depending on the size of the document, this will not always be possible. 
         """
         doc_uuid = UUID(doc_id)
-        doc: Optional[DocumentChild] = Document.get_by_id(doc_uuid)
-        if doc is None:
+        # the registry holds the document's token count, so the size check happens before loading the text
+        entry = DocumentRegistry.objects.filter(id=doc_uuid).select_related('collection').first()
+        if entry is None:
             return {"exception": f"Document {doc_id} does not exist!"}
-        if not doc.collection.user_can_view(user):
+        if not entry.collection.user_can_view(user):
             return {"exception": f"User cannot access document {doc_id}!"}
-        token_count = async_to_sync(chat_ref.chat.llm_if.token_count)(chat_ref.chat.convo, doc.full_text)
-        if token_count > 150000:
+        llm_if = chat_ref.chat.llm_if
+        # the document is a tool result of the current turn, which the context budgeter always sends in full
+        budget = llm_if.context_budgeter.budget if llm_if.context_budgeter else apps.get_app_config('aquillm').context_budget
+        if llm_if.document_tokens(entry.token_count) > budget - llm_if.token_count(chat_ref.chat.convo):
             return {"exception": f"Document {doc_id} is too large to open in this chat."}
+        doc: Optional[DocumentChild] = entry.get_document()
+        if doc is None:
+            return {"exception": f"Document {doc_id} does not exist!"}
         return {"result": doc.full_text}
     
     return whole_document
@@ -109,7 +116,7 @@ def get_search_single_document_func(user: User) -> LLMTool:
             return {"exception": f"Document {doc_id} does not exist!"}
         if not doc.collection.user_can_view(user):
             return {"exception": f"User cannot access document {doc_id}!"}
-        _,_,results = TextChunk.text_chunk_search(search_string, top_k, [doc])
+        _,_,results = TextChunk.text_chunk_search(search_string, top_k, docs=[doc])
         ret = {"result": {f"[Result {i+1}] -- {chunk.document.title} chunk #: {chunk.chunk_number} chunk_id:{chunk.id}": chunk.content for i, chunk in enumerate(results)}}
         return ret
     
@@ -162,14 +169,83 @@ class ChatConsumer(AsyncWebsocketConsumer):
     
     
     col_ref = CollectionsRef([])
+
+    # Delta protocol state. Every message to the client carries a version one higher than the last.
+    # A "sync" sends the whole conversation; a "delta" sends a list of ops against the previous version:
+    #   {"op": "append", "message": {...}}, {"op": "update", "message": {...}} (a message changed in place, matched by message_uuid),
+    #   {"op": "rate", "message_uuid": ..., "rating": ...}
+    # A client that misses a version asks for a resync.
+    version: int = 0
+    sent_uuids: list[str] = [] # message_uuids of the messages the client has, in order
+    sent_hashes: list[str] = [] # hashes of those messages as sent, to spot ones changed in place
+    saved_uuids: list[str] = [] # message_uuids of the messages stored in the database, in order
     
+    # stores only the messages added since the last save. Messages are only ever appended, so if the stored
+    # prefix no longer matches, everything from the first difference on is rewritten.
     @database_sync_to_async
     def __save(self):
+        assert self.db_convo is not None and self.convo is not None
+        uuids = [str(message.message_uuid) for message in self.convo]
+        start = 0
+        while start < min(len(uuids), len(self.saved_uuids)) and uuids[start] == self.saved_uuids[start]:
+            start += 1
+        if start < self.convo.summarized_through:
+            # summarized messages were replaced, so the summary no longer describes them
+            self.convo.summary, self.convo.summarized_through = None, 0
+        if start < len(uuids) or len(self.saved_uuids) != len(uuids):
+            self.db_convo.append_messages(self.convo.messages[start:], start)
+        self.saved_uuids = uuids
+        if (self.convo.summary, self.convo.summarized_through) != (self.db_convo.summary, self.db_convo.summarized_through):
+            self.db_convo.summary, self.db_convo.summarized_through = self.convo.summary, self.convo.summarized_through
+            self.db_convo.save(update_fields=['summary', 'summarized_through'])
+        if len(uuids) >= 2 and not self.db_convo.name:
+            self.db_convo.request_name()
+
+    @database_sync_to_async
+    def __save_message(self, message):
+        assert self.db_convo is not None
+        self.db_convo.update_message(message)
+
+    @database_sync_to_async
+    def __load_convo(self) -> Conversation:
         assert self.db_convo is not None
-        self.db_convo.convo = to_jsonable_python(self.convo)
-        if len(self.db_convo.convo['messages']) >= 2 and not self.db_convo.name:
-            self.db_convo.set_name()
-        self.db_convo.save()
+        return self.db_convo.convo_object
+
+    @staticmethod
+    def message_hash(message) -> str:
+        return sha256(message.model_dump_json().encode('utf-8')).hexdigest()
+
+    async def send_sync(self):
+        assert self.convo is not None
+        self.version += 1
+        self.sent_uuids = [str(message.message_uuid) for message in self.convo]
+        self.sent_hashes = [self.message_hash(message) for message in self.convo]
+        await self.send(text_data=dumps({"sync": {"version": self.version, "conversation": to_jsonable_python(self.convo)}}))
+
+    async def send_delta(self, ops: list[dict]):
+        if not ops:
+            return
+        self.version += 1
+        await self.send(text_data=dumps({"delta": {"version": self.version, "ops": ops}}))
+
+    # sends the messages changed in place and those added since the last send. Messages are only ever
+    # appended, so one removed or replaced means resync.
+    async def send_changes(self):
+        assert self.convo is not None
+        uuids = [str(message.message_uuid) for message in self.convo]
+        if uuids[:len(self.sent_uuids)] != self.sent_uuids:
+            await self.send_sync()
+            return
+        hashes = [self.message_hash(message) for message in self.convo]
+        ops = [{"op": "update", "message": to_jsonable_python(message)}
+               for message, old_hash, new_hash in zip(self.convo.messages, self.sent_hashes, hashes) if old_hash != new_hash]
+        ops += [{"op": "append", "message": to_jsonable_python(message)} for message in self.convo.messages[len(self.sent_uuids):]]
+        self.sent_uuids, self.sent_hashes = uuids, hashes
+        await self.send_delta(ops)
+
+    # forwards streamed deltas to the client as they arrive. Only the finished message is saved, by send_func.
+    async def stream_func(self, event: LLMStreamEvent):
+        await self.send(text_data=dumps({"stream": event.model_dump(include={'type', 'text', 'tool_name'}, exclude_none=True)}))
 
     @database_sync_to_async
     def __get_convo(self, convo_id: int, user: User):
@@ -190,7 +266,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         async def send_func(convo: Conversation):
             self.convo = convo
-            await self.send(text_data=dumps({"conversation": to_jsonable_python(self.convo) }))
+            await self.send_changes()
             await self.__save()
 
         await self.accept()
@@ -210,10 +286,14 @@ class ChatConsumer(AsyncWebsocketConsumer):
             await self.send('{"exception": "Invalid chat_id"}')
             
             return
+        # the conversation's title arrives here once the background titling task has named it
+        await self.channel_layer.group_add(f'chat-convo-{self.db_convo.id}', self.channel_name) # type: ignore
         try:
-            self.convo = Conversation.model_validate(self.db_convo.convo)
+            self.convo = await self.__load_convo()
+            self.saved_uuids = [str(message.message_uuid) for message in self.convo]
             self.convo.rebind_tools(self.tools)
-            await self.llm_if.spin(self.convo, max_func_calls=5, max_tokens=2048, send_func=send_func)
+            await self.send_sync()
+            await self.llm_if.spin(self.convo, max_func_calls=5, max_tokens=2048, send_func=send_func, stream_func=self.stream_func)
             return 
         except OverloadedError as e:
             self.dead = True
@@ -230,12 +310,21 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
 
 
+    async def disconnect(self, close_code):
+        if self.db_convo is not None:
+            await self.channel_layer.group_discard(f'chat-convo-{self.db_convo.id}', self.channel_name) # type: ignore
+
+    async def convo_name(self, event):
+        if self.db_convo is not None:
+            self.db_convo.name = event['name']
+        await self.send(text_data=dumps({"name": event['name']}))
+
     async def receive(self, text_data):
 
         async def send_func(convo: Conversation):
             await aclose_old_connections()
             self.convo = convo
-            await self.send(text_data=dumps({"conversation": to_jsonable_python(self.convo)}))
+            await self.send_changes()
             await self.__save()
 
         async def append(data: dict):
@@ -250,19 +339,26 @@ class ChatConsumer(AsyncWebsocketConsumer):
             assert self.convo is not None
             message = [message for message in self.convo if str(message.message_uuid) == data['uuid']][0]
             message.rating = data['rating']
-            await self.__save()
+            # the rate op brings the client's copy up to date, so no update op is needed for it later
+            if data['uuid'] in self.sent_uuids:
+                self.sent_hashes[self.sent_uuids.index(data['uuid'])] = self.message_hash(message)
+            await self.send_delta([{"op": "rate", "message_uuid": data['uuid'], "rating": message.rating}])
+            await self.__save_message(message)
 
         if not self.dead:
             try:
                 data = loads(text_data)
                 action = data.pop('action', None)
+                if action == 'resync':
+                    await self.send_sync()
+                    return
                 if action == 'append':
                     await append(data)
                 elif action == 'rate':
                     await rate(data)
                 else:
                     raise ValueError(f'Invalid action "{action}"')
-                await self.llm_if.spin(self.convo, max_func_calls=5, max_tokens=2048, send_func=send_func)
+                await self.llm_if.spin(self.convo, max_func_calls=5, max_tokens=2048, send_func=send_func, stream_func=self.stream_func)
             except Exception as e:
                 if DEBUG:
                     raise e
@@ -7,8 +7,7 @@ from django.contrib.auth.models import User
 from django.apps import apps
 from json import dumps
 from aquillm.settings import DEBUG
-from aquillm.models import DESCENDED_FROM_DOCUMENT
-from functools import reduce
+from aquillm.models import DocumentRegistry, IngestionJob
 import logging
 logger = logging.getLogger(__name__)
 
@@ -19,6 +18,15 @@ class IngestMonitorConsumer(AsyncWebsocketConsumer):
     #         hasattr(self.channel_layer, 'group_send') and
     #         isinstance(self.channel_layer.group_send, Awaitable))# keeps type checker happy
 
+    @database_sync_to_async
+    def __get_state(self, doc_id):
+        return DocumentRegistry.objects.filter(id=doc_id).values_list('ingestion_state', flat=True).first()
+
+    @database_sync_to_async
+    def __get_error(self, doc_id):
+        job = IngestionJob.latest_for(doc_id)
+        return job.error if job and job.error else None
+
     async def connect(self):
         self.user = self.scope.get('user', None)
         is_authenticated = bool(self.user and getattr(self.user, 'is_authenticated', False))
@@ -26,10 +34,22 @@ class IngestMonitorConsumer(AsyncWebsocketConsumer):
             await self.accept()
         else:
             await self.close()
-        await self.channel_layer.group_add(f"document-ingest-{self.scope['url_route']['kwargs']['doc_id']}", self.channel_name) # type: ignore
+        doc_id = self.scope['url_route']['kwargs']['doc_id']
+        await self.channel_layer.group_add(f"document-ingest-{doc_id}", self.channel_name) # type: ignore
+        # ingestion may have finished, or failed, before the monitor connected
+        ingestion_state = await self.__get_state(doc_id)
+        if ingestion_state == 'complete':
+            await self.send(text_data=dumps({'type': 'document.ingest.complete', 'complete': True}))
+        elif ingestion_state == 'failed':
+            error = await self.__get_error(doc_id)
+            await self.send(text_data=dumps({'type': 'document.ingest.failed',
+                                             'exception': f'Ingestion failed: {error}' if error else 'Ingestion failed'}))
 
     async def document_ingest_complete(self, event):
         await self.send(text_data=dumps(event))
+
+    async def document_ingest_failed(self, event):
+        await self.send(text_data=dumps(event))
         
     async def document_ingest_progress(self, event):
         await self.send(text_data=dumps(event))
@@ -40,8 +60,7 @@ class IngestMonitorConsumer(AsyncWebsocketConsumer):
 class IngestionDashboardConsumer(AsyncWebsocketConsumer):
     @database_sync_to_async
     def __get_in_progress(self, user):
-        querysets = [t.objects.filter(ingested_by=user, ingestion_complete=False).order_by('ingestion_date') for t in DESCENDED_FROM_DOCUMENT]    
-        return reduce(lambda l,r : list(l) + list(r), querysets)
+        return list(DocumentRegistry.objects.filter(ingested_by=user, ingestion_complete=False).order_by('ingestion_date'))
     
     async def connect(self):
         self.user = self.scope.get('user')
@@ -1,7 +1,9 @@
 #!/bin/bash
 set -e
 
-celery -A aquillm worker --loglevel=info &
+celery -A aquillm worker -Q celery --loglevel=info &
+# ingestion: threads, so each task can start a process pool to extract PDF pages in parallel
+celery -A aquillm worker -Q ingest -n ingest@%h --pool=threads --concurrency=${INGEST_CONCURRENCY:-4} --loglevel=info &
 
 cd /app/react
 npm ci
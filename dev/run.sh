@@ -17,5 +17,7 @@ cd /app/aquillm
 ./manage.py migrate --noinput
 ./manage.py collectstatic --noinput
 
-celery -A aquillm worker --loglevel=info &
+celery -A aquillm worker -Q celery --loglevel=info &
+# ingestion: threads, so each task can start a process pool to extract PDF pages in parallel
+celery -A aquillm worker -Q ingest -n ingest@%h --pool=threads --concurrency=${INGEST_CONCURRENCY:-4} --loglevel=info &
 python -Xfrozen_modules=off manage.py runserver 0.0.0.0:${PORT:-8080}
\ No newline at end of file
@@ -4,13 +4,18 @@ import { CircularProgressbar } from 'react-circular-progressbar';
 import ReactMarkdown from 'react-markdown';
 
 // Define TypeScript interfaces
+interface ToolCall {
+  id: string;
+  name: string;
+  input: any;
+}
+
 interface Message {
   role: 'user' | 'assistant' | 'tool';
   content: string;
   message_uuid?: string;
   rating?: number;
-  tool_call_name?: string;
-  tool_call_input?: any;
+  tool_calls?: ToolCall[];
   tool_name?: string;
   result_dict?: any;
   for_whom?: 'user' | 'assistant';
@@ -27,17 +32,66 @@ interface Conversation {
   usage?: number;
 }
 
+interface StreamEvent {
+  type: 'text' | 'tool_call';
+  text?: string;
+  tool_name?: string;
+}
+
+// Conversation updates are versioned: a sync carries the whole conversation, a delta carries
+// the ops that turn the previous version into this one. A gap in versions triggers a resync.
+type DeltaOp =
+  | { op: 'append'; message: Message }
+  | { op: 'update'; message: Message }
+  | { op: 'rate'; message_uuid: string; rating: number };
+
 interface WebSocketMessage {
   exception?: string;
-  conversation?: Conversation;
+  sync?: { version: number; conversation: Conversation };
+  delta?: { version: number; ops: DeltaOp[] };
+  stream?: StreamEvent;
+  name?: string;
 }
 
+// The usage shown is that of the most recent assistant message.
+const withUsage = (conversation: Conversation): Conversation => {
+  const lastAssistantMessage = conversation.messages
+    .slice()
+    .reverse()
+    .find((msg) => msg.role === 'assistant');
+  if (lastAssistantMessage && lastAssistantMessage.usage !== undefined) {
+    return { ...conversation, usage: lastAssistantMessage.usage };
+  }
+  return conversation;
+};
+
+const applyDelta = (conversation: Conversation, ops: DeltaOp[]): Conversation => {
+  let messages = conversation.messages;
+  for (const op of ops) {
+    if (op.op === 'rate') {
+      messages = messages.map(msg => msg.message_uuid === op.message_uuid ? { ...msg, rating: op.rating } : msg);
+    } else {
+      // appends are upserts too, so the server's copy replaces a message the client added optimistically
+      const index = messages.findIndex(msg => msg.message_uuid === op.message.message_uuid);
+      if (index >= 0) {
+        messages = [...messages.slice(0, index), op.message, ...messages.slice(index + 1)];
+      } else if (op.op === 'append') {
+        messages = [...messages, op.message];
+      }
+    }
+  }
+  return withUsage({ ...conversation, messages });
+};
+
 interface ChatProps {
   convoId: string;
 }
 
 const Chat: React.FC<ChatProps> = ({ convoId }) => {
   const [conversation, setConversation] = useState<Conversation>({ messages: [] });
+  // Text of the assistant message currently being streamed. Cleared when the finished message arrives.
+  const [streamingText, setStreamingText] = useState('');
+  const [streamingToolName, setStreamingToolName] = useState('');
   const [isConnected, setIsConnected] = useState(false);
   const [inputDisabled, setInputDisabled] = useState(true);
   const [messageInput, setMessageInput] = useState('');
@@ -49,6 +103,7 @@ const Chat: React.FC<ChatProps> = ({ convoId }) => {
   const [showCollections, setShowCollections] = useState(false);
   
   const wsRef = useRef<WebSocket | null>(null);
+  const versionRef = useRef(0);
   const conversationEndRef = useRef<HTMLDivElement>(null);
   const messageContainerRef = useRef<HTMLDivElement>(null);
   
@@ -61,6 +116,18 @@ const Chat: React.FC<ChatProps> = ({ convoId }) => {
     if (conversationEndRef.current) {
       conversationEndRef.current.scrollIntoView({ behavior: 'smooth' });
     }
+  }, [conversation, streamingText]);
+
+  // Input is enabled once the assistant has finished its turn
+  useEffect(() => {
+    if (conversation.messages.length) {
+      const lastMessage = conversation.messages[conversation.messages.length - 1];
+      const shouldEnableInput =
+        (lastMessage.role === 'assistant' && !hasToolCalls(lastMessage)) ||
+        (lastMessage.role === 'tool' && !awaitingAssistant(conversation.messages));
+
+      setInputDisabled(!shouldEnableInput);
+    }
   }, [conversation]);
 
   // Fetch collections on component mount
@@ -140,31 +207,44 @@ const Chat: React.FC<ChatProps> = ({ convoId }) => {
           }
           
           setException('');
-          
-          if (data.conversation) {
-            const updatedConversation = data.conversation;
-
-            // Find the most recent assistant message
-            const lastAssistantMessage = updatedConversation.messages
-              .slice()
-              .reverse()
-              .find((msg) => msg.role === 'assistant');
-
-            // Update conversation.usage if the last assistant message has usage
-            if (lastAssistantMessage && lastAssistantMessage.usage !== undefined) {
-              updatedConversation.usage = lastAssistantMessage.usage;
-            }
 
-            setConversation(updatedConversation);
+          if (data.name) {
+            // the conversation was titled in the background
+            document.title = data.name;
+            return;
+          }
 
-            if (updatedConversation.messages.length) {
-              const lastMessage = updatedConversation.messages[updatedConversation.messages.length - 1];
-              const shouldEnableInput =
-                (lastMessage.role === 'assistant' && !lastMessage.tool_call_input) ||
-                (lastMessage.role === 'tool' && lastMessage.for_whom === 'user');
+          if (data.stream) {
+            const event = data.stream;
+            if (event.type === 'text' && event.text) {
+              setStreamingText(prev => prev + event.text);
+            } else if (event.type === 'tool_call' && event.tool_name) {
+              const toolName = event.tool_name;
+              setStreamingToolName(prev => prev ? `${prev}, ${toolName}` : toolName);
+            }
+            return;
+          }
+          
+          if (data.sync) {
+            setStreamingText('');
+            setStreamingToolName('');
+            versionRef.current = data.sync.version;
+            setConversation(withUsage(data.sync.conversation));
+          }
 
-              setInputDisabled(!shouldEnableInput);
+          if (data.delta) {
+            if (data.delta.version !== versionRef.current + 1) {
+              // missed an update, so the local copy can't be patched. Ask for the whole conversation.
+              ws.send(JSON.stringify({ action: 'resync' }));
+              return;
+            }
+            versionRef.current = data.delta.version;
+            const ops = data.delta.ops;
+            if (ops.some(op => op.op === 'append')) {
+              setStreamingText('');
+              setStreamingToolName('');
             }
+            setConversation(prev => applyDelta(prev, ops));
           }
         } catch (error) {
           setException(`Error processing message: ${error instanceof Error ? error.message : 'Unknown error'}`);
@@ -205,7 +285,7 @@ const Chat: React.FC<ChatProps> = ({ convoId }) => {
     if (!messageInput.trim() || !wsRef.current || wsRef.current.readyState !== WebSocket.OPEN) return;
     
     setInputDisabled(true);
-    const newMessage: Message = { role: 'user', content: messageInput.trim() };
+    const newMessage: Message = { role: 'user', content: messageInput.trim(), message_uuid: crypto.randomUUID() };
     
     const updatedConversation = { 
       ...conversation, 
@@ -293,7 +373,16 @@ const Chat: React.FC<ChatProps> = ({ convoId }) => {
             />
           ))}
           
-          {shouldShowSpinner(conversation.messages) && (
+          {(streamingText || streamingToolName) && (
+            <MessageBubble
+              key="msg-streaming"
+              message={{ role: 'assistant', content: streamingText }}
+              onRate={rateMessage}
+              streamingToolName={streamingToolName}
+            />
+          )}
+
+          {!streamingText && shouldShowSpinner(conversation.messages) && (
             <div className="flex justify-center my-4">
               <div className="animate-spin rounded-full h-8 w-8 border-4 border-blue-500 border-t-transparent"></div>
             </div>
@@ -396,19 +485,34 @@ const Chat: React.FC<ChatProps> = ({ convoId }) => {
   );
 };
 
+const hasToolCalls = (message: Message) => !!message.tool_calls?.length;
+
+// The results of one turn's tool calls arrive together; the assistant responds if any of them are for it
+const awaitingAssistant = (messages: Message[]) => {
+  for (let i = messages.length - 1; i >= 0 && messages[i].role === 'tool'; i--) {
+    if (messages[i].for_whom === 'assistant') return true;
+  }
+  return false;
+};
+
 // Helper function to determine if spinner should be shown
 const shouldShowSpinner = (messages: Message[]) => {
   if (messages.length === 0) return false;
   const lastMessage = messages[messages.length - 1];
   return (
     lastMessage.role === 'user' ||
-    (lastMessage.role === 'assistant' && lastMessage.tool_call_input) ||
-    (lastMessage.role === 'tool' && lastMessage.for_whom === 'assistant')
+    (lastMessage.role === 'assistant' && hasToolCalls(lastMessage)) ||
+    (lastMessage.role === 'tool' && awaitingAssistant(messages))
   );
 };
 
 // MessageBubble component
-const MessageBubble: React.FC<{ message: Message, onRate: (uuid: string | undefined, rating: number) => void }> = ({ message, onRate }) => {
+const MessageBubble: React.FC<{
+  message: Message,
+  onRate: (uuid: string | undefined, rating: number) => void,
+  streamingToolName?: string
+}> = ({ message, onRate, streamingToolName }) => {
+  const isStreaming = streamingToolName !== undefined;
   const getMessageClasses = () => {
     let classes = "w-4/5 p-2.5 rounded-[12px] shadow-md whitespace-pre-wrap break-words element-border";
     
@@ -437,7 +541,7 @@ const MessageBubble: React.FC<{ message: Message, onRate: (uuid: string | undefi
         {message.role === 'user' && (
           <p className="whitespace-pre-wrap break-words">{message.content}</p>
         )}
-        {message.role === 'assistant' && !message.tool_call_input && (
+        {message.role === 'assistant' && !hasToolCalls(message) && (
           <div className="prose prose-invert max-w-none compact-prose leading-tight [&>*]:my-1 [&_ol>li>p]:inline">
             <ReactMarkdown>
               {message.content}
@@ -445,21 +549,28 @@ const MessageBubble: React.FC<{ message: Message, onRate: (uuid: string | undefi
           </div>
         )}
         
-        {/* Tool call details for assistant */}
-        {message.role === 'assistant' && message.tool_call_input && (
+        {/* Tool call being streamed */}
+        {isStreaming && streamingToolName && (
           <div className="mt-2.5 text-sm">
-            <strong>Called Tool: {message.tool_call_name}</strong>
+            <strong>Calling Tool: {streamingToolName}</strong>
+          </div>
+        )}
+
+        {/* Tool call details for assistant */}
+        {message.role === 'assistant' && message.tool_calls?.map((toolCall) => (
+          <div key={toolCall.id} className="mt-2.5 text-sm">
+            <strong>Called Tool: {toolCall.name}</strong>
             <Collapsible 
               summary="View Tool Arguments" 
               summaryTextColor="text-text-non_user_text_bubble"
               content={
                 <pre className="whitespace-pre-wrap break-words bg-tool_details-assistant p-2 rounded text-text-non_user_text_bubble">
-                  {JSON.stringify(message.tool_call_input, null, 2)}
+                  {JSON.stringify(toolCall.input, null, 2)}
                 </pre>
               }
             />
           </div>
-        )}
+        ))}
         
         {/* Tool output */}
         {message.role === 'tool' && (
@@ -484,7 +595,7 @@ const MessageBubble: React.FC<{ message: Message, onRate: (uuid: string | undefi
         )}
         
         {/* Rating buttons */}
-        {(message.role === 'assistant' || message.role === 'tool') && (
+        {(message.role === 'assistant' || message.role === 'tool') && !isStreaming && (
           <RatingButtons 
             rating={message.rating} 
             onRate={(rating) => onRate(message.message_uuid, rating)}